@@ -11,7 +11,22 @@
 #include <vtkImageData.h>
 #include <vtkMatrix4x4.h>
 #include <vtkOrientedGridTransform.h>
-#include <vtkOrientedGridTransform.h>
+#include <vtkSMPThreadLocalObject.h>
+#include <vtkSMPTools.h>
+#include <vtkType.h>
+
+// ITK includes
+#include <itk_zlib.h>
+
+// STD includes
+#include <algorithm>
+#include <atomic>
+#include <cmath>
+#include <cstdio>
+#include <fstream>
+#include <iomanip>
+#include <mutex>
+#include <vector>
 
 // Use an anonymous namespace to keep class types and function names
 // from colliding when module is used as shared object module.  Every
@@ -20,128 +35,730 @@
 //
 namespace
 {
-void GetTransformedPointSamplesAsVectorImage(vtkImageData* vectorImage, vtkMRMLTransformNode* inputTransformNode, vtkMatrix4x4* ijkToRAS)
+// Reports the progress of a loop over slices run by several threads,
+// at most once per percent and from whichever thread crosses it.
+class SliceProgressReporter
 {
-  vtkNew<vtkGeneralTransform> inputTransform;
-  inputTransformNode->GetTransformFromWorld(inputTransform.GetPointer());
+public:
+  SliceProgressReporter(int numberOfSlices)
+    : NumberOfSlices(numberOfSlices), CompletedSlices(0), ReportedPercent(0)
+  {
+  }
+
+  void SliceCompleted()
+  {
+    int percent = 100 * (++this->CompletedSlices) / this->NumberOfSlices;
+    int reported = this->ReportedPercent;
+    while (percent > reported)
+    {
+      if (this->ReportedPercent.compare_exchange_weak(reported, percent))
+      {
+        std::lock_guard<std::mutex> lock(this->OutputMutex);
+        std::cout << "<filter-progress>" << (percent / 100.0) << "</filter-progress>" << std::endl << std::flush;
+        break;
+      }
+    }
+  }
+
+private:
+  int NumberOfSlices;
+  std::atomic<int> CompletedSlices;
+  std::atomic<int> ReportedPercent;
+  std::mutex OutputMutex;
+};
+
+// Samples the displacement of a transform over the voxels of an image.
+// The image is split in slabs of slices processed by vtkSMPTools.
+// vtkGeneralTransform is not thread safe, so each thread evaluates its own copy.
+class TransformPointSamplesFunctor
+{
+public:
+  TransformPointSamplesFunctor(vtkImageData* vectorImage, vtkGeneralTransform* inputTransform, vtkMatrix4x4* ijkToRAS, SliceProgressReporter& progress)
+    : VectorImage(vectorImage), InputTransform(inputTransform), Progress(progress)
+  {
+    this->IJKToRAS->DeepCopy(ijkToRAS);
+  }
+
+  void Initialize()
+  {
+    vtkGeneralTransform*& transform = this->Transform.Local();
+    transform->DeepCopy(this->InputTransform);
+    transform->Update();
+  }
+
+  void operator()(vtkIdType beginSlice, vtkIdType endSlice)
+  {
+    vtkGeneralTransform* transform = this->Transform.Local();
+    double point_RAS[4] = { 0, 0, 0, 1 };
+    double transformedPoint_RAS[4] = { 0, 0, 0, 1 };
+    double point_IJK[4] = { 0, 0, 0, 1 };
+    int* extent = this->VectorImage->GetExtent();
+    int* dim = this->VectorImage->GetDimensions();
+    float* scalars = static_cast<float*>(this->VectorImage->GetScalarPointer());
+    for (vtkIdType k = beginSlice; k < endSlice; k++)
+    {
+      point_IJK[2] = k;
+      float* voxelPtr = scalars + 3 * static_cast<vtkIdType>(k - extent[4]) * dim[0] * dim[1];
+      for (point_IJK[1] = extent[2]; point_IJK[1] <= extent[3]; point_IJK[1]++)
+      {
+        for (point_IJK[0] = extent[0]; point_IJK[0] <= extent[1]; point_IJK[0]++)
+        {
+          this->IJKToRAS->MultiplyPoint(point_IJK, point_RAS);
+
+          transform->TransformPoint(point_RAS, transformedPoint_RAS);
 
+          // store the pointDislocationVector_RAS components in the image
+          *(voxelPtr++) = static_cast<float>(transformedPoint_RAS[0] - point_RAS[0]);
+          *(voxelPtr++) = static_cast<float>(transformedPoint_RAS[1] - point_RAS[1]);
+          *(voxelPtr++) = static_cast<float>(transformedPoint_RAS[2] - point_RAS[2]);
+        }
+      }
+      this->Progress.SliceCompleted();
+    }
+  }
+
+  void Reduce()
+  {
+  }
+
+private:
+  vtkImageData* VectorImage;
+  vtkGeneralTransform* InputTransform;
+  vtkNew<vtkMatrix4x4> IJKToRAS;
+  vtkSMPThreadLocalObject<vtkGeneralTransform> Transform;
+  SliceProgressReporter& Progress;
+};
+
+void GetTransformedPointSamplesAsVectorImage(vtkImageData* vectorImage, vtkGeneralTransform* inputTransform, vtkMatrix4x4* ijkToRAS, SliceProgressReporter& progress)
+{
   // The orientation of the volume cannot be set in the image
   // therefore the volume will not appear in the correct position
   // if the direction matrix is not identity.
   vectorImage->AllocateScalars(VTK_FLOAT, 3);
 
-  double point_RAS[4] = { 0, 0, 0, 1 };
-  double transformedPoint_RAS[4] = { 0, 0, 0, 1 };
-  double point_IJK[4] = { 0, 0, 0, 1 };
-  float* voxelPtr = static_cast<float*>(vectorImage->GetScalarPointer());
   int* extent = vectorImage->GetExtent();
-  int* dim = vectorImage->GetDimensions();
-  float numberOfVoxels = dim[0] * dim[1] * dim[2];
-  unsigned int voxelCount = 0;
-  for (point_IJK[2] = extent[4]; point_IJK[2] <= extent[5]; point_IJK[2]++)
+  TransformPointSamplesFunctor functor(vectorImage, inputTransform, ijkToRAS, progress);
+  vtkSMPTools::For(extent[4], extent[5] + 1, functor);
+}
+
+// Direct interpolation of the displacement grid of a vtkOrientedGridTransform,
+// reading its buffer without going through the (not thread safe) transform.
+// Points outside of the grid take the displacement of the closest border voxel,
+// as in vtkGridTransform. Cubic interpolation uses Catmull-Rom weights with the
+// border voxels replicated, so it can differ from VTK next to the grid borders.
+class DisplacementGridSampler
+{
+public:
+  // Returns false if the transform is not a displacement grid applied in the forward direction
+  bool SetTransform(vtkAbstractTransform* transform)
   {
-    for (point_IJK[1] = extent[2]; point_IJK[1] <= extent[3]; point_IJK[1]++)
+    vtkOrientedGridTransform* gridTransform = vtkOrientedGridTransform::SafeDownCast(transform);
+    if (gridTransform == nullptr || gridTransform->GetInverseFlag() || gridTransform->GetDisplacementGrid() == nullptr)
     {
-      for (point_IJK[0] = extent[0]; point_IJK[0] <= extent[1]; point_IJK[0]++)
+      return false;
+    }
+    vtkImageData* grid = gridTransform->GetDisplacementGrid();
+    if (grid->GetNumberOfScalarComponents() != 3 ||
+        (grid->GetScalarType() != VTK_FLOAT && grid->GetScalarType() != VTK_DOUBLE))
+    {
+      return false;
+    }
+    this->Scalars = grid->GetScalarPointer();
+    this->ScalarType = grid->GetScalarType();
+    grid->GetExtent(this->Extent);
+    this->Scale = gridTransform->GetDisplacementScale();
+    this->Shift = gridTransform->GetDisplacementShift();
+    this->InterpolationMode = gridTransform->GetInterpolationMode();
+
+    // RAS to (extent relative) IJK
+    double* origin = grid->GetOrigin();
+    double* spacing = grid->GetSpacing();
+    vtkMatrix4x4* direction = gridTransform->GetGridDirectionMatrix();
+    vtkNew<vtkMatrix4x4> ijkToRAS;
+    for (int r = 0; r < 3; r++)
+    {
+      for (int c = 0; c < 3; c++)
       {
-        ijkToRAS->MultiplyPoint(point_IJK, point_RAS);
+        ijkToRAS->SetElement(r, c, (direction ? direction->GetElement(r, c) : (r == c)) * spacing[c]);
+      }
+      ijkToRAS->SetElement(r, 3, origin[r]);
+    }
+    this->IJKToRAS->DeepCopy(ijkToRAS.GetPointer());
+    vtkMatrix4x4::Invert(ijkToRAS.GetPointer(), this->RASToIJK.GetPointer());
+    return true;
+  }
 
-        inputTransform->TransformPoint(point_RAS, transformedPoint_RAS);
+  // True if the grid has the given extent and index to RAS matrix,
+  // so its voxels can be read with GetVoxel instead of interpolated.
+  bool HasGeometry(const int extent[6], vtkMatrix4x4* ijkToRAS) const
+  {
+    for (int i = 0; i < 6; i++)
+    {
+      if (extent[i] != this->Extent[i])
+      {
+        return false;
+      }
+    }
+    for (int r = 0; r < 3; r++)
+    {
+      for (int c = 0; c < 4; c++)
+      {
+        if (std::fabs(ijkToRAS->GetElement(r, c) - this->IJKToRAS->GetElement(r, c)) > 1e-6)
+        {
+          return false;
+        }
+      }
+    }
+    return true;
+  }
 
-        // store the pointDislocationVector_RAS components in the image
-        *(voxelPtr++) = static_cast<float>(transformedPoint_RAS[0] - point_RAS[0]);
-        *(voxelPtr++) = static_cast<float>(transformedPoint_RAS[1] - point_RAS[1]);
-        *(voxelPtr++) = static_cast<float>(transformedPoint_RAS[2] - point_RAS[2]);
+  // Displacement of the voxel with the given (absolute) index
+  void GetVoxel(int i, int j, int k, double displacement[3]) const
+  {
+    vtkIdType offset = 3 * ((i - this->Extent[0]) + (this->Extent[1] - this->Extent[0] + 1) *
+      ((j - this->Extent[2]) + static_cast<vtkIdType>(this->Extent[3] - this->Extent[2] + 1) * (k - this->Extent[4])));
+    for (int a = 0; a < 3; a++)
+    {
+      double value = this->ScalarType == VTK_FLOAT ? static_cast<const float*>(this->Scalars)[offset + a] : static_cast<const double*>(this->Scalars)[offset + a];
+      displacement[a] = value * this->Scale + this->Shift;
+    }
+  }
+
+  // Extent of an image, with the given RAS to IJK matrix, outside of which this grid
+  // samples to zero displacement. It is empty (lower bound above upper bound) if the
+  // whole grid is zero, and the whole image if the non zero voxels reach the grid
+  // border, as points outside of the grid take the displacement of the border.
+  void GetSupportExtent(const int imageExtent[6], vtkMatrix4x4* imageRASToIJK, int supportExtent[6]) const
+  {
+    for (int i = 0; i < 6; i++)
+    {
+      supportExtent[i] = imageExtent[i];
+    }
+    if (this->Shift != 0)
+    {
+      return;
+    }
 
-        voxelCount++;
-        if (voxelCount % 10000 == 0)
+    int size[3];
+    int lower[3], upper[3];
+    for (int a = 0; a < 3; a++)
+    {
+      size[a] = this->Extent[2*a+1] - this->Extent[2*a] + 1;
+      lower[a] = size[a];
+      upper[a] = -1;
+    }
+    vtkIdType voxel = 0;
+    for (int k = 0; k < size[2]; k++)
+    {
+      for (int j = 0; j < size[1]; j++)
+      {
+        for (int i = 0; i < size[0]; i++, voxel++)
         {
-          std::cout << "<filter-progress>" << (voxelCount / numberOfVoxels) << "</filter-progress>" << std::endl << std::flush;
+          bool nonZero = this->ScalarType == VTK_FLOAT ?
+            this->IsNonZero(static_cast<const float*>(this->Scalars) + 3 * voxel) :
+            this->IsNonZero(static_cast<const double*>(this->Scalars) + 3 * voxel);
+          if (nonZero)
+          {
+            int index[3] = { i, j, k };
+            for (int a = 0; a < 3; a++)
+            {
+              lower[a] = std::min(lower[a], index[a]);
+              upper[a] = std::max(upper[a], index[a]);
+            }
+          }
         }
       }
     }
+    if (upper[0] < 0)
+    {
+      supportExtent[1] = supportExtent[0] - 1;
+      return;
+    }
+
+    // voxels reached by the interpolation kernel
+    int margin = this->InterpolationMode == VTK_CUBIC_INTERPOLATION ? 2 : 1;
+    for (int a = 0; a < 3; a++)
+    {
+      lower[a] -= margin;
+      upper[a] += margin;
+      if (lower[a] < 0 || upper[a] > size[a] - 1)
+      {
+        return;
+      }
+    }
+
+    // bounding box of the corners in the image index space
+    double imageLower[3] = { VTK_DOUBLE_MAX, VTK_DOUBLE_MAX, VTK_DOUBLE_MAX };
+    double imageUpper[3] = { VTK_DOUBLE_MIN, VTK_DOUBLE_MIN, VTK_DOUBLE_MIN };
+    for (int corner = 0; corner < 8; corner++)
+    {
+      double point_IJK[4] = { 0, 0, 0, 1 };
+      double point_RAS[4], imagePoint_IJK[4];
+      for (int a = 0; a < 3; a++)
+      {
+        point_IJK[a] = this->Extent[2*a] + ((corner >> a) & 1 ? upper[a] : lower[a]);
+      }
+      this->IJKToRAS->MultiplyPoint(point_IJK, point_RAS);
+      imageRASToIJK->MultiplyPoint(point_RAS, imagePoint_IJK);
+      for (int a = 0; a < 3; a++)
+      {
+        imageLower[a] = std::min(imageLower[a], imagePoint_IJK[a]);
+        imageUpper[a] = std::max(imageUpper[a], imagePoint_IJK[a]);
+      }
+    }
+    for (int a = 0; a < 3; a++)
+    {
+      supportExtent[2*a] = std::max(imageExtent[2*a], static_cast<int>(std::floor(std::max(imageLower[a], -1e9))));
+      supportExtent[2*a+1] = std::min(imageExtent[2*a+1], static_cast<int>(std::ceil(std::min(imageUpper[a], 1e9))));
+    }
   }
 
-}
+  void Sample(const double point[3], double displacement[3]) const
+  {
+    double index[3];
+    int size[3];
+    for (int a = 0; a < 3; a++)
+    {
+      size[a] = this->Extent[2*a+1] - this->Extent[2*a] + 1;
+      index[a] = this->RASToIJK->Element[a][3] - this->Extent[2*a];
+      for (int c = 0; c < 3; c++)
+      {
+        index[a] += this->RASToIJK->Element[a][c] * point[c];
+      }
+      index[a] = std::min(std::max(index[a], 0.0), static_cast<double>(size[a] - 1));
+    }
+    if (this->ScalarType == VTK_FLOAT)
+    {
+      this->SampleTyped(static_cast<const float*>(this->Scalars), index, size, displacement);
+    }
+    else
+    {
+      this->SampleTyped(static_cast<const double*>(this->Scalars), index, size, displacement);
+    }
+    for (int a = 0; a < 3; a++)
+    {
+      displacement[a] = displacement[a] * this->Scale + this->Shift;
+    }
+  }
 
-} // end of anonymous namespace
+private:
+  template<class T>
+  static bool IsNonZero(const T* value)
+  {
+    return value[0] != 0 || value[1] != 0 || value[2] != 0;
+  }
 
-int main( int argc, char * argv[] )
+  template<class T>
+  void SampleTyped(const T* scalars, const double index[3], const int size[3], double displacement[3]) const
+  {
+    // indices and weights of the voxels contributing along each axis
+    const int maxTaps = 4;
+    int taps = 1;
+    vtkIdType voxel[3][maxTaps];
+    double weight[3][maxTaps];
+    for (int a = 0; a < 3; a++)
+    {
+      int i = static_cast<int>(std::floor(index[a]));
+      double f = index[a] - i;
+      if (this->InterpolationMode == VTK_CUBIC_INTERPOLATION)
+      {
+        taps = 4;
+        weight[a][0] = ((-0.5 * f + 1.0) * f - 0.5) * f;
+        weight[a][1] = (1.5 * f - 2.5) * f * f + 1.0;
+        weight[a][2] = ((-1.5 * f + 2.0) * f + 0.5) * f;
+        weight[a][3] = (0.5 * f - 0.5) * f * f;
+        for (int t = 0; t < 4; t++)
+        {
+          voxel[a][t] = std::min(std::max(i - 1 + t, 0), size[a] - 1);
+        }
+      }
+      else if (this->InterpolationMode == VTK_LINEAR_INTERPOLATION)
+      {
+        taps = 2;
+        weight[a][0] = 1.0 - f;
+        weight[a][1] = f;
+        voxel[a][0] = i;
+        voxel[a][1] = std::min(i + 1, size[a] - 1);
+      }
+      else // nearest
+      {
+        taps = 1;
+        weight[a][0] = 1.0;
+        voxel[a][0] = static_cast<int>(std::floor(index[a] + 0.5));
+      }
+    }
+
+    displacement[0] = displacement[1] = displacement[2] = 0;
+    for (int tk = 0; tk < taps; tk++)
+    {
+      for (int tj = 0; tj < taps; tj++)
+      {
+        double wjk = weight[1][tj] * weight[2][tk];
+        const T* row = scalars + 3 * (voxel[1][tj] + voxel[2][tk] * size[1]) * size[0];
+        for (int ti = 0; ti < taps; ti++)
+        {
+          double w = weight[0][ti] * wjk;
+          const T* value = row + 3 * voxel[0][ti];
+          displacement[0] += w * value[0];
+          displacement[1] += w * value[1];
+          displacement[2] += w * value[2];
+        }
+      }
+    }
+  }
+
+  const void* Scalars = nullptr;
+  int ScalarType = VTK_FLOAT;
+  int Extent[6];
+  double Scale = 1.0;
+  double Shift = 0.0;
+  int InterpolationMode = VTK_LINEAR_INTERPOLATION;
+  vtkNew<vtkMatrix4x4> IJKToRAS;
+  vtkNew<vtkMatrix4x4> RASToIJK;
+};
+
+// Composes two displacement grids over the voxels of an image. A point is first
+// displaced by grid 2 and then by grid 1, as the hardened transform chain would.
+// Grid 2 is only sampled inside its support, elsewhere the output is grid 1, copied
+// if it has the geometry of the output.
+class GridCompositionFunctor
 {
-  PARSE_ARGS;
+public:
+  GridCompositionFunctor(vtkImageData* vectorImage, const DisplacementGridSampler& grid1, const DisplacementGridSampler& grid2, vtkMatrix4x4* ijkToRAS,
+    const int supportExtent[6], bool copyGrid1, SliceProgressReporter& progress)
+    : VectorImage(vectorImage), Grid1(grid1), Grid2(grid2), CopyGrid1(copyGrid1), Progress(progress)
+  {
+    this->IJKToRAS->DeepCopy(ijkToRAS);
+    std::copy(supportExtent, supportExtent + 6, this->SupportExtent);
+  }
 
-  // INPUT TRANSFORM 1
+  void operator()(vtkIdType beginSlice, vtkIdType endSlice)
+  {
+    double point_RAS[4] = { 0, 0, 0, 1 };
+    double point_IJK[4] = { 0, 0, 0, 1 };
+    double displaced_RAS[3];
+    double displacement1[3], displacement2[3];
+    int* extent = this->VectorImage->GetExtent();
+    int* dim = this->VectorImage->GetDimensions();
+    float* scalars = static_cast<float*>(this->VectorImage->GetScalarPointer());
+    for (vtkIdType k = beginSlice; k < endSlice; k++)
+    {
+      point_IJK[2] = k;
+      float* voxelPtr = scalars + 3 * static_cast<vtkIdType>(k - extent[4]) * dim[0] * dim[1];
+      for (point_IJK[1] = extent[2]; point_IJK[1] <= extent[3]; point_IJK[1]++)
+      {
+        for (point_IJK[0] = extent[0]; point_IJK[0] <= extent[1]; point_IJK[0]++)
+        {
+          if (!this->InSupport(point_IJK))
+          {
+            // no correction
+            displacement2[0] = displacement2[1] = displacement2[2] = 0;
+            if (this->CopyGrid1)
+            {
+              this->Grid1.GetVoxel(point_IJK[0], point_IJK[1], point_IJK[2], displacement1);
+            }
+            else
+            {
+              this->IJKToRAS->MultiplyPoint(point_IJK, point_RAS);
+              this->Grid1.Sample(point_RAS, displacement1);
+            }
+          }
+          else
+          {
+            this->IJKToRAS->MultiplyPoint(point_IJK, point_RAS);
 
-  bool transform1FromNode = inputTransform1Node.compare("None") != 0;
-  bool transform1FromFile = !inputTransform1File.empty();
+            this->Grid2.Sample(point_RAS, displacement2);
+            for (int a = 0; a < 3; a++)
+            {
+              displaced_RAS[a] = point_RAS[a] + displacement2[a];
+            }
+            this->Grid1.Sample(displaced_RAS, displacement1);
+          }
 
-  if ((transform1FromNode && transform1FromFile) || (!transform1FromNode && !transform1FromFile))
+          *(voxelPtr++) = static_cast<float>(displacement2[0] + displacement1[0]);
+          *(voxelPtr++) = static_cast<float>(displacement2[1] + displacement1[1]);
+          *(voxelPtr++) = static_cast<float>(displacement2[2] + displacement1[2]);
+        }
+      }
+      this->Progress.SliceCompleted();
+    }
+  }
+
+private:
+  bool InSupport(const double point_IJK[3]) const
   {
-    std::cerr << "Specify either a MRML transform node or a transform file name for input transform 1." << std::endl;
-    return EXIT_FAILURE;
+    for (int a = 0; a < 3; a++)
+    {
+      if (point_IJK[a] < this->SupportExtent[2*a] || point_IJK[a] > this->SupportExtent[2*a+1])
+      {
+        return false;
+      }
+    }
+    return true;
   }
 
-  vtkNew<vtkMRMLTransformNode> transform1Node;
-  vtkNew<vtkMRMLTransformStorageNode> storageNode1;
-  storageNode1->SetFileName(transform1FromNode ? inputTransform1Node.c_str() : inputTransform1File.c_str());
-  if (!storageNode1->ReadData(transform1Node))
+  vtkImageData* VectorImage;
+  const DisplacementGridSampler& Grid1;
+  const DisplacementGridSampler& Grid2;
+  vtkNew<vtkMatrix4x4> IJKToRAS;
+  int SupportExtent[6];
+  bool CopyGrid1;
+  SliceProgressReporter& Progress;
+};
+
+void GetComposedGridsAsVectorImage(vtkImageData* vectorImage, const DisplacementGridSampler& grid1, const DisplacementGridSampler& grid2, vtkMatrix4x4* ijkToRAS,
+  const int supportExtent[6], bool copyGrid1, SliceProgressReporter& progress)
+{
+  vectorImage->AllocateScalars(VTK_FLOAT, 3);
+
+  int* extent = vectorImage->GetExtent();
+  GridCompositionFunctor functor(vectorImage, grid1, grid2, ijkToRAS, supportExtent, copyGrid1, progress);
+  vtkSMPTools::For(extent[4], extent[5] + 1, functor);
+}
+
+// Case insensitive check of the end of a file name, e.g. ".gz"
+bool HasExtension(const std::string& fileName, const std::string& extension)
+{
+  if (fileName.size() < extension.size())
   {
-    std::cerr << "Failed to read input transform 1 from file " << std::endl;
-    return EXIT_FAILURE;
+    return false;
   }
+  std::string end = fileName.substr(fileName.size() - extension.size());
+  std::transform(end.begin(), end.end(), end.begin(), ::tolower);
+  return end == extension;
+}
 
-  // INPUT TRANSFORM 2
+// Compresses blocks of data, each as a complete gzip member, in parallel.
+class GzipBlocksFunctor
+{
+public:
+  GzipBlocksFunctor(const std::vector<std::vector<char> >& blocks, std::vector<std::vector<char> >& compressedBlocks, int level)
+    : Blocks(blocks), CompressedBlocks(compressedBlocks), Level(level), Failed(false)
+  {
+  }
 
-  bool transform2FromNode = inputTransform2Node.compare("None") != 0;
-  bool transform2FromFile = !inputTransform2File.empty();
+  void operator()(vtkIdType beginBlock, vtkIdType endBlock)
+  {
+    for (vtkIdType b = beginBlock; b < endBlock; b++)
+    {
+      z_stream stream;
+      stream.zalloc = Z_NULL;
+      stream.zfree = Z_NULL;
+      stream.opaque = Z_NULL;
+      // 16 added to the window bits selects the gzip wrapper
+      if (deflateInit2(&stream, this->Level, Z_DEFLATED, 15 + 16, 8, Z_DEFAULT_STRATEGY) != Z_OK)
+      {
+        this->Failed = true;
+        return;
+      }
+      const std::vector<char>& block = this->Blocks[b];
+      std::vector<char>& compressedBlock = this->CompressedBlocks[b];
+      compressedBlock.resize(deflateBound(&stream, static_cast<uLong>(block.size())));
+      stream.next_in = reinterpret_cast<Bytef*>(const_cast<char*>(block.data()));
+      stream.avail_in = static_cast<uInt>(block.size());
+      stream.next_out = reinterpret_cast<Bytef*>(compressedBlock.data());
+      stream.avail_out = static_cast<uInt>(compressedBlock.size());
+      if (deflate(&stream, Z_FINISH) != Z_STREAM_END)
+      {
+        this->Failed = true;
+      }
+      compressedBlock.resize(stream.total_out);
+      deflateEnd(&stream);
+    }
+  }
 
-  if ((transform2FromNode && transform2FromFile) || (!transform2FromNode && !transform2FromFile))
+  bool HasFailed() const
   {
-    std::cerr << "Specify either a MRML transform node or a transform file name for input transform 2." << std::endl;
-    return EXIT_FAILURE;
+    return this->Failed;
   }
 
-  vtkNew<vtkMRMLTransformNode> transform2Node;
-  vtkNew<vtkMRMLTransformStorageNode> storageNode2;
-  storageNode2->SetFileName(transform2FromNode ? inputTransform2Node.c_str() : inputTransform2File.c_str());
-  if (!storageNode2->ReadData(transform2Node))
+private:
+  const std::vector<std::vector<char> >& Blocks;
+  std::vector<std::vector<char> >& CompressedBlocks;
+  int Level;
+  std::atomic<bool> Failed;
+};
+
+// Compresses a file as a sequence of gzip members, each holding one block of the input,
+// so that the blocks can be compressed on all threads. Concatenated members form a valid
+// gzip file (RFC 1952) that decompresses to the whole input, as with pigz or bgzip, and
+// is read by zlib based NIfTI readers. Only a batch of blocks is held in memory at a time,
+// at most 64 MB of input whatever the number of threads.
+bool GzipFile(const std::string& inputFile, const std::string& outputFile, int level)
+{
+  const size_t blockSize = 4 << 20;
+  const size_t maxBlocksPerBatch = 16;
+  const size_t blocksPerBatch = std::min(maxBlocksPerBatch, 2 * static_cast<size_t>(std::max(1, vtkSMPTools::GetEstimatedNumberOfThreads())));
+
+  std::ifstream input(inputFile.c_str(), std::ios::in | std::ios::binary);
+  std::ofstream output(outputFile.c_str(), std::ios::out | std::ios::binary | std::ios::trunc);
+  if (!input || !output)
   {
-    std::cerr << "Failed to read input transform 2 from file " << std::endl;
-    return EXIT_FAILURE;
+    return false;
   }
 
-  // REFERENCE VOLUME
+  std::vector<std::vector<char> > blocks(blocksPerBatch, std::vector<char>(blockSize));
+  std::vector<std::vector<char> > compressedBlocks(blocksPerBatch);
+  bool endOfFile = false;
+  bool empty = true;
+  while (!endOfFile)
+  {
+    size_t numberOfBlocks = 0;
+    while (numberOfBlocks < blocksPerBatch && !endOfFile)
+    {
+      std::vector<char>& block = blocks[numberOfBlocks];
+      block.resize(blockSize);
+      input.read(block.data(), blockSize);
+      block.resize(static_cast<size_t>(input.gcount()));
+      endOfFile = !input;
+      // an empty input still needs one (empty) member
+      if (!block.empty() || empty)
+      {
+        numberOfBlocks++;
+        empty = false;
+      }
+    }
 
-  bool referenceVolumeFromNode = inputReferenceVolumeNode.compare("None") != 0;
-  bool referenceVolumeFromFile = !inputReferenceVolumeFile.empty();
+    GzipBlocksFunctor functor(blocks, compressedBlocks, level);
+    vtkSMPTools::For(0, static_cast<vtkIdType>(numberOfBlocks), 1, functor);
+    if (functor.HasFailed())
+    {
+      return false;
+    }
+    for (size_t b = 0; b < numberOfBlocks; b++)
+    {
+      output.write(compressedBlocks[b].data(), compressedBlocks[b].size());
+    }
+  }
 
-  if ((referenceVolumeFromNode && referenceVolumeFromFile) || (!referenceVolumeFromNode && !referenceVolumeFromFile))
+  output.close();
+  return !input.bad() && !output.fail();
+}
+
+// Name of the uncompressed file written before compressing to a .gz file name,
+// e.g. warp-uncompressed.nii for warp.nii.gz
+std::string UncompressedFileName(const std::string& gzipFileName)
+{
+  std::string fileName = gzipFileName.substr(0, gzipFileName.size() - 3);
+  size_t extensionStart = fileName.find_last_of('.');
+  size_t nameStart = fileName.find_last_of("/\\");
+  if (extensionStart == std::string::npos || (nameStart != std::string::npos && extensionStart < nameStart))
   {
-    std::cerr << "Specify either a MRML volume node or a volume file name for reference volume." << std::endl;
-    return EXIT_FAILURE;
+    extensionStart = fileName.size();
   }
+  return fileName.substr(0, extensionStart) + "-uncompressed" + fileName.substr(extensionStart);
+}
 
-  vtkNew<vtkMRMLScalarVolumeNode> referenceVolumeNode;
-  vtkNew<vtkMRMLVolumeArchetypeStorageNode> storageNode3;
-  storageNode3->SetFileName(referenceVolumeFromNode ? inputReferenceVolumeNode.c_str() : inputReferenceVolumeFile.c_str());
-  if (!storageNode3->ReadData(referenceVolumeNode))
+// Writes a displacement field as an uncompressed MetaImage (.mha) file, one slab of
+// slices at a time, so that the whole field never has to be in memory. As for the
+// files written by vtkMRMLTransformStorageNode, geometry and vectors are in LPS.
+class MetaImageSlabWriter
+{
+public:
+  ~MetaImageSlabWriter()
   {
-    std::cerr << "Failed to read reference volume from file " << std::endl;
-    return EXIT_FAILURE;
+    this->Close();
   }
 
-  // OUTPUT
+  static bool IsMetaImageFileName(const std::string& fileName)
+  {
+    return HasExtension(fileName, ".mha");
+  }
 
-  bool saveToNode = outputDisplacementField.compare("None") != 0;
-  bool saveToFile = !outputFileName.empty();
+  bool Open(const std::string& fileName, const int extent[6], vtkMatrix4x4* ijkToRAS)
+  {
+    this->File.open(fileName.c_str(), std::ios::out | std::ios::binary | std::ios::trunc);
+    if (!this->File)
+    {
+      return false;
+    }
 
-  if ((saveToNode && saveToFile) || (!saveToNode && !saveToFile))
+    double origin_IJK[4] = { static_cast<double>(extent[0]), static_cast<double>(extent[2]), static_cast<double>(extent[4]), 1 };
+    double origin_RAS[4];
+    ijkToRAS->MultiplyPoint(origin_IJK, origin_RAS);
+    double spacing[3];
+    double direction_LPS[3][3]; // columns
+    for (int c = 0; c < 3; c++)
+    {
+      spacing[c] = std::sqrt(ijkToRAS->Element[0][c] * ijkToRAS->Element[0][c]
+        + ijkToRAS->Element[1][c] * ijkToRAS->Element[1][c]
+        + ijkToRAS->Element[2][c] * ijkToRAS->Element[2][c]);
+      for (int r = 0; r < 3; r++)
+      {
+        direction_LPS[c][r] = (r < 2 ? -1 : 1) * ijkToRAS->Element[r][c] / (spacing[c] != 0 ? spacing[c] : 1.0);
+      }
+    }
+
+    unsigned short one = 1;
+    bool bigEndian = reinterpret_cast<unsigned char*>(&one)[0] == 0;
+    this->File << std::setprecision(17);
+    this->File << "ObjectType = Image\n";
+    this->File << "NDims = 3\n";
+    this->File << "BinaryData = True\n";
+    this->File << "BinaryDataByteOrderMSB = " << (bigEndian ? "True" : "False") << "\n";
+    this->File << "CompressedData = False\n";
+    this->File << "TransformMatrix =";
+    for (int c = 0; c < 3; c++)
+    {
+      for (int r = 0; r < 3; r++)
+      {
+        this->File << " " << direction_LPS[c][r];
+      }
+    }
+    this->File << "\n";
+    this->File << "Offset = " << -origin_RAS[0] << " " << -origin_RAS[1] << " " << origin_RAS[2] << "\n";
+    this->File << "ElementSpacing = " << spacing[0] << " " << spacing[1] << " " << spacing[2] << "\n";
+    this->File << "DimSize = " << extent[1] - extent[0] + 1 << " " << extent[3] - extent[2] + 1 << " " << extent[5] - extent[4] + 1 << "\n";
+    this->File << "ElementNumberOfChannels = 3\n";
+    this->File << "ElementType = MET_FLOAT\n";
+    this->File << "ElementDataFile = LOCAL\n";
+    return static_cast<bool>(this->File);
+  }
+
+  // Appends the slices of a float RAS displacement image, which is converted to LPS in place.
+  bool WriteSlab(vtkImageData* slab)
   {
-    std::cerr << "Specify either a MRML output node or an output file name" << std::endl;
-    return EXIT_FAILURE;
+    float* scalars = static_cast<float*>(slab->GetScalarPointer());
+    vtkIdType numberOfVoxels = slab->GetNumberOfPoints();
+    for (vtkIdType voxel = 0; voxel < numberOfVoxels; voxel++, scalars += 3)
+    {
+      scalars[0] = -scalars[0];
+      scalars[1] = -scalars[1];
+    }
+    this->File.write(static_cast<const char*>(slab->GetScalarPointer()), 3 * numberOfVoxels * sizeof(float));
+    return static_cast<bool>(this->File);
   }
 
-  std::cout << "<filter-comment>" << "Set up" << "</filter-comment>" << std::endl << std::flush;
+  bool Close()
+  {
+    if (!this->File.is_open())
+    {
+      return true;
+    }
+    this->File.close();
+    return !this->File.fail();
+  }
+
+private:
+  std::ofstream File;
+};
+
+// Samples the composition of transform 1 and transform 2 over the grid of the
+// reference volume and writes it as a grid transform. Transform 1 might be
+// modified, as it is hardened with transform 2 in the generic path.
+// If slabSize is positive, the output is computed and written to a MetaImage
+// file slabSize slices at a time instead of being held in memory as a whole.
+// A non negative compressionLevel sets the zlib level of .gz outputs, compressed
+// in parallel blocks; 0 disables the compression of other outputs.
+int CompositeToGridFile(vtkMRMLTransformNode* transform1Node, vtkMRMLTransformNode* transform2Node,
+  vtkMRMLScalarVolumeNode* referenceVolumeNode, const std::string& compositionMode, int slabSize, int compressionLevel,
+  const std::string& outputFile)
+{
+  if (slabSize > 0 && !MetaImageSlabWriter::IsMetaImageFileName(outputFile))
+  {
+    std::cerr << "Output written by slabs must be a MetaImage (.mha) file." << std::endl;
+    return EXIT_FAILURE;
+  }
 
   // Create a grid transform
   vtkSmartPointer<vtkMRMLTransformNode> outputGridTransformNode;
@@ -210,21 +827,256 @@ int main( int argc, char * argv[] )
 
   // RUN
 
-  vtkNew<vtkGeneralTransform> hardeningTransform;
-  transform2Node->GetTransformToWorld(hardeningTransform.GetPointer());
-  transform1Node->ApplyTransform(hardeningTransform.GetPointer());
+  // Both inputs are displacement grids: interpolate them directly
+  DisplacementGridSampler grid1, grid2;
+  bool composeGrids = compositionMode == "auto" &&
+    grid1.SetTransform(transform1Node->GetTransformFromParent()) &&
+    grid2.SetTransform(transform2Node->GetTransformFromParent());
+
+  int extent[6];
+  outputVolume->GetExtent(extent);
+  int supportExtent[6];
+  bool copyGrid1 = false;
+  vtkNew<vtkGeneralTransform> inputTransform;
+  if (composeGrids)
+  {
+    vtkNew<vtkMatrix4x4> rasToIJK;
+    vtkMatrix4x4::Invert(ijkToRas.GetPointer(), rasToIJK.GetPointer());
+    grid2.GetSupportExtent(extent, rasToIJK.GetPointer(), supportExtent);
+    copyGrid1 = grid1.HasGeometry(extent, ijkToRas.GetPointer());
+    std::cout << "Transform 2 support: [" << supportExtent[0] << ", " << supportExtent[1] << "] x [" << supportExtent[2] << ", " << supportExtent[3]
+              << "] x [" << supportExtent[4] << ", " << supportExtent[5] << "]" << std::endl;
+  }
+  else
+  {
+    vtkNew<vtkGeneralTransform> hardeningTransform;
+    transform2Node->GetTransformToWorld(hardeningTransform.GetPointer());
+    transform1Node->ApplyTransform(hardeningTransform.GetPointer());
+    transform1Node->GetTransformFromWorld(inputTransform.GetPointer());
+  }
+
+  MetaImageSlabWriter slabWriter;
+  if (slabSize > 0 && !slabWriter.Open(outputFile, extent, ijkToRas.GetPointer()))
+  {
+    std::cerr << "Failed to open output file " << outputFile << std::endl;
+    return EXIT_FAILURE;
+  }
 
   std::cout << "<filter-comment>" << "Computing" << "</filter-comment>" << std::endl << std::flush;
-  GetTransformedPointSamplesAsVectorImage(outputVolume, transform1Node, ijkToRas.GetPointer());
+  SliceProgressReporter progress(extent[5] - extent[4] + 1);
+  int slices = slabSize > 0 ? slabSize : extent[5] - extent[4] + 1;
+  vtkNew<vtkImageData> slab;
+  for (int firstSlice = extent[4]; firstSlice <= extent[5]; firstSlice += slices)
+  {
+    vtkImageData* target = outputVolume;
+    if (slabSize > 0)
+    {
+      target = slab.GetPointer();
+      target->SetExtent(extent[0], extent[1], extent[2], extent[3], firstSlice, std::min(firstSlice + slices - 1, extent[5]));
+    }
+
+    if (composeGrids)
+    {
+      GetComposedGridsAsVectorImage(target, grid1, grid2, ijkToRas.GetPointer(), supportExtent, copyGrid1, progress);
+    }
+    else
+    {
+      GetTransformedPointSamplesAsVectorImage(target, inputTransform.GetPointer(), ijkToRas.GetPointer(), progress);
+    }
+
+    if (slabSize > 0 && !slabWriter.WriteSlab(target))
+    {
+      std::cerr << "Failed to write output transform" << std::endl;
+      return EXIT_FAILURE;
+    }
+  }
+
+  if (slabSize > 0)
+  {
+    if (!slabWriter.Close())
+    {
+      std::cerr << "Failed to write output transform" << std::endl;
+      return EXIT_FAILURE;
+    }
+    return EXIT_SUCCESS;
+  }
 
   std::cout << "<filter-comment>" << "Writing" << "</filter-comment>" << std::endl << std::flush;
+  bool gzipOutput = compressionLevel >= 0 && HasExtension(outputFile, ".gz");
+  std::string writtenFile = gzipOutput ? UncompressedFileName(outputFile) : outputFile;
   vtkNew<vtkMRMLTransformStorageNode> storageNode;
-  storageNode->SetFileName(saveToNode ? outputDisplacementField.c_str() : outputFileName.c_str());
+  storageNode->SetFileName(writtenFile.c_str());
+  if (gzipOutput || compressionLevel == 0)
+  {
+    storageNode->SetUseCompression(0);
+  }
   if (!storageNode->WriteData(outputGridTransformNode))
   {
     std::cerr << "Failed to write output transform" << std::endl;
     return EXIT_FAILURE;
   }
 
+  if (gzipOutput)
+  {
+    std::cout << "<filter-comment>" << "Compressing" << "</filter-comment>" << std::endl << std::flush;
+    bool compressed = GzipFile(writtenFile, outputFile, compressionLevel);
+    std::remove(writtenFile.c_str());
+    if (!compressed)
+    {
+      std::cerr << "Failed to compress output transform" << std::endl;
+      return EXIT_FAILURE;
+    }
+  }
+
+  return EXIT_SUCCESS;
+}
+
+} // end of anonymous namespace
+
+int main( int argc, char * argv[] )
+{
+  PARSE_ARGS;
+
+  // INPUT TRANSFORM 1
+
+  bool transform1FromNode = inputTransform1Node.compare("None") != 0;
+  bool transform1FromFile = !inputTransform1File.empty();
+
+  if ((transform1FromNode && transform1FromFile) || (!transform1FromNode && !transform1FromFile))
+  {
+    std::cerr << "Specify either a MRML transform node or a transform file name for input transform 1." << std::endl;
+    return EXIT_FAILURE;
+  }
+
+  vtkNew<vtkMRMLTransformNode> transform1Node;
+  vtkNew<vtkMRMLTransformStorageNode> storageNode1;
+  storageNode1->SetFileName(transform1FromNode ? inputTransform1Node.c_str() : inputTransform1File.c_str());
+  if (!storageNode1->ReadData(transform1Node))
+  {
+    std::cerr << "Failed to read input transform 1 from file " << std::endl;
+    return EXIT_FAILURE;
+  }
+
+  // INPUT TRANSFORM 2
+
+  bool transform2FromNode = inputTransform2Node.compare("None") != 0;
+  bool transform2FromFile = !inputTransform2File.empty();
+
+  if ((transform2FromNode && transform2FromFile) || (!transform2FromNode && !transform2FromFile))
+  {
+    std::cerr << "Specify either a MRML transform node or a transform file name for input transform 2." << std::endl;
+    return EXIT_FAILURE;
+  }
+
+  vtkNew<vtkMRMLTransformNode> transform2Node;
+  vtkNew<vtkMRMLTransformStorageNode> storageNode2;
+  storageNode2->SetFileName(transform2FromNode ? inputTransform2Node.c_str() : inputTransform2File.c_str());
+  if (!storageNode2->ReadData(transform2Node))
+  {
+    std::cerr << "Failed to read input transform 2 from file " << std::endl;
+    return EXIT_FAILURE;
+  }
+
+  // REFERENCE VOLUME
+
+  bool referenceVolumeFromNode = inputReferenceVolumeNode.compare("None") != 0;
+  bool referenceVolumeFromFile = !inputReferenceVolumeFile.empty();
+
+  if ((referenceVolumeFromNode && referenceVolumeFromFile) || (!referenceVolumeFromNode && !referenceVolumeFromFile))
+  {
+    std::cerr << "Specify either a MRML volume node or a volume file name for reference volume." << std::endl;
+    return EXIT_FAILURE;
+  }
+
+  vtkNew<vtkMRMLScalarVolumeNode> referenceVolumeNode;
+  vtkNew<vtkMRMLVolumeArchetypeStorageNode> storageNode3;
+  storageNode3->SetFileName(referenceVolumeFromNode ? inputReferenceVolumeNode.c_str() : inputReferenceVolumeFile.c_str());
+  if (!storageNode3->ReadData(referenceVolumeNode))
+  {
+    std::cerr << "Failed to read reference volume from file " << std::endl;
+    return EXIT_FAILURE;
+  }
+
+  // OUTPUT
+
+  bool saveToNode = outputDisplacementField.compare("None") != 0;
+  bool saveToFile = !outputFileName.empty();
+
+  if ((saveToNode && saveToFile) || (!saveToNode && !saveToFile))
+  {
+    std::cerr << "Specify either a MRML output node or an output file name" << std::endl;
+    return EXIT_FAILURE;
+  }
+
+  // RUN
+
+  if (numberOfThreads < 0)
+  {
+    std::cerr << "The number of threads must be zero (use all cores) or positive." << std::endl;
+    return EXIT_FAILURE;
+  }
+  if (numberOfThreads > 0)
+  {
+    vtkSMPTools::Initialize(numberOfThreads);
+  }
+
+  std::cout << "<filter-comment>" << "Set up" << "</filter-comment>" << std::endl << std::flush;
+
+  if (slabSize < 0)
+  {
+    std::cerr << "The slab size must be zero (no slabs) or positive." << std::endl;
+    return EXIT_FAILURE;
+  }
+
+  if (compressionLevel < -1 || compressionLevel > 9)
+  {
+    std::cerr << "The compression level must be between 0 and 9, or -1 for the default of the file writer." << std::endl;
+    return EXIT_FAILURE;
+  }
+
+  if (CompositeToGridFile(transform1Node, transform2Node, referenceVolumeNode, compositionMode, slabSize, compressionLevel,
+    saveToNode ? outputDisplacementField : outputFileName) != EXIT_SUCCESS)
+  {
+    return EXIT_FAILURE;
+  }
+
+  // INVERSE
+
+  // The inverse composition reuses transform 2, inverted, as its first transform
+  if (!outputInverseFileName.empty())
+  {
+    if (inverseTransformFile.empty() || inverseReferenceVolumeFile.empty())
+    {
+      std::cerr << "The inverse output requires an inverse transform file and an inverse reference volume file." << std::endl;
+      return EXIT_FAILURE;
+    }
+
+    vtkNew<vtkMRMLTransformNode> inverseTransformNode;
+    vtkNew<vtkMRMLTransformStorageNode> inverseTransformStorageNode;
+    inverseTransformStorageNode->SetFileName(inverseTransformFile.c_str());
+    if (!inverseTransformStorageNode->ReadData(inverseTransformNode))
+    {
+      std::cerr << "Failed to read inverse transform from file " << std::endl;
+      return EXIT_FAILURE;
+    }
+
+    vtkNew<vtkMRMLScalarVolumeNode> inverseReferenceVolumeNode;
+    vtkNew<vtkMRMLVolumeArchetypeStorageNode> inverseReferenceStorageNode;
+    inverseReferenceStorageNode->SetFileName(inverseReferenceVolumeFile.c_str());
+    if (!inverseReferenceStorageNode->ReadData(inverseReferenceVolumeNode))
+    {
+      std::cerr << "Failed to read inverse reference volume from file " << std::endl;
+      return EXIT_FAILURE;
+    }
+
+    std::cout << "<filter-comment>" << "Inverse" << "</filter-comment>" << std::endl << std::flush;
+    transform2Node->Inverse();
+    if (CompositeToGridFile(transform2Node, inverseTransformNode, inverseReferenceVolumeNode, compositionMode, slabSize, compressionLevel,
+      outputInverseFileName) != EXIT_SUCCESS)
+    {
+      return EXIT_FAILURE;
+    }
+  }
+
   return EXIT_SUCCESS;
 }
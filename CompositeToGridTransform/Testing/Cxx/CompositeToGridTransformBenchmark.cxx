@@ -0,0 +1,209 @@
+// Benchmark of CompositeToGridTransform composing a dense warp with a local correction.
+// Usage: CompositeToGridTransformBenchmark <temporary directory> <grid size> locality <correction half width> [benchmark options]
+//        CompositeToGridTransformBenchmark <temporary directory> <grid size> compression <compression level> [benchmark options]
+// In locality mode the correction is non zero in a cube of the given half width (in voxels)
+// around the grid center, so the run time should grow with the correction support, not the grid size.
+// In compression mode the output is written as NIfTI with the given compression level, where
+// "none" writes an uncompressed .nii file and -1 uses the default of the file writer.
+// With --compareTolerance, the output is compared to the one of the generic composition.
+// See NetstimBenchmarkHelpers.h for the other options.
+
+#include "NetstimBenchmarkHelpers.h"
+
+// MRML includes
+#include <vtkMRMLScalarVolumeNode.h>
+#include <vtkMRMLTransformNode.h>
+#include <vtkMRMLTransformStorageNode.h>
+#include <vtkMRMLVolumeArchetypeStorageNode.h>
+
+// VTK includes
+#include <vtkImageData.h>
+#include <vtkNew.h>
+#include <vtkOrientedGridTransform.h>
+
+// ITK includes
+#include <itkTimeProbe.h>
+
+// STD includes
+#include <cmath>
+#include <cstdlib>
+#include <fstream>
+#include <iostream>
+#include <string>
+#include <vector>
+
+#ifdef WIN32
+# define MODULE_IMPORT __declspec(dllimport)
+#else
+# define MODULE_IMPORT
+#endif
+
+extern "C" MODULE_IMPORT int ModuleEntryPoint(int, char* []);
+
+namespace
+{
+  int RunModule(std::vector<std::string> & args)
+  {
+    std::vector<char*> argv;
+    argv.push_back(const_cast<char*>("CompositeToGridTransform"));
+    for (std::string & arg : args)
+    {
+      argv.push_back(&arg[0]);
+    }
+    return ModuleEntryPoint(static_cast<int>(argv.size()), argv.data());
+  }
+
+  void InitializeImage(vtkImageData* image, int gridSize, int numberOfComponents)
+  {
+    image->SetDimensions(gridSize, gridSize, gridSize);
+    image->SetSpacing(2, 2, 2);
+    image->SetOrigin(-gridSize, -gridSize, -gridSize);
+    image->AllocateScalars(VTK_DOUBLE, numberOfComponents);
+  }
+
+  // Smooth displacement over the whole grid if halfWidth is negative,
+  // otherwise a bump that is zero outside the central cube of the given half width.
+  bool WriteGrid(const std::string & fileName, int gridSize, int halfWidth)
+  {
+    vtkNew<vtkImageData> displacements;
+    InitializeImage(displacements.GetPointer(), gridSize, 3);
+    double* values = static_cast<double*>(displacements->GetScalarPointer());
+    int center = gridSize / 2;
+    for (int k = 0; k < gridSize; k++)
+    {
+      for (int j = 0; j < gridSize; j++)
+      {
+        for (int i = 0; i < gridSize; i++, values += 3)
+        {
+          if (halfWidth < 0)
+          {
+            values[0] = 3 * std::sin(0.05 * j);
+            values[1] = 3 * std::sin(0.05 * k);
+            values[2] = 3 * std::sin(0.05 * i);
+            continue;
+          }
+          int index[3] = { i - center, j - center, k - center };
+          double weight = 1;
+          for (int a = 0; a < 3; a++)
+          {
+            double x = static_cast<double>(index[a]) / (halfWidth + 1);
+            weight *= std::abs(x) < 1 ? (1 - x * x) * (1 - x * x) : 0;
+          }
+          values[0] = values[1] = values[2] = 2 * weight;
+        }
+      }
+    }
+
+    vtkNew<vtkOrientedGridTransform> gridTransform;
+    gridTransform->SetDisplacementGridData(displacements.GetPointer());
+    gridTransform->SetInterpolationModeToCubic();
+    vtkNew<vtkMRMLTransformNode> transformNode;
+    transformNode->SetAndObserveTransformFromParent(gridTransform.GetPointer());
+
+    vtkNew<vtkMRMLTransformStorageNode> storageNode;
+    storageNode->SetFileName(fileName.c_str());
+    return storageNode->WriteData(transformNode.GetPointer()) != 0;
+  }
+
+  bool WriteReferenceVolume(const std::string & fileName, int gridSize)
+  {
+    vtkNew<vtkImageData> image;
+    InitializeImage(image.GetPointer(), gridSize, 1);
+    image->SetOrigin(0, 0, 0);
+    image->SetSpacing(1, 1, 1);
+    vtkNew<vtkMRMLScalarVolumeNode> volumeNode;
+    volumeNode->SetAndObserveImageData(image.GetPointer());
+    volumeNode->SetOrigin(-gridSize, -gridSize, -gridSize);
+    volumeNode->SetSpacing(2, 2, 2);
+
+    vtkNew<vtkMRMLVolumeArchetypeStorageNode> storageNode;
+    storageNode->SetFileName(fileName.c_str());
+    return storageNode->WriteData(volumeNode.GetPointer()) != 0;
+  }
+
+  long long GetFileSize(const std::string & fileName)
+  {
+    std::ifstream file(fileName.c_str(), std::ios::in | std::ios::binary | std::ios::ate);
+    return file ? static_cast<long long>(file.tellg()) : -1;
+  }
+
+} // end of anonymous namespace
+
+int main( int argc, char * argv[] )
+{
+  NetstimBenchmark::Options options;
+  if (!NetstimBenchmark::ParseOptions(argc, argv, options) || options.Arguments.size() != 4)
+  {
+    std::cerr << "Usage: " << argv[0] << " <temporary directory> <grid size> <locality|compression> <value> [benchmark options]" << std::endl;
+    return EXIT_FAILURE;
+  }
+
+  std::string temporaryDirectory = options.Arguments[0];
+  int gridSize = std::stoi(options.Arguments[1]);
+  std::string mode = options.Arguments[2];
+  std::string value = options.Arguments[3];
+  if (mode != "locality" && mode != "compression")
+  {
+    std::cerr << "Unknown benchmark mode " << mode << std::endl;
+    return EXIT_FAILURE;
+  }
+  std::string caseName = "grid " + std::to_string(gridSize) + " " + mode + " " + value;
+
+  std::string prefix = temporaryDirectory + "/CompositeToGridTransformBenchmark" + std::to_string(gridSize) + mode + value;
+  std::string warpFileName = prefix + "Warp.nrrd";
+  std::string referenceFileName = prefix + "Reference.nrrd";
+  int halfWidth = mode == "locality" ? std::stoi(value) : 5;
+  std::string correctionFileName = prefix + "Correction.nrrd";
+  if (!WriteGrid(warpFileName, gridSize, -1) || !WriteReferenceVolume(referenceFileName, gridSize) ||
+      !WriteGrid(correctionFileName, gridSize, halfWidth))
+  {
+    std::cerr << "Failed to write the benchmark inputs" << std::endl;
+    return EXIT_FAILURE;
+  }
+
+  std::vector<std::string> args = {
+    "--inputTransform1File", warpFileName,
+    "--inputTransform2File", correctionFileName,
+    "--inputReferenceVolumeFile", referenceFileName};
+  std::vector<std::string> genericArgs = args;
+
+  std::string outputFileName = prefix + "Output.nrrd";
+  if (mode == "compression")
+  {
+    outputFileName = prefix + "Output" + (value == "none" ? ".nii" : ".nii.gz");
+    if (value != "none")
+    {
+      args.insert(args.end(), {"--compressionLevel", value});
+    }
+  }
+  args.insert(args.end(), {"--outputFileName", outputFileName});
+
+  itk::TimeProbe probe;
+  probe.Start();
+  int status = RunModule(args);
+  probe.Stop();
+
+  if (status != EXIT_SUCCESS)
+  {
+    std::cerr << "Run with " << mode << " value " << value << " failed" << std::endl;
+    return EXIT_FAILURE;
+  }
+  NetstimBenchmark::Record(options, "CompositeToGridTransform", caseName, probe.GetTotal());
+  std::cout << "Output file size: " << GetFileSize(outputFileName) << " bytes" << std::endl;
+  if (!NetstimBenchmark::CheckTimeBaseline(options, "CompositeToGridTransform", caseName, probe.GetTotal()))
+  {
+    return EXIT_FAILURE;
+  }
+
+  if (options.CompareTolerance >= 0)
+  {
+    genericArgs.insert(genericArgs.end(), {"--compositionMode", "generic", "--outputFileName", prefix + "Generic.nrrd"});
+    if (RunModule(genericArgs) != EXIT_SUCCESS ||
+        !NetstimBenchmark::CheckOutput(options, outputFileName, prefix + "Generic.nrrd"))
+    {
+      return EXIT_FAILURE;
+    }
+  }
+
+  return EXIT_SUCCESS;
+}
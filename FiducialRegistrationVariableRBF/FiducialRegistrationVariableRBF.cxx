@@ -6,12 +6,15 @@
 
 // ITK includes
 #include <itkImage.h>
+#include <itkMultiThreaderBase.h>
+
+// STD includes
+#include <algorithm>
+#include <cmath>
 
 #include "SimpleITK.h"
 
-#ifndef M_PI
-  #define M_PI 3.14159265358979323846
-#endif
+#include "FiducialRegistrationVariableRBFCoefficients.h"
 
 namespace sitk = itk::simple;
 
@@ -32,145 +35,233 @@ namespace
     return p;
   }
 
-  static float RBFValue (itk::Point<double, 3> * rbf_center, itk::Point<double, 3> * loc, float radius)
+  // Index space bounding box of the support of each landmark kernel.
+  // The direction matrix is orthonormal, so a sphere of radius R around a landmark
+  // spans R / spacing[a] voxels along each index axis a.
+  struct LandmarkSupport
+  {
+    itk::int64_t lower[3];
+    itk::int64_t upper[3];
+    float squaredCutoff; // in squared mm. Negative means untruncated.
+  };
+
+  std::vector<LandmarkSupport> ComputeLandmarksSupport(
+    sitk::Image *vectorField,
+    std::vector< itk::Point<double, 3> > * fixedLandmarks,
+    float * adaptRadius,
+    float kernelTruncation)
+  {
+    unsigned int numLandmarks = fixedLandmarks->size();
+    std::vector<unsigned int> size = vectorField->GetSize();
+    std::vector<double> spacing = vectorField->GetSpacing();
+    std::vector<LandmarkSupport> support(numLandmarks);
+
+    for (unsigned int landmarkIndex=0; landmarkIndex < numLandmarks; landmarkIndex++) {
+      LandmarkSupport & s = support[landmarkIndex];
+      if (kernelTruncation <= 0){
+        for (unsigned int a=0; a<3; a++){
+          s.lower[a] = 0;
+          s.upper[a] = static_cast<itk::int64_t>(size[a]) - 1;
+        }
+        s.squaredCutoff = -1;
+        continue;
+      }
+      float cutoff = kernelTruncation * adaptRadius[landmarkIndex];
+      s.squaredCutoff = cutoff * cutoff;
+      const itk::Point<double, 3> & p = fixedLandmarks->at(landmarkIndex);
+      std::vector<double> continuousIndex = vectorField->TransformPhysicalPointToContinuousIndex(std::vector<double> {p[0], p[1], p[2]});
+      for (unsigned int a=0; a<3; a++){
+        s.lower[a] = std::max<itk::int64_t>(0, static_cast<itk::int64_t>(std::ceil(continuousIndex[a] - cutoff / spacing[a])));
+        s.upper[a] = std::min<itk::int64_t>(static_cast<itk::int64_t>(size[a]) - 1, static_cast<itk::int64_t>(std::floor(continuousIndex[a] + cutoff / spacing[a])));
+      }
+    }
+    return support;
+  }
+
+  // Region of the grid to evaluate, as inclusive index bounds.
+  struct IndexRegion
+  {
+    itk::int64_t lower[3];
+    itk::int64_t upper[3];
+  };
+
+  IndexRegion FullRegion(sitk::Image *vectorField)
+  {
+    std::vector<unsigned int> size = vectorField->GetSize();
+    IndexRegion region;
+    for (unsigned int a=0; a<3; a++){
+      region.lower[a] = 0;
+      region.upper[a] = static_cast<itk::int64_t>(size[a]) - 1;
+    }
+    return region;
+  }
+
+  // Bounding region of the truncated kernels centered at the changed landmarks,
+  // with the radius each of them had (removed landmarks) or has (added ones).
+  IndexRegion ChangedLandmarksRegion(
+    sitk::Image *vectorField,
+    std::vector< itk::Point<double, 3> > * changedLandmarks,
+    float * changedRadius,
+    float kernelTruncation)
   {
-    float r = rbf_center->EuclideanDistanceTo(*loc) / radius;
-    float val = exp( -r*r );   
-    return val;
+    std::vector<LandmarkSupport> support = ComputeLandmarksSupport(vectorField, changedLandmarks, changedRadius, kernelTruncation);
+    IndexRegion region = FullRegion(vectorField);
+    for (unsigned int a=0; a<3; a++){
+      std::swap(region.lower[a], region.upper[a]); // empty
+    }
+    for (const LandmarkSupport & s : support){
+      for (unsigned int a=0; a<3; a++){
+        region.lower[a] = std::min(region.lower[a], s.lower[a]);
+        region.upper[a] = std::max(region.upper[a], s.upper[a]);
+      }
+    }
+    return region;
   }
 
+  // Overwrite the displacement of the voxels inside region with the sum of the kernels.
   void RBFGaussUpdateVectorField( 
     sitk::Image *vectorField, 
     float *coeff, 
     std::vector< itk::Point<double, 3> > * fixedLandmarks,
-    float * adaptRadius)
+    float * adaptRadius,
+    float kernelTruncation,
+    const IndexRegion & region,
+    unsigned int numberOfThreads)
   {
-    unsigned int i, landmarkIndex, imageLinearIndex;
-    float rbf;
-    unsigned int numLandmarks = fixedLandmarks->size();
+    for (unsigned int a=0; a<3; a++){
+      if (region.lower[a] > region.upper[a]){
+        return; // nothing to update
+      }
+    }
 
-    itk::Point<double, 3> physicalPointITK;
-    std::vector<double> physicalPoint;
+    unsigned int numLandmarks = fixedLandmarks->size();
 
     std::vector<unsigned int> size = vectorField->GetSize();
+    // get the buffer before threading, as it might make the image unique
     float * buffer = vectorField->GetBufferAsFloat();
-    std::vector<itk::int64_t> ijk {0,0,0};
 
-    for(ijk[0]=0; ijk[0]<size[0]; ijk[0]=ijk[0]+1){
-    for(ijk[1]=0; ijk[1]<size[1]; ijk[1]=ijk[1]+1){
-    for(ijk[2]=0; ijk[2]<size[2]; ijk[2]=ijk[2]+1){
+    // Physical step when advancing one voxel along the first index axis,
+    // i.e. the first column of direction * spacing.
+    std::vector<double> spacing = vectorField->GetSpacing();
+    std::vector<double> direction = vectorField->GetDirection();
+    double step[3];
+    for (unsigned int a=0; a<3; a++){
+      step[a] = direction[3*a] * spacing[0];
+    }
 
-      physicalPoint = vectorField->TransformIndexToPhysicalPoint(ijk);
-      for (i=0; i<3; i++){
-        physicalPointITK[i] = physicalPoint[i];
+    // Spatial index: landmarks binned by the slices of the last index axis they can reach.
+    // Landmarks are kept in ascending order within each bin.
+    std::vector<LandmarkSupport> support = ComputeLandmarksSupport(vectorField, fixedLandmarks, adaptRadius, kernelTruncation);
+    std::vector< std::vector<unsigned int> > sliceLandmarks(size[2]);
+    for (unsigned int landmarkIndex=0; landmarkIndex < numLandmarks; landmarkIndex++) {
+      const LandmarkSupport & s = support[landmarkIndex];
+      if (s.lower[0] > s.upper[0] || s.lower[1] > s.upper[1]){
+        continue; // does not reach the grid
       }
+      for (itk::int64_t slice = s.lower[2]; slice <= s.upper[2]; slice++){
+        sliceLandmarks[slice].push_back(landmarkIndex);
+      }
+    }
+
+    // Voxels are visited in memory order: the first index is the innermost loop.
+    // Each work unit owns whole slices of the last index, so every voxel is written
+    // by one thread only and accumulates the landmarks in the same order. Therefore,
+    // the output does not depend on the number of threads.
+    auto evaluateSlice = [&](itk::SizeValueType slice)
+    {
+      unsigned int i;
+      size_t imageLinearIndex;
+      float rbf;
+      double squaredDistance;
+      itk::Point<double, 3> physicalPointITK;
+      std::vector<double> rowOrigin;
+      std::vector<itk::int64_t> ijk {0,0,static_cast<itk::int64_t>(slice)};
+      std::vector<unsigned int> rowLandmarks;
+
+      for(ijk[1]=region.lower[1]; ijk[1]<=region.upper[1]; ijk[1]=ijk[1]+1){
+
+        size_t rowLinearIndex = size[0] * (ijk[1] + static_cast<size_t>(size[1]) * ijk[2]);
+        for(ijk[0]=region.lower[0]; ijk[0]<=region.upper[0]; ijk[0]=ijk[0]+1){
+          imageLinearIndex = rowLinearIndex + ijk[0];
+          for (i=0; i<3; i++){
+            buffer[3*imageLinearIndex+i] = 0;
+          }
+        }
+
+        rowLandmarks.clear();
+        for (unsigned int landmarkIndex : sliceLandmarks[slice]) {
+          if (ijk[1] >= support[landmarkIndex].lower[1] && ijk[1] <= support[landmarkIndex].upper[1]){
+            rowLandmarks.push_back(landmarkIndex);
+          }
+        }
+        if (rowLandmarks.empty()){
+          continue;
+        }
+
+        // Only the first voxel of the row is mapped through the image geometry,
+        // the rest are offset from it by a multiple of the step.
+        ijk[0] = 0;
+        rowOrigin = vectorField->TransformIndexToPhysicalPoint(ijk);
+
+        for(ijk[0]=region.lower[0]; ijk[0]<=region.upper[0]; ijk[0]=ijk[0]+1){
+
+          for (i=0; i<3; i++){
+            physicalPointITK[i] = rowOrigin[i] + ijk[0] * step[i];
+          }
+
+          imageLinearIndex = rowLinearIndex + ijk[0];
+
+          for (unsigned int landmarkIndex : rowLandmarks) {
 
-      imageLinearIndex = ijk[0] + (size[0] * (ijk[1] + size[1] * ijk[2]));
+            const LandmarkSupport & s = support[landmarkIndex];
+            if (s.squaredCutoff >= 0 && (ijk[0] < s.lower[0] || ijk[0] > s.upper[0])){
+              continue;
+            }
 
-      for (landmarkIndex=0; landmarkIndex < numLandmarks; landmarkIndex++) {
-        
-        rbf = RBFValue(&fixedLandmarks->at(landmarkIndex), &physicalPointITK, adaptRadius[landmarkIndex]);
+            squaredDistance = fixedLandmarks->at(landmarkIndex).SquaredEuclideanDistanceTo(physicalPointITK);
+            if (s.squaredCutoff >= 0 && squaredDistance > s.squaredCutoff){
+              continue;
+            }
+
+            rbf = RBFValue(squaredDistance, adaptRadius[landmarkIndex]);
+
+            for (i=0; i<3; i++){
+              buffer[3*imageLinearIndex+i] += coeff[3*landmarkIndex+i] * rbf;
+            }
+          }
 
-        for (i=0; i<3; i++){
-          buffer[3*imageLinearIndex+i] += coeff[3*landmarkIndex+i] * rbf;
         }
       }
+    };
 
+    itk::MultiThreaderBase::Pointer threader = itk::MultiThreaderBase::New();
+    if (numberOfThreads > 0)
+    {
+      threader->SetMaximumNumberOfThreads(numberOfThreads);
+      threader->SetNumberOfWorkUnits(numberOfThreads);
     }
-    }
-    }
+    threader->ParallelizeArray(region.lower[2], region.upper[2] + 1, evaluateSlice, nullptr);
 
   }
 
-  float * BSplineRBFFindCoeffs(
-    std::vector< itk::Point<double, 3> > * fixedLandmarks, 
-    std::vector< itk::Point<double, 3> > * movingLandmarks,
-    float * adaptRadius,
-    float stiffness)
+  // Upper bound of the displacement (per component, in mm) left out at any voxel
+  // by truncating the kernels at kernelTruncation times their radius.
+  float TruncationErrorBound(float *coeff, unsigned int numLandmarks, float kernelTruncation)
   {
-    float rbfv1, rbfv2;
-    int i, j, k, d;
-    float rbf_prefactor, reg_term, r2, tmp;
-    unsigned int numLandmarks = fixedLandmarks->size();
-
-    float * coeff = (float*) malloc (3 * numLandmarks * sizeof(float));
-
-    typedef vnl_matrix <double> Vnl_matrix;
-    typedef vnl_svd <double> SVDSolverType;
-    Vnl_matrix A, b;
-
-    float RBFRadius = 0.0;
-    for (i=0; i<numLandmarks; i++){
-      RBFRadius += adaptRadius[i];
-    }
-    RBFRadius = RBFRadius / numLandmarks;
-
-    A.set_size (3 * numLandmarks, 3 * numLandmarks);
-    A.fill(0.);
-
-    b.set_size (3 * numLandmarks, 1);
-    b.fill (0.0);
-
-    // right-hand side
-    for (i=0; i<numLandmarks; i++) {
-	  for (j=0; j<numLandmarks; j++) {
-	    rbfv1 = RBFValue (&fixedLandmarks->at(i), &fixedLandmarks->at(j), adaptRadius[j]);
-		
-	    for (d=0;d<3;d++) {
-		    b (3*i +d, 0) -= rbfv1 * (fixedLandmarks->at(j)[d] - movingLandmarks->at(j)[d]);
-	    }
-	  }
-    }
-
-    // matrix
-    for (i = 0; i < numLandmarks; i++) {
-	  for (j = 0; j < numLandmarks; j++) {
-	    tmp = 0;
-	    for (k = 0; k < numLandmarks; k++) {
-
-		  rbfv1 = RBFValue (&fixedLandmarks->at(k), &fixedLandmarks->at(i), adaptRadius[k]);
-		  rbfv2 = RBFValue (&fixedLandmarks->at(k), &fixedLandmarks->at(j), adaptRadius[k]);
-
-		  tmp += rbfv1*rbfv2;
-	    }
-	    for (d=0;d<3;d++){
-		    A(3*i+d, 3*j+d) = tmp;
-	    }
-	  }
-    }
-
-    //add regularization terms to the matrix
-    rbf_prefactor = sqrt(M_PI/2.)*sqrt(M_PI/2.)*sqrt(M_PI/2.)/RBFRadius;
-    for (d=0;d<3;d++) {
-	  for (i=0;i<numLandmarks;i++) {
-	    for (j=0;j<numLandmarks;j++) {
-        tmp = A(3*i+d, 3*j+d);
-        reg_term = 0.;			
-        if (i==j) {
-            reg_term = rbf_prefactor * 15.;
-        }
-        else
-        {
-          // r2 = sq distance between landmarks i,j in mm
-          float d = fixedLandmarks->at(i).EuclideanDistanceTo(fixedLandmarks->at(j));
-          r2 = (d * d) / (adaptRadius[i] * adaptRadius[j]);
-          reg_term = rbf_prefactor * exp(-r2/2.) * (-10 + (r2-5.)*(r2-5.));
-        }
-        A (3*i+d,3*j+d) = tmp + reg_term * stiffness;
-      } 
-	  }
+    if (kernelTruncation <= 0){
+      return 0;
     }
-
-    SVDSolverType svd (A, 1e-6);
-    Vnl_matrix x = svd.solve (b);
-
-    for (i=0; i<3*numLandmarks; i++) {
-	    coeff[i] = x(i,0);
+    float maxCoefficientSum = 0;
+    for (unsigned int d=0; d<3; d++){
+      float coefficientSum = 0;
+      for (unsigned int landmarkIndex=0; landmarkIndex < numLandmarks; landmarkIndex++){
+        coefficientSum += std::fabs(coeff[3*landmarkIndex+d]);
+      }
+      maxCoefficientSum = std::max(maxCoefficientSum, coefficientSum);
     }
-    return coeff;
+    return maxCoefficientSum * exp(-kernelTruncation * kernelTruncation);
   }
 
-
 } // end of anonymous namespace
 
 int main( int argc, char * argv[] )
@@ -229,17 +320,113 @@ int main( int argc, char * argv[] )
 
   float * coeff = BSplineRBFFindCoeffs(&fixedPoints, &movingPoints, adaptRadius, stiffness);
 
+  // Output grid, from the reference volume or from the geometry parameters
+
+  std::vector<unsigned int> size;
+  std::vector<double> origin, spacing, direction;
+
+  if (!referenceVolume.empty())
+  {
+    // Only the header is needed
+    sitk::ImageFileReader reader;
+    reader.SetFileName(referenceVolume);
+    reader.ReadImageInformation();
+    std::vector<uint64_t> referenceSize = reader.GetSize();
+    size.assign(referenceSize.begin(), referenceSize.end());
+    origin = reader.GetOrigin();
+    spacing = reader.GetSpacing();
+    direction = reader.GetDirection();
+  }
+  else
+  {
+    if (outputDirection.empty())
+    {
+      outputDirection = {1, 0, 0, 0, 1, 0, 0, 0, 1};
+    }
+    if (outputSize.size() != 3 || outputOrigin.size() != 3 || outputSpacing.size() != 3 || outputDirection.size() != 9)
+    {
+      std::cerr << "Specify either a reference volume or the output size, origin and spacing (three values each) "
+                << "and optionally the output direction (nine values)." << std::endl;
+      return EXIT_FAILURE;
+    }
+    for (int s : outputSize)
+    {
+      if (s <= 0)
+      {
+        std::cerr << "The output size must be positive." << std::endl;
+        return EXIT_FAILURE;
+      }
+      size.push_back(s);
+    }
+    origin = outputOrigin;
+    spacing = outputSpacing;
+    direction = outputDirection;
+  }
+
   // Create vector field
-  sitk::ImageFileReader reader;
-  reader.SetFileName(referenceVolume);
-  sitk::Image &&referenceImage = reader.Execute();
+  sitk::Image output(size, sitk::sitkVectorFloat32);
+  output.SetOrigin(origin);
+  output.SetSpacing(spacing);
+  output.SetDirection(direction);
+
+  if (numberOfThreads < 0)
+  {
+    std::cerr << "The number of threads must be zero (use all cores) or positive." << std::endl;
+    return EXIT_FAILURE;
+  }
+
+  IndexRegion region = FullRegion(&output);
+
+  // Incremental update: start from the previous field and only rewrite the
+  // neighbourhood of the changed landmarks.
+  if (!previousDisplacementField.empty() && !changedFiducials.empty())
+  {
+    sitk::Image previous = sitk::ReadImage(previousDisplacementField);
+    if (previous.GetPixelID() != sitk::sitkVectorFloat32)
+    {
+      previous = sitk::Cast(previous, sitk::sitkVectorFloat32);
+    }
+    if (kernelTruncation <= 0)
+    {
+      std::cout << "Kernels are not truncated. Computing the full displacement field." << std::endl;
+    }
+    else if (changedRBFRadius.empty())
+    {
+      std::cout << "The radius of the changed fiducials is not given. Computing the full displacement field." << std::endl;
+    }
+    else if (changedRBFRadius.size() != 1 && changedRBFRadius.size() != changedFiducials.size())
+    {
+      std::cerr << "The number of changed RBF radius must be one or the same as the number of changed fiducials." << std::endl;
+      return EXIT_FAILURE;
+    }
+    else if (previous.GetSize() != output.GetSize() || previous.GetOrigin() != output.GetOrigin() ||
+             previous.GetSpacing() != output.GetSpacing() || previous.GetDirection() != output.GetDirection())
+    {
+      std::cout << "Previous displacement field geometry does not match the output grid. Computing the full displacement field." << std::endl;
+    }
+    else
+    {
+      PointList changedPoints(changedFiducials.size());
+      std::transform(changedFiducials.begin(), changedFiducials.end(),
+        changedPoints.begin(),
+        convertStdVectorToITKPoint);
+      std::vector<float> changedRadius(changedFiducials.size(), changedRBFRadius[0]);
+      if (changedRBFRadius.size() > 1)
+      {
+        std::copy(changedRBFRadius.begin(), changedRBFRadius.end(), changedRadius.begin());
+      }
+      output = previous;
+      region = ChangedLandmarksRegion(&output, &changedPoints, changedRadius.data(), kernelTruncation);
+    }
+  }
 
-  sitk::Image output(referenceImage.GetSize(), sitk::sitkVectorFloat32);
-  output.SetOrigin(referenceImage.GetOrigin());
-  output.SetSpacing(referenceImage.GetSpacing());
-  output.SetDirection(referenceImage.GetDirection());
+  RBFGaussUpdateVectorField(&output, coeff, &fixedPoints, adaptRadius, kernelTruncation, region, numberOfThreads);
 
-  RBFGaussUpdateVectorField(&output, coeff, &fixedPoints, adaptRadius);
+  if (kernelTruncation > 0)
+  {
+    std::cout << "Kernels truncated at " << kernelTruncation << " radii. "
+              << "Maximum omitted displacement per voxel: " << TruncationErrorBound(coeff, numFiducials, kernelTruncation) << " mm" << std::endl;
+  }
 
   sitk::WriteImage(output, outputDisplacementField);
 
@@ -0,0 +1,142 @@
+// Coefficients of the variable radius RBF, shared by the CLI and its tests.
+// The logic of this computation is taken from plastimatch and modified to use variable RBF Radius.
+// https://gitlab.com/plastimatch/plastimatch
+
+#ifndef __FiducialRegistrationVariableRBFCoefficients_h
+#define __FiducialRegistrationVariableRBFCoefficients_h
+
+// ITK includes
+#include <itkPoint.h>
+
+// VNL includes
+#include <vnl/vnl_fastops.h>
+#include <vnl/algo/vnl_cholesky.h>
+#include <vnl/algo/vnl_svd.h>
+
+// STD includes
+#include <cmath>
+#include <cstdlib>
+#include <vector>
+
+#ifndef M_PI
+  #define M_PI 3.14159265358979323846
+#endif
+
+namespace
+{
+  static float RBFValue (itk::Point<double, 3> * rbf_center, itk::Point<double, 3> * loc, float radius)
+  {
+    float r = rbf_center->EuclideanDistanceTo(*loc) / radius;
+    float val = exp( -r*r );   
+    return val;
+  }
+
+  // Same as above, from the squared distance between the center and the location
+  static float RBFValue (double squaredDistance, float radius)
+  {
+    float r2 = squaredDistance / (radius * radius);
+    return exp( -r2 );
+  }
+
+  float * BSplineRBFFindCoeffs(
+    std::vector< itk::Point<double, 3> > * fixedLandmarks, 
+    std::vector< itk::Point<double, 3> > * movingLandmarks,
+    float * adaptRadius,
+    float stiffness)
+  {
+    int i, j, k, d;
+    float rbf_prefactor, reg_term, r2, tmp;
+    unsigned int numLandmarks = fixedLandmarks->size();
+
+    float * coeff = (float*) malloc (3 * numLandmarks * sizeof(float));
+
+    typedef vnl_matrix <double> Vnl_matrix;
+    typedef vnl_vector <double> Vnl_vector;
+    typedef vnl_svd <double> SVDSolverType;
+    typedef vnl_cholesky CholeskySolverType;
+    Vnl_matrix A, b;
+
+    float RBFRadius = 0.0;
+    for (i=0; i<numLandmarks; i++){
+      RBFRadius += adaptRadius[i];
+    }
+    RBFRadius = RBFRadius / numLandmarks;
+
+    // The kernel is isotropic, so the three coordinate blocks of the system are identical.
+    // Solve a single N x N system with one right-hand side per coordinate.
+    A.set_size (numLandmarks, numLandmarks);
+    b.set_size (numLandmarks, 3);
+
+    // Kernel matrix, K(k, i) is the kernel of landmark k evaluated at landmark i.
+    // Both sides of the normal equations are products of it, so the kernel is
+    // only evaluated N^2 times: A = K^T K and b = -K^T (fixed - moving).
+    Vnl_matrix K (numLandmarks, numLandmarks);
+    for (k = 0; k < numLandmarks; k++) {
+      for (i = 0; i < numLandmarks; i++) {
+        K(k, i) = RBFValue (&fixedLandmarks->at(k), &fixedLandmarks->at(i), adaptRadius[k]);
+      }
+    }
+
+    Vnl_matrix displacement (numLandmarks, 3);
+    for (j = 0; j < numLandmarks; j++) {
+      for (d = 0; d < 3; d++) {
+        displacement(j, d) = fixedLandmarks->at(j)[d] - movingLandmarks->at(j)[d];
+      }
+    }
+
+    // right-hand side
+    vnl_fastops::AtB (b, K, displacement);
+    b *= -1;
+
+    // matrix
+    vnl_fastops::AtA (A, K);
+
+    //add regularization terms to the matrix
+    rbf_prefactor = sqrt(M_PI/2.)*sqrt(M_PI/2.)*sqrt(M_PI/2.)/RBFRadius;
+    for (i=0;i<numLandmarks;i++) {
+      for (j=0;j<numLandmarks;j++) {
+        tmp = A(i, j);
+        reg_term = 0.;			
+        if (i==j) {
+            reg_term = rbf_prefactor * 15.;
+        }
+        else
+        {
+          // r2 = sq distance between landmarks i,j in mm
+          float d = fixedLandmarks->at(i).EuclideanDistanceTo(fixedLandmarks->at(j));
+          r2 = (d * d) / (adaptRadius[i] * adaptRadius[j]);
+          reg_term = rbf_prefactor * exp(-r2/2.) * (-10 + (r2-5.)*(r2-5.));
+        }
+        A (i, j) = tmp + reg_term * stiffness;
+      }
+    }
+
+    // The matrix is symmetric. Use a Cholesky factorization and only fall back
+    // to SVD if it is not positive definite or is ill-conditioned.
+    CholeskySolverType cholesky (A, CholeskySolverType::estimate_condition);
+    if (cholesky.rank_deficiency() == 0 && cholesky.rcond() > 1e-6)
+    {
+      for (d=0; d<3; d++) {
+        Vnl_vector x = cholesky.solve (b.get_column(d));
+        for (i=0; i<numLandmarks; i++) {
+          coeff[3*i+d] = x(i);
+        }
+      }
+    }
+    else
+    {
+      SVDSolverType svd (A, 1e-6);
+      Vnl_matrix x = svd.solve (b);
+      for (i=0; i<numLandmarks; i++) {
+        for (d=0; d<3; d++) {
+          coeff[3*i+d] = x(i,d);
+        }
+      }
+    }
+    return coeff;
+  }
+
+
+} // end of anonymous namespace
+
+#endif
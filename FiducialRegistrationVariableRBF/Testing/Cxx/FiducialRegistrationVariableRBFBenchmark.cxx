@@ -0,0 +1,122 @@
+// Benchmark of FiducialRegistrationVariableRBF on a synthetic landmark set.
+// Usage: FiducialRegistrationVariableRBFBenchmark <temporary directory> <grid size> <number of landmarks> [benchmark options]
+// A small grid measures the coefficients solve, a large one the field evaluation.
+// With --compareTolerance, the output is compared to the one computed on a single
+// thread without kernel truncation. See NetstimBenchmarkHelpers.h for the other options.
+
+#include "NetstimBenchmarkHelpers.h"
+
+// ITK includes
+#include <itkTimeProbe.h>
+
+// STD includes
+#include <iostream>
+#include <random>
+#include <sstream>
+#include <string>
+#include <vector>
+
+#ifdef WIN32
+# define MODULE_IMPORT __declspec(dllimport)
+#else
+# define MODULE_IMPORT
+#endif
+
+extern "C" MODULE_IMPORT int ModuleEntryPoint(int, char* []);
+
+namespace
+{
+  int RunModule(std::vector<std::string> & args)
+  {
+    std::vector<char*> argv;
+    argv.push_back(const_cast<char*>("FiducialRegistrationVariableRBF"));
+    for (std::string & arg : args)
+    {
+      argv.push_back(&arg[0]);
+    }
+    return ModuleEntryPoint(static_cast<int>(argv.size()), argv.data());
+  }
+
+  std::string PointToString(const double * point)
+  {
+    std::ostringstream stream;
+    stream << point[0] << "," << point[1] << "," << point[2];
+    return stream.str();
+  }
+
+} // end of anonymous namespace
+
+int main( int argc, char * argv[] )
+{
+  NetstimBenchmark::Options options;
+  if (!NetstimBenchmark::ParseOptions(argc, argv, options) || options.Arguments.size() != 3)
+  {
+    std::cerr << "Usage: " << argv[0] << " <temporary directory> <grid size> <number of landmarks> [benchmark options]" << std::endl;
+    return EXIT_FAILURE;
+  }
+
+  std::string temporaryDirectory = options.Arguments[0];
+  unsigned int gridSize = std::stoul(options.Arguments[1]);
+  unsigned int numberOfLandmarks = std::stoul(options.Arguments[2]);
+  std::string caseName = "grid " + std::to_string(gridSize) + " landmarks " + std::to_string(numberOfLandmarks);
+  std::string prefix = temporaryDirectory + "/FiducialRegistrationVariableRBFBenchmark" + std::to_string(gridSize) + "_" + std::to_string(numberOfLandmarks);
+
+  // Output grid spanning the landmarks
+  std::string size = std::to_string(gridSize);
+  std::string spacing = std::to_string(128.0 / gridSize);
+
+  std::mt19937 generator(0);
+  std::uniform_real_distribution<double> position(-60, 60);
+  std::normal_distribution<double> displacement(0, 2);
+
+  std::vector<std::string> args;
+  for (unsigned int i = 0; i < numberOfLandmarks; i++)
+  {
+    double fixed[3], moving[3];
+    for (int d = 0; d < 3; d++)
+    {
+      fixed[d] = position(generator);
+      moving[d] = fixed[d] + displacement(generator);
+    }
+    args.push_back("--fixedFiducials");
+    args.push_back(PointToString(fixed));
+    args.push_back("--movingFiducials");
+    args.push_back(PointToString(moving));
+  }
+  args.insert(args.end(), {"--rbfradius", "15", "--stiffness", "0.1",
+    "--outputSize", size + "," + size + "," + size,
+    "--outputOrigin", "-60,-60,-60",
+    "--outputSpacing", spacing + "," + spacing + "," + spacing});
+  std::vector<std::string> referenceArgs = args;
+
+  args.insert(args.end(), {"--outputDisplacementField", prefix + "Output.nrrd"});
+
+  itk::TimeProbe probe;
+  probe.Start();
+  int status = RunModule(args);
+  probe.Stop();
+
+  if (status != EXIT_SUCCESS)
+  {
+    std::cerr << "Run with " << numberOfLandmarks << " landmarks failed" << std::endl;
+    return EXIT_FAILURE;
+  }
+  NetstimBenchmark::Record(options, "FiducialRegistrationVariableRBF", caseName, probe.GetTotal());
+  if (!NetstimBenchmark::CheckTimeBaseline(options, "FiducialRegistrationVariableRBF", caseName, probe.GetTotal()))
+  {
+    return EXIT_FAILURE;
+  }
+
+  if (options.CompareTolerance >= 0)
+  {
+    referenceArgs.insert(referenceArgs.end(), {"--kernelTruncation", "0", "--numberOfThreads", "1",
+      "--outputDisplacementField", prefix + "Reference.nrrd"});
+    if (RunModule(referenceArgs) != EXIT_SUCCESS ||
+        !NetstimBenchmark::CheckOutput(options, prefix + "Output.nrrd", prefix + "Reference.nrrd"))
+    {
+      return EXIT_FAILURE;
+    }
+  }
+
+  return EXIT_SUCCESS;
+}
@@ -0,0 +1,119 @@
+// Compare the coefficients of the variable radius RBF against the reference
+// 3N x 3N formulation taken from plastimatch.
+
+#include "FiducialRegistrationVariableRBFCoefficients.h"
+
+// STD includes
+#include <algorithm>
+#include <iostream>
+#include <random>
+
+namespace
+{
+  // Reference implementation. The kernel products of the normal equations are
+  // evaluated in a triple loop and the coordinates are solved as one 3N x 3N system.
+  vnl_matrix<double> ReferenceCoefficients(
+    std::vector< itk::Point<double, 3> > & fixedLandmarks,
+    std::vector< itk::Point<double, 3> > & movingLandmarks,
+    std::vector<float> & adaptRadius,
+    float stiffness)
+  {
+    unsigned int numLandmarks = fixedLandmarks.size();
+
+    float RBFRadius = 0.0;
+    for (unsigned int i = 0; i < numLandmarks; i++)
+    {
+      RBFRadius += adaptRadius[i];
+    }
+    RBFRadius = RBFRadius / numLandmarks;
+
+    vnl_matrix<double> A(3 * numLandmarks, 3 * numLandmarks, 0.0);
+    vnl_matrix<double> b(3 * numLandmarks, 1, 0.0);
+
+    for (unsigned int i = 0; i < numLandmarks; i++)
+    {
+      for (unsigned int j = 0; j < numLandmarks; j++)
+      {
+        float rbfv = RBFValue(&fixedLandmarks[i], &fixedLandmarks[j], adaptRadius[j]);
+        for (int d = 0; d < 3; d++)
+        {
+          b(3*i+d, 0) -= rbfv * (fixedLandmarks[j][d] - movingLandmarks[j][d]);
+        }
+      }
+    }
+
+    float rbf_prefactor = sqrt(M_PI/2.)*sqrt(M_PI/2.)*sqrt(M_PI/2.)/RBFRadius;
+    for (unsigned int i = 0; i < numLandmarks; i++)
+    {
+      for (unsigned int j = 0; j < numLandmarks; j++)
+      {
+        float tmp = 0;
+        for (unsigned int k = 0; k < numLandmarks; k++)
+        {
+          tmp += RBFValue(&fixedLandmarks[k], &fixedLandmarks[i], adaptRadius[k]) *
+                 RBFValue(&fixedLandmarks[k], &fixedLandmarks[j], adaptRadius[k]);
+        }
+        float reg_term = rbf_prefactor * 15.;
+        if (i != j)
+        {
+          float dist = fixedLandmarks[i].EuclideanDistanceTo(fixedLandmarks[j]);
+          float r2 = (dist * dist) / (adaptRadius[i] * adaptRadius[j]);
+          reg_term = rbf_prefactor * exp(-r2/2.) * (-10 + (r2-5.)*(r2-5.));
+        }
+        for (int d = 0; d < 3; d++)
+        {
+          A(3*i+d, 3*j+d) = tmp + reg_term * stiffness;
+        }
+      }
+    }
+
+    vnl_svd<double> svd(A, 1e-6);
+    return svd.solve(b);
+  }
+
+} // end of anonymous namespace
+
+int FiducialRegistrationVariableRBFCoefficientsTest(int, char* [])
+{
+  const float stiffness = 0.1;
+  const double tolerance = 1e-3;
+
+  std::mt19937 generator(0);
+  std::uniform_real_distribution<double> position(-60, 60);
+  std::normal_distribution<double> displacement(0, 2);
+  std::uniform_real_distribution<float> radius(10, 20);
+
+  for (unsigned int numLandmarks : {1, 5, 50, 200})
+  {
+    std::vector< itk::Point<double, 3> > fixedLandmarks(numLandmarks), movingLandmarks(numLandmarks);
+    std::vector<float> adaptRadius(numLandmarks);
+    for (unsigned int i = 0; i < numLandmarks; i++)
+    {
+      for (int d = 0; d < 3; d++)
+      {
+        fixedLandmarks[i][d] = position(generator);
+        movingLandmarks[i][d] = fixedLandmarks[i][d] + displacement(generator);
+      }
+      adaptRadius[i] = radius(generator);
+    }
+
+    vnl_matrix<double> reference = ReferenceCoefficients(fixedLandmarks, movingLandmarks, adaptRadius, stiffness);
+    float * coeff = BSplineRBFFindCoeffs(&fixedLandmarks, &movingLandmarks, adaptRadius.data(), stiffness);
+
+    double maximumDifference = 0;
+    for (unsigned int i = 0; i < 3 * numLandmarks; i++)
+    {
+      maximumDifference = std::max(maximumDifference, std::abs(coeff[i] - reference(i, 0)));
+    }
+    free(coeff);
+
+    std::cout << numLandmarks << " landmarks, maximum coefficient difference: " << maximumDifference << std::endl;
+    if (maximumDifference > tolerance)
+    {
+      std::cerr << "Coefficients differ from the reference by more than " << tolerance << std::endl;
+      return EXIT_FAILURE;
+    }
+  }
+
+  return EXIT_SUCCESS;
+}
@@ -18,8 +18,10 @@
 #endif
 
 extern "C" MODULE_IMPORT int ModuleEntryPoint(int, char* []);
+int FiducialRegistrationVariableRBFCoefficientsTest(int, char* []);
 
 void RegisterTests()
 {
   StringToTestFunctionMap["ModuleEntryPoint"] = ModuleEntryPoint;
+  StringToTestFunctionMap["FiducialRegistrationVariableRBFCoefficientsTest"] = FiducialRegistrationVariableRBFCoefficientsTest;
 }
@@ -66,6 +66,22 @@ class NetstimPreferencesSettingsUI:
       self.useSmoothAtlasCheckBox.connect("toggled(bool)", self.onUseSmoothAtlasCheckBoxToggled)
       layout.addRow("Use smooth atlases: ", self.useSmoothAtlasCheckBox)
 
+      self.warpDriveDiskCacheSizeSpinBox = qt.QSpinBox()
+      self.warpDriveDiskCacheSizeSpinBox.setRange(0, 100000)
+      self.warpDriveDiskCacheSizeSpinBox.setSuffix(" MB")
+      self.warpDriveDiskCacheSizeSpinBox.value = WarpDriveDiskCacheSize().getValue()
+      self.warpDriveDiskCacheSizeSpinBox.setToolTip("Disk space used to keep WarpDrive results for reuse. Set to 0 to only keep them in memory. Takes effect after restart.")
+      self.warpDriveDiskCacheSizeSpinBox.connect("valueChanged(int)", lambda v: WarpDriveDiskCacheSize().setValue(v))
+      layout.addRow("WarpDrive disk cache: ", self.warpDriveDiskCacheSizeSpinBox)
+
+      self.warpDriveCompressionLevelSpinBox = qt.QSpinBox()
+      self.warpDriveCompressionLevelSpinBox.setRange(-1, 9)
+      self.warpDriveCompressionLevelSpinBox.setSpecialValueText("Writer default")
+      self.warpDriveCompressionLevelSpinBox.value = WarpDriveCompressionLevel().getValue()
+      self.warpDriveCompressionLevelSpinBox.setToolTip("gzip level of the warp fields saved by WarpDrive (1 fastest, 9 smallest, 0 no compression). Fields are compressed on all cores. Writer default compresses on a single core.")
+      self.warpDriveCompressionLevelSpinBox.connect("valueChanged(int)", lambda v: WarpDriveCompressionLevel().setValue(v))
+      layout.addRow("WarpDrive compression level: ", self.warpDriveCompressionLevelSpinBox)
+
       # initial set-up
       previousSpace = LeadDBSSpace().getValue()
       if previousSpace:
@@ -121,4 +137,18 @@ class UseSmoothAtlas(NetstimPreference):
       super().__init__()
       self.key = "useSmoothAtlas"
       self.default = True
-      self.converter = slicer.util.toBool
\ No newline at end of file
+      self.converter = slicer.util.toBool
+
+class WarpDriveDiskCacheSize(NetstimPreference):
+  def __init__(self):
+      super().__init__()
+      self.key = "warpDriveDiskCacheSize"
+      self.default = 0
+      self.converter = int
+
+class WarpDriveCompressionLevel(NetstimPreference):
+  def __init__(self):
+      super().__init__()
+      self.key = "warpDriveCompressionLevel"
+      self.default = 6
+      self.converter = int
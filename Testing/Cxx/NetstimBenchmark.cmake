@@ -0,0 +1,22 @@
+#-----------------------------------------------------------------------------
+# Common set up of the CLI benchmarks. Each benchmark case is a test labeled
+# Benchmark (run them with ctest -L Benchmark) appending its run time and
+# peak memory to NETSTIM_BENCHMARK_CSV.
+
+set(NETSTIM_BENCHMARK_INCLUDE_DIR ${CMAKE_CURRENT_LIST_DIR})
+
+set(NETSTIM_BENCHMARK_CSV "${CMAKE_BINARY_DIR}/Testing/Temporary/NetstimBenchmarks.csv"
+  CACHE FILEPATH "File the benchmark results are appended to.")
+set(NETSTIM_BENCHMARK_TIME_BASELINE ""
+  CACHE FILEPATH "Optional CSV file of benchmark, case, seconds. Benchmarks slower than their baseline fail.")
+set(NETSTIM_BENCHMARK_TIME_TOLERANCE "0.5"
+  CACHE STRING "Allowed relative slow down with respect to the time baseline.")
+mark_as_advanced(NETSTIM_BENCHMARK_CSV NETSTIM_BENCHMARK_TIME_BASELINE NETSTIM_BENCHMARK_TIME_TOLERANCE)
+
+set(NETSTIM_BENCHMARK_ARGS --csv ${NETSTIM_BENCHMARK_CSV})
+if(NETSTIM_BENCHMARK_TIME_BASELINE)
+  list(APPEND NETSTIM_BENCHMARK_ARGS
+    --timeBaseline ${NETSTIM_BENCHMARK_TIME_BASELINE}
+    --timeTolerance ${NETSTIM_BENCHMARK_TIME_TOLERANCE}
+    )
+endif()
@@ -0,0 +1,233 @@
+// Helpers shared by the benchmarks of the CLI modules: option parsing, peak memory,
+// CSV records, and checks of run times and outputs against baselines.
+// Each benchmark run should be a separate process (one CTest test per case),
+// as the peak memory is the one of the whole process.
+
+#ifndef NetstimBenchmarkHelpers_h
+#define NetstimBenchmarkHelpers_h
+
+// ITK includes
+#include <itkImage.h>
+#include <itkImageFileReader.h>
+#include <itkImageRegionConstIterator.h>
+#include <itkVector.h>
+
+// STD includes
+#include <algorithm>
+#include <cmath>
+#include <fstream>
+#include <iostream>
+#include <sstream>
+#include <string>
+#include <vector>
+
+#if defined(_WIN32)
+# include <windows.h>
+# include <psapi.h>
+# pragma comment(lib, "psapi.lib")
+#else
+# include <sys/resource.h>
+#endif
+
+namespace NetstimBenchmark
+{
+
+struct Options
+{
+  std::vector<std::string> Arguments; // positional arguments
+  std::string CSVFile;                // results are appended to this file
+  std::string TimeBaselineFile;       // rows of benchmark, case, seconds
+  double TimeTolerance = 0.5;         // allowed relative slow down
+  double CompareTolerance = -1;       // negative to skip comparing against the reference output
+};
+
+// Splits --csv, --timeBaseline, --timeTolerance and --compareTolerance from the positional arguments
+inline bool ParseOptions(int argc, char* argv[], Options& options)
+{
+  for (int i = 1; i < argc; i++)
+  {
+    std::string argument = argv[i];
+    if (argument.compare(0, 2, "--") != 0)
+    {
+      options.Arguments.push_back(argument);
+      continue;
+    }
+    if (i + 1 >= argc)
+    {
+      std::cerr << "Missing value of " << argument << std::endl;
+      return false;
+    }
+    std::string value = argv[++i];
+    if (argument == "--csv")
+    {
+      options.CSVFile = value;
+    }
+    else if (argument == "--timeBaseline")
+    {
+      options.TimeBaselineFile = value;
+    }
+    else if (argument == "--timeTolerance")
+    {
+      options.TimeTolerance = std::stod(value);
+    }
+    else if (argument == "--compareTolerance")
+    {
+      options.CompareTolerance = std::stod(value);
+    }
+    else
+    {
+      std::cerr << "Unknown option " << argument << std::endl;
+      return false;
+    }
+  }
+  return true;
+}
+
+// Peak resident set size of this process in MB
+inline double GetPeakMemoryMB()
+{
+#if defined(_WIN32)
+  PROCESS_MEMORY_COUNTERS counters;
+  if (!GetProcessMemoryInfo(GetCurrentProcess(), &counters, sizeof(counters)))
+  {
+    return 0;
+  }
+  return counters.PeakWorkingSetSize / (1024.0 * 1024.0);
+#else
+  struct rusage usage;
+  if (getrusage(RUSAGE_SELF, &usage) != 0)
+  {
+    return 0;
+  }
+# if defined(__APPLE__)
+  return usage.ru_maxrss / (1024.0 * 1024.0); // bytes
+# else
+  return usage.ru_maxrss / 1024.0; // KB
+# endif
+#endif
+}
+
+inline std::string Trim(const std::string& text)
+{
+  size_t begin = text.find_first_not_of(" \t\r\n");
+  size_t end = text.find_last_not_of(" \t\r\n");
+  return begin == std::string::npos ? "" : text.substr(begin, end - begin + 1);
+}
+
+// Prints the run time and peak memory of a case and appends them to the CSV file
+inline void Record(const Options& options, const std::string& benchmark, const std::string& caseName, double seconds)
+{
+  double peakMemory = GetPeakMemoryMB();
+  std::cout << "benchmark, case, seconds, peak memory (MB)" << std::endl;
+  std::cout << benchmark << ", " << caseName << ", " << seconds << ", " << peakMemory << std::endl;
+  if (options.CSVFile.empty())
+  {
+    return;
+  }
+  bool newFile = !std::ifstream(options.CSVFile.c_str()).good();
+  std::ofstream csv(options.CSVFile.c_str(), std::ios::out | std::ios::app);
+  if (newFile)
+  {
+    csv << "benchmark,case,seconds,peak memory (MB)" << std::endl;
+  }
+  csv << benchmark << "," << caseName << "," << seconds << "," << peakMemory << std::endl;
+}
+
+// Fails if the case is slower than its baseline by more than the time tolerance.
+// Cases without baseline pass.
+inline bool CheckTimeBaseline(const Options& options, const std::string& benchmark, const std::string& caseName, double seconds)
+{
+  if (options.TimeBaselineFile.empty())
+  {
+    return true;
+  }
+  std::ifstream baselines(options.TimeBaselineFile.c_str());
+  if (!baselines)
+  {
+    std::cerr << "Failed to read time baselines from " << options.TimeBaselineFile << std::endl;
+    return false;
+  }
+  std::string line;
+  while (std::getline(baselines, line))
+  {
+    std::vector<std::string> fields;
+    std::istringstream stream(line);
+    std::string field;
+    while (std::getline(stream, field, ','))
+    {
+      fields.push_back(Trim(field));
+    }
+    if (fields.size() < 3 || fields[0] != benchmark || fields[1] != caseName)
+    {
+      continue;
+    }
+    double baseline = std::stod(fields[2]);
+    if (seconds > baseline * (1 + options.TimeTolerance))
+    {
+      std::cerr << benchmark << " " << caseName << " took " << seconds << " s, more than the baseline of "
+                << baseline << " s with tolerance " << options.TimeTolerance << std::endl;
+      return false;
+    }
+    return true;
+  }
+  std::cout << "No time baseline for " << benchmark << " " << caseName << std::endl;
+  return true;
+}
+
+// Largest absolute difference between the components of two displacement fields,
+// or a negative value if a file cannot be read or the fields have different sizes.
+inline double GetMaximumDifference(const std::string& fileName1, const std::string& fileName2)
+{
+  typedef itk::Image<itk::Vector<float, 3>, 3> FieldType;
+  typedef itk::ImageFileReader<FieldType> ReaderType;
+  ReaderType::Pointer reader1 = ReaderType::New();
+  ReaderType::Pointer reader2 = ReaderType::New();
+  reader1->SetFileName(fileName1);
+  reader2->SetFileName(fileName2);
+  try
+  {
+    reader1->Update();
+    reader2->Update();
+  }
+  catch (itk::ExceptionObject& exception)
+  {
+    std::cerr << exception << std::endl;
+    return -1;
+  }
+  FieldType* field1 = reader1->GetOutput();
+  FieldType* field2 = reader2->GetOutput();
+  if (field1->GetLargestPossibleRegion().GetSize() != field2->GetLargestPossibleRegion().GetSize())
+  {
+    std::cerr << "Fields have different sizes" << std::endl;
+    return -1;
+  }
+
+  double maximumDifference = 0;
+  itk::ImageRegionConstIterator<FieldType> it1(field1, field1->GetLargestPossibleRegion());
+  itk::ImageRegionConstIterator<FieldType> it2(field2, field2->GetLargestPossibleRegion());
+  for (; !it1.IsAtEnd(); ++it1, ++it2)
+  {
+    for (unsigned int a = 0; a < 3; a++)
+    {
+      maximumDifference = std::max(maximumDifference, static_cast<double>(std::fabs(it1.Get()[a] - it2.Get()[a])));
+    }
+  }
+  return maximumDifference;
+}
+
+// Fails if the output differs from the reference by more than the compare tolerance
+inline bool CheckOutput(const Options& options, const std::string& outputFile, const std::string& referenceFile)
+{
+  double difference = GetMaximumDifference(outputFile, referenceFile);
+  std::cout << "Maximum difference to the reference: " << difference << std::endl;
+  if (difference < 0 || difference > options.CompareTolerance)
+  {
+    std::cerr << outputFile << " differs from " << referenceFile << " by more than " << options.CompareTolerance << std::endl;
+    return false;
+  }
+  return true;
+}
+
+} // end of namespace NetstimBenchmark
+
+#endif
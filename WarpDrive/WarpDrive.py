@@ -9,7 +9,7 @@ import json
 import numpy as np
 
 from WarpDriveLib.Tools import NoneTool, SmudgeTool, DrawTool, PointToPointTool, ShrinkExpandTool
-from WarpDriveLib.Helpers import GridNodeHelper, LeadDBSCall
+from WarpDriveLib.Helpers import GridNodeHelper, LeadDBSCall, RBFCache, RBFEngine, RecomputeScheduler, SmudgeHelper
 from WarpDriveLib.Widgets import Tables, Toolbar
 
 #
@@ -132,8 +132,11 @@ class WarpDriveWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     # so that when the scene is saved and reloaded, these settings are restored.
     self.logic = WarpDriveLogic()
 
+    # One warp computation at a time, outdated ones are cancelled
+    self.recomputeScheduler = RecomputeScheduler.RecomputeScheduler(self.onCalculateButton, lambda cliNode: cliNode.Cancel())
+
     # Connections
-    self.ui.calculateButton.connect('clicked(bool)', self.onCalculateButton)
+    self.ui.calculateButton.connect('clicked(bool)', lambda b: self.recomputeScheduler.request())
     self.ui.spacingSameAsInputCheckBox.toggled.connect(lambda b: self.ui.spacingSpinBox.setEnabled(not b))
 
     # These connections ensure that whenever user changes some settings on the GUI, that is saved in the MRML scene
@@ -363,9 +366,9 @@ class WarpDriveWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.ui.shrinkExpandButton.text = self._parameterNode.GetParameter("ShrinkExpandMode")
     self.ui.shrinkExpandAmmountSlider.value = float(self._parameterNode.GetParameter("ShrinkExpandAmmount"))
 
-    # calculate warp
-    if self._parameterNode.GetParameter("Update") == "true" and self._parameterNode.GetParameter("Running") == "false" and self.ui.autoUpdateCheckBox.checked:
-      self.ui.calculateButton.animateClick()
+    # calculate warp, superseding the running computation if any
+    if self._parameterNode.GetParameter("Update") == "true" and self.ui.autoUpdateCheckBox.checked:
+      qt.QTimer.singleShot(0, self.recomputeScheduler.request)
     
     # set update to false
     self._parameterNode.SetParameter("Update", "false")
@@ -424,6 +427,7 @@ class WarpDriveWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
   def onCalculateButton(self):
     """
     Run processing when user clicks "Apply" button.
+    Returns the running cli node, or None if the output was already set.
     """
     # cursor
     qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
@@ -436,7 +440,7 @@ class WarpDriveWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     size,origin,spacing,directionMatrix = GridNodeHelper.getGridDefinition(self._parameterNode.GetNodeReference("InputNode"))
     userSpacing = np.ones(3) * float(self._parameterNode.GetParameter("Spacing"))
     size = size * (spacing / userSpacing)
-    auxVolumeNode = GridNodeHelper.emptyVolume(size.astype(int), origin, userSpacing, directionMatrix)
+    outputGrid = (size.astype(int), origin, userSpacing, directionMatrix)
     # output
     outputNode = self._parameterNode.GetNodeReference("OutputGridTransform")
     # params
@@ -465,19 +469,21 @@ class WarpDriveWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     qt.QApplication.processEvents()
 
     self._parameterNode.SetParameter("Running", "true")
-    cliNode = self.logic.run(auxVolumeNode, outputNode, sourceFiducial, targetFiducial, RBFRadius, stiffness)
+    cliNode = self.logic.run(outputGrid, outputNode, sourceFiducial, targetFiducial, RBFRadius, stiffness)
 
     if cliNode is not None:
       # set up for UI
       self.ui.landwarpWidget.setCurrentCommandLineModuleNode(cliNode)
       # add observer
       cliNode.AddObserver(slicer.vtkMRMLCommandLineModuleNode.StatusModifiedEvent, \
-        lambda c,e,o=outputNode,v=visualizationNodes,a=auxVolumeNode,s=snapOptions: self.onStatusModifiedEvent(c,o,v,a,s))
+        lambda c,e,o=outputNode,v=visualizationNodes,s=snapOptions: self.onStatusModifiedEvent(c,o,v,s))
     else:
-      self.onStatusModifiedEvent(None,outputNode,visualizationNodes,auxVolumeNode,snapOptions)
+      self.onStatusModifiedEvent(None,outputNode,visualizationNodes,snapOptions)
+
+    return cliNode
 
   
-  def onStatusModifiedEvent(self, caller, outputNode, visualizationNodes, auxVolumeNode, snapOptions):
+  def onStatusModifiedEvent(self, caller, outputNode, visualizationNodes, snapOptions):
     
     if isinstance(caller, slicer.vtkMRMLCommandLineModuleNode):
       if caller.GetStatusString() == 'Completed':
@@ -485,6 +491,8 @@ class WarpDriveWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         qt.QTimer.singleShot(1000, lambda: slicer.mrmlScene.RemoveNode(caller))
         if snapOptions and snapOptions['AutoApply'] and not snapOptions['SnapRun']:
           qt.QTimer.singleShot(1000, lambda m=snapOptions['Mode'],s=snapOptions['SourceID'],t=snapOptions['TargetID'],f=self._parameterNode.GetNodeReferenceID("TargetFiducial"): self.logic.runSnap(m, s, t, f))
+      elif caller.GetStatus() in [caller.Cancelled, caller.CompletedWithErrors]:
+        qt.QTimer.singleShot(1000, lambda: slicer.mrmlScene.RemoveNode(caller))
       else:
         return
 
@@ -494,12 +502,14 @@ class WarpDriveWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     # remove aux
     for node in visualizationNodes:
       slicer.mrmlScene.RemoveNode(node)
-    slicer.mrmlScene.RemoveNode(auxVolumeNode)
 
     qt.QApplication.setOverrideCursor(qt.Qt.ArrowCursor)
 
     self._parameterNode.SetParameter("Running", "false")
 
+    # start the pending computation, if any
+    self.recomputeScheduler.jobFinished(caller)
+
 
 
 #
@@ -516,6 +526,12 @@ class WarpDriveLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  rbfCache = None
+  # problems needing fewer kernel evaluations are solved in-process instead of with the CLI
+  inProcessMaxCost = 2e7
+  # while the CLI runs, the output shows a field computed in-process with this times the output spacing
+  coarsePreviewFactor = 4
+
   def __init__(self):
     ScriptedLoadableModuleLogic.__init__(self)
     if slicer.util.settingsValue('Developer/DeveloperMode', False, converter=slicer.util.toBool):
@@ -562,33 +578,91 @@ class WarpDriveLogic(ScriptedLoadableModuleLogic):
     if not parameterNode.GetParameter("InverseMode"):
       parameterNode.SetParameter("InverseMode", "0")
 
-  def run(self, referenceVolume, outputNode, sourceFiducial, targetFiducial, RBFRadius, stiffness):
-
+  def run(self, outputGrid, outputNode, sourceFiducial, targetFiducial, RBFRadius, stiffness):
+    """
+    outputGrid is a (size, origin, spacing, directionMatrix) tuple as returned by GridNodeHelper.getGridDefinition
+    """
     # run landmark registration if points available
     if RBFRadius != "":
-      cliNode = self.computeWarp(referenceVolume, outputNode, sourceFiducial, targetFiducial, RBFRadius, stiffness)
+      cliNode = self.computeWarp(outputGrid, outputNode, sourceFiducial, targetFiducial, RBFRadius, stiffness)
     else:
-      size, origin, spacing, directionMatrix = GridNodeHelper.getGridDefinition(referenceVolume)
+      size, origin, spacing, directionMatrix = outputGrid
       GridNodeHelper.emptyGridTransform(size, origin, spacing, directionMatrix, outputNode)
       return
     return cliNode
 
-  def computeWarp(self, referenceVolume, outputNode, sourceFiducial, targetFiducial, RBFRadius, stiffness, wait_for_completion=False):
+  def computeWarp(self, outputGrid, outputNode, sourceFiducial, targetFiducial, RBFRadius, stiffness, wait_for_completion=False, preview=True):
+    """
+    Returns the cli node, or None if the result was found in the cache or computed in-process and set to outputNode.
+    If preview, a coarse field is set to outputNode while the cli runs.
+    """
+    # Reuse the result of a previous run with the same inputs
+    size, origin, spacing, directionMatrix = outputGrid
+    sourcePoints = self.getSelectedControlPointPositions(sourceFiducial)
+    targetPoints = self.getSelectedControlPointPositions(targetFiducial)
+    radius = [float(r) for r in RBFRadius.split(",")]
+    arrayGrid = (size, origin, spacing, slicer.util.arrayFromVTKMatrix(directionMatrix)[:3,:3])
+    cacheKey = RBFCache.computeKey(sourcePoints, targetPoints, radius, stiffness, arrayGrid)
+    cache = self.getRBFCache()
+    field = cache.get(cacheKey)
+    if field is not None:
+      self.setOutputField(outputGrid, outputNode, field)
+      return None
+
+    # Small problems are solved in-process, without temporary files and CLI launch
+    if RBFEngine.evaluationCost(targetPoints, radius, arrayGrid) <= self.inProcessMaxCost:
+      field = RBFEngine.computeField(sourcePoints, targetPoints, radius, stiffness, arrayGrid)
+      self.setOutputField(outputGrid, outputNode, field)
+      cache.put(cacheKey, field)
+      return None
+
+    # Coarse preview, replaced by the CLI output when it completes
+    if preview and self.coarsePreviewFactor > 1 and not wait_for_completion:
+      coarseGrid = GridNodeHelper.getCoarseGridDefinition(*outputGrid, self.coarsePreviewFactor)
+      coarseArrayGrid = coarseGrid[:3] + arrayGrid[3:]
+      if RBFEngine.evaluationCost(targetPoints, radius, coarseArrayGrid) <= self.inProcessMaxCost:
+        self.setOutputField(coarseGrid, outputNode, RBFEngine.computeField(sourcePoints, targetPoints, radius, stiffness, coarseArrayGrid))
 
     # Compute the warp with FiducialRegistrationVariableRBF
     cliParams = {
-      "referenceVolume" : referenceVolume.GetID(),
       "fixedFiducials" : targetFiducial.GetID(),
       "movingFiducials" : sourceFiducial.GetID(),
       "outputDisplacementField" : outputNode.GetID(),
       "RBFRadius" : RBFRadius,
       "stiffness" : stiffness,
       } 
+    # pass the output grid geometry instead of a reference volume
+    cliParams.update(GridNodeHelper.getGridDefinitionAsCLIParameters(*outputGrid))
 
     cliNode = slicer.cli.run(slicer.modules.fiducialregistrationvariablerbf, None, cliParams, wait_for_completion, update_display=False)
 
+    storeResult = lambda c: cache.put(cacheKey, slicer.util.arrayFromGridTransform(outputNode).copy()) if c.GetStatus() == c.Completed else None
+    if wait_for_completion:
+      storeResult(cliNode)
+    else:
+      cliNode.AddObserver(slicer.vtkMRMLCommandLineModuleNode.StatusModifiedEvent, lambda c,e: storeResult(c))
+
     return cliNode
 
+  @staticmethod
+  def setOutputField(outputGrid, outputNode, field):
+    size, origin, spacing, directionMatrix = outputGrid
+    GridNodeHelper.emptyGridTransform(size, origin, spacing, directionMatrix, outputNode)
+    slicer.util.arrayFromGridTransform(outputNode)[:] = field
+    slicer.util.arrayFromGridTransformModified(outputNode)
+
+  @classmethod
+  def getRBFCache(cls):
+    if cls.rbfCache is None:
+      diskCacheSize = slicer.util.settingsValue("NetstimPreferences/warpDriveDiskCacheSize", 0, converter=int) # MB
+      cls.rbfCache = RBFCache.RBFCache(diskPath=os.path.join(slicer.app.temporaryPath, "WarpDriveCache"), maxDiskBytes=diskCacheSize * 1024 * 1024)
+    return cls.rbfCache
+
+  @staticmethod
+  def getSelectedControlPointPositions(fiducialNode):
+    positions = [fiducialNode.GetNthControlPointPosition(i) for i in range(fiducialNode.GetNumberOfControlPoints()) if fiducialNode.GetNthControlPointSelected(i)]
+    return np.array(positions).reshape(-1,3)
+
   def previewWarp(self, source, target):
     if isinstance(source, slicer.vtkMRMLMarkupsFiducialNode) and isinstance(target, slicer.vtkMRMLMarkupsFiducialNode):
       sourcePoints = vtk.vtkPoints()
@@ -772,6 +846,19 @@ class WarpDriveTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_WarpDrive1()
+    self.test_RBFCache()
+    self.test_LandmarkDecimation()
+    self.test_LandmarkResampling()
+    self.test_BulkControlPoints()
+    self.test_RBFEngine()
+    self.test_CoarsePreview()
+    self.test_RecomputeScheduler()
+    self.test_AsyncPreviousCorrections()
+    self.test_QueuedPreviousCorrections()
+    self.test_SmudgeHelper()
+    self.test_SmudgeBorder()
+    self.test_SmudgeTiledGrid()
+    self.test_SmudgeDragBenchmark()
 
   def test_WarpDrive1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -803,3 +890,547 @@ class WarpDriveTest(ScriptedLoadableModuleTest):
     parameterNode.EndModify(wasModified)
 
     self.delayDisplay('Test passed')
+
+  def test_RBFCache(self):
+    """ Hits, misses and eviction of the RBF result cache.
+    """
+    import tempfile
+    from WarpDriveLib.Helpers import RBFCache
+
+    grid = (np.array([10,10,10]), np.zeros(3), np.ones(3), np.eye(3))
+    points = np.random.rand(5,3)
+    key = RBFCache.computeKey(points, points + 1, [15]*5, 0.1, grid)
+    self.assertEqual(key, RBFCache.computeKey(points.copy(), points + 1, [15]*5, 0.1, grid))
+    self.assertNotEqual(key, RBFCache.computeKey(points, points + 1, [15]*5, 0.2, grid))
+    self.assertNotEqual(key, RBFCache.computeKey(points, points + 1, [15]*4 + [16], 0.1, grid))
+
+    fields = [np.full((10,10,10,3), i, dtype=np.float32) for i in range(4)]
+
+    with tempfile.TemporaryDirectory() as diskPath:
+      cache = RBFCache.RBFCache(maxMemoryBytes=2 * fields[0].nbytes, diskPath=diskPath, maxDiskBytes=int(1.5 * fields[0].nbytes) + 1024)
+      self.assertIsNone(cache.get('0'))
+      for i,field in enumerate(fields):
+        cache.put(str(i), field)
+      # last two in memory, only the most recently evicted on disk
+      self.assertEqual(list(cache.memory.keys()), ['2','3'])
+      self.assertEqual(len(os.listdir(diskPath)), 1)
+      self.assertIsNone(cache.get('0'))
+      np.testing.assert_array_equal(cache.get('1'), fields[1])
+      self.assertEqual(list(cache.memory.keys()), ['3','1'])
+
+    cache = RBFCache.RBFCache(maxMemoryBytes=fields[0].nbytes)
+    cache.put('0', fields[0])
+    cache.put('1', fields[1])
+    self.assertIsNone(cache.get('0'))
+    np.testing.assert_array_equal(cache.get('1'), fields[1])
+    # a field larger than the memory bound is not kept
+    cache.put('2', np.zeros((20,10,10,3), dtype=np.float32))
+    self.assertEqual(len(cache.memory), 0)
+    self.assertEqual(cache.memoryBytes, 0)
+
+  def test_LandmarkDecimation(self):
+    """ Merging of near-duplicate landmark pairs.
+    """
+    from WarpDriveLib.Helpers import LandmarkHelper
+
+    radius = 10
+    tolerance = 0.5
+    # dense stroke with a slowly varying displacement, plus an isolated pair
+    target = np.zeros((101,3))
+    target[:100,0] = np.linspace(0, 20, 100)
+    target[100] = [100, 0, 0]
+    source = target.copy()
+    source[:100,1] = np.linspace(2, 3, 100)
+    source[100,1] = 5
+
+    decimatedSource, decimatedTarget = LandmarkHelper.decimateLandmarks(source, target, radius, displacementTolerance=tolerance)
+    self.assertLess(len(decimatedTarget), 20)
+    self.assertGreater(len(decimatedTarget), 2)
+    # isolated pair is kept as is
+    self.assertTrue(np.any(np.all(decimatedTarget == target[100], axis=1)))
+    # every original pair is represented by a merged one within the tolerance
+    for s,t in zip(source, target):
+      closest = np.argmin(np.linalg.norm(decimatedTarget - t, axis=1))
+      self.assertLessEqual(np.linalg.norm(t - decimatedTarget[closest]), radius)
+      self.assertLessEqual(np.linalg.norm((s - t) - (decimatedSource[closest] - decimatedTarget[closest])), tolerance)
+
+  def test_LandmarkResampling(self):
+    """ Resampling of strokes, without scene nodes.
+    """
+    from WarpDriveLib.Helpers import LandmarkHelper
+
+    # L shaped stroke of length 10, with a repeated point
+    stroke = np.array([[0.,0,0],[3,0,0],[3,0,0],[6,0,0],[6,4,0]])
+    points = LandmarkHelper.resamplePolyline(stroke, sampleDistance=1)
+    self.assertEqual(len(points), 11)
+    np.testing.assert_allclose(points[[0,-1]], stroke[[0,-1]])
+    np.testing.assert_allclose(points[:7,0], np.arange(7))
+    np.testing.assert_allclose(points[7:,1], np.arange(1,5))
+    np.testing.assert_allclose(LandmarkHelper.resamplePolyline(stroke, numberOfPoints=3), [[0,0,0],[5,0,0],[6,4,0]])
+    # a click is a single point
+    self.assertEqual(len(LandmarkHelper.resamplePolyline([[1.,2,3],[1,2,3]])), 1)
+
+  def test_BulkControlPoints(self):
+    """ A correction of several hundred points notifies the observers of the fiducial node once.
+    """
+    from WarpDriveLib.Helpers import MarkupsHelper
+
+    points = np.random.RandomState(0).uniform(-50, 50, (300,3))
+    fiducialNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
+    events = [fiducialNode.PointAddedEvent, fiducialNode.PointModifiedEvent, fiducialNode.PointPositionDefinedEvent]
+    counts = {event: 0 for event in events}
+    def countEvent(caller, event, eventId):
+      counts[eventId] += 1
+    observers = [fiducialNode.AddObserver(event, lambda c,e,i=event: countEvent(c,e,i)) for event in events]
+
+    # one point at a time, as before
+    for point in points:
+      fiducialNode.AddControlPoint(vtk.vtkVector3d(point), 'correction')
+      fiducialNode.SetNthControlPointDescription(fiducialNode.GetNumberOfControlPoints()-1, '15')
+    self.assertGreaterEqual(counts[fiducialNode.PointAddedEvent], len(points))
+    logging.info('WarpDrive: %d point events adding %d control points one at a time' % (sum(counts.values()), len(points)))
+
+    fiducialNode.RemoveAllControlPoints()
+    counts = {event: 0 for event in events}
+    self.assertEqual(MarkupsHelper.addControlPoints(fiducialNode, points, 'correction', '15'), 0)
+    for event in events:
+      self.assertLessEqual(counts[event], 1)
+    self.assertEqual(counts[fiducialNode.PointAddedEvent], 1)
+    np.testing.assert_allclose(slicer.util.arrayFromMarkupsControlPoints(fiducialNode), points)
+    self.assertEqual(fiducialNode.GetNthControlPointLabel(299), 'correction')
+    self.assertEqual(fiducialNode.GetNthControlPointDescription(299), '15')
+
+    for observer in observers:
+      fiducialNode.RemoveObserver(observer)
+
+  def test_RBFEngine(self):
+    """ In-process RBF against the FiducialRegistrationVariableRBF CLI.
+    """
+    from WarpDriveLib.Helpers import RBFEngine
+
+    direction = np.array([[0.8,-0.6,0],[0.6,0.8,0],[0,0,1]])
+    outputGrid = (np.array([30,25,20]), np.array([-20.,-15.,-10.]), np.array([2.,2.,2.]), direction)
+    size, origin, spacing, direction = outputGrid
+    indices = np.array([[5,5,5],[20,10,8],[12,18,15]])
+    targetPoints = origin + indices.dot((direction * spacing).T)
+    sourcePoints = targetPoints + np.array([[2,0,0],[0,-1.5,1],[1,1,1]])
+    radius = [8, 6, 10]
+
+    # without regularization the field interpolates the landmarks
+    field = RBFEngine.computeField(sourcePoints, targetPoints, radius, 0, outputGrid)
+    for (i,j,k), source, target in zip(indices, sourcePoints, targetPoints):
+      np.testing.assert_allclose(field[k,j,i], source - target, atol=0.01)
+
+    # truncated kernels only omit negligible contributions
+    coefficients = RBFEngine.findCoefficients(sourcePoints, targetPoints, radius, 0.1)
+    np.testing.assert_allclose(RBFEngine.evaluateField(coefficients, targetPoints, radius, outputGrid),
+                               RBFEngine.evaluateField(coefficients, targetPoints, radius, outputGrid, kernelTruncation=0), atol=1e-5)
+    self.assertLess(RBFEngine.evaluationCost(targetPoints, radius, outputGrid, 1), np.prod(size) * len(radius))
+    # many landmarks are solved with the CLI even if their kernels cover few voxels
+    manyPoints = origin + np.random.rand(300,3) * 0.1
+    self.assertGreater(RBFEngine.evaluationCost(manyPoints, 0.1, outputGrid), WarpDriveLogic.inProcessMaxCost)
+
+    # same field as the CLI
+    sourceFiducial = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
+    targetFiducial = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
+    slicer.util.updateMarkupsControlPointsFromArray(sourceFiducial, sourcePoints)
+    slicer.util.updateMarkupsControlPointsFromArray(targetFiducial, targetPoints)
+    directionMatrix = vtk.vtkMatrix4x4()
+    for row in range(3):
+      for col in range(3):
+        directionMatrix.SetElement(row, col, direction[row,col])
+    outputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLGridTransformNode')
+    cliParams = {
+      "fixedFiducials" : targetFiducial.GetID(),
+      "movingFiducials" : sourceFiducial.GetID(),
+      "outputDisplacementField" : outputNode.GetID(),
+      "RBFRadius" : ",".join(str(r) for r in radius),
+      "stiffness" : 0.1,
+      }
+    cliParams.update(GridNodeHelper.getGridDefinitionAsCLIParameters(size, origin, spacing, directionMatrix))
+    cliNode = slicer.cli.run(slicer.modules.fiducialregistrationvariablerbf, None, cliParams, wait_for_completion=True, update_display=False)
+    self.assertEqual(cliNode.GetStatusString(), 'Completed')
+    np.testing.assert_allclose(slicer.util.arrayFromGridTransform(outputNode),
+                               RBFEngine.computeField(sourcePoints, targetPoints, radius, 0.1, outputGrid), atol=0.01)
+
+  def test_CoarsePreview(self):
+    """ Coarse field shown while the CLI computes the full resolution one.
+    """
+    import WarpDrive
+    logic = WarpDrive.WarpDriveLogic()
+    logic.rbfCache = RBFCache.RBFCache(maxMemoryBytes=0)
+
+    sourceFiducial = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
+    targetFiducial = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
+    slicer.util.updateMarkupsControlPointsFromArray(sourceFiducial, np.array([[2.,0,0],[10,12,3]]))
+    slicer.util.updateMarkupsControlPointsFromArray(targetFiducial, np.array([[0.,0,0],[10,10,0]]))
+    outputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLGridTransformNode')
+    outputGrid = (np.array([61,61,41]), np.array([-60.,-60.,-40.]), np.array([2.,2.,2.]), vtk.vtkMatrix4x4())
+
+    # force the full resolution field to the CLI
+    size, origin, spacing, directionMatrix = outputGrid
+    fullCost = RBFEngine.evaluationCost(np.array([[0.,0,0],[10,10,0]]), [15,15], (size, origin, spacing, np.eye(3)))
+    logic.inProcessMaxCost = fullCost - 1
+    cliNode = logic.computeWarp(outputGrid, outputNode, sourceFiducial, targetFiducial, "15,15", 0.1)
+    self.assertIsNotNone(cliNode)
+    np.testing.assert_array_equal(GridNodeHelper.getGridDefinition(outputNode)[0], [16,16,11])
+    self.assertGreater(np.abs(slicer.util.arrayFromGridTransform(outputNode)).max(), 1)
+
+    while cliNode.IsBusy():
+      slicer.app.processEvents()
+      qt.QThread.msleep(50)
+    self.assertEqual(cliNode.GetStatusString(), 'Completed')
+    np.testing.assert_array_equal(GridNodeHelper.getGridDefinition(outputNode)[0], size)
+
+  def test_RecomputeScheduler(self):
+    """ At most one running and one pending job, with a fake job runner.
+    """
+    from WarpDriveLib.Helpers import RecomputeScheduler
+
+    started = []
+    cancelled = []
+    def startJob():
+      started.append('job%d' % len(started))
+      return started[-1]
+    scheduler = RecomputeScheduler.RecomputeScheduler(startJob, cancelled.append)
+
+    scheduler.request()
+    self.assertEqual(started, ['job0'])
+    self.assertTrue(scheduler.isBusy())
+
+    # requests while running cancel the running job once and coalesce in one pending job
+    for i in range(3):
+      scheduler.request()
+    self.assertEqual(started, ['job0'])
+    self.assertEqual(cancelled, ['job0'])
+
+    # finishing notifications of other jobs are ignored
+    scheduler.jobFinished('other')
+    scheduler.jobFinished(None)
+    self.assertEqual(started, ['job0'])
+
+    # the pending job starts when the running one finishes
+    scheduler.jobFinished('job0')
+    self.assertEqual(started, ['job0', 'job1'])
+    scheduler.jobFinished('job1')
+    self.assertFalse(scheduler.isBusy())
+    self.assertEqual(cancelled, ['job0'])
+
+    # jobs completing synchronously leave the scheduler idle
+    scheduler = RecomputeScheduler.RecomputeScheduler(lambda: None, cancelled.append)
+    scheduler.request()
+    self.assertFalse(scheduler.isBusy())
+
+    # requests made while a job is starting (e.g. from processed events) do not start another one
+    started = []
+    cancelled = []
+    def startJobProcessingEvents():
+      if not started:
+        scheduler.request()
+        scheduler.request()
+      return startJob()
+    scheduler = RecomputeScheduler.RecomputeScheduler(startJobProcessingEvents, cancelled.append)
+    scheduler.request()
+    self.assertEqual(started, ['job0'])
+    self.assertEqual(cancelled, ['job0'])
+    scheduler.jobFinished('job0')
+    self.assertEqual(started, ['job0', 'job1'])
+
+    # runners that finish the job while cancelling it start the pending one right away
+    started = []
+    scheduler = RecomputeScheduler.RecomputeScheduler(startJob, lambda job: scheduler.jobFinished(job))
+    scheduler.request()
+    scheduler.request()
+    self.assertEqual(started, ['job0', 'job1'])
+    self.assertTrue(scheduler.isBusy())
+
+  def test_AsyncPreviousCorrections(self):
+    """ Previous corrections are modified without blocking the GUI for the whole solve.
+    """
+    import WarpDrive
+    import time
+    from WarpDriveLib.Effects.PointerEffect import AbstractPointerEffect
+
+    parameterNode = WarpDrive.WarpDriveLogic().getParameterNode()
+    inputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLGridTransformNode')
+    GridNodeHelper.emptyGridTransform(np.array([81,81,61]), np.array([-80.,-80.,-60.]), np.array([2.,2.,2.]), vtk.vtkMatrix4x4(), inputNode)
+    previousTargetFiducial = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
+    previousPoints = np.array([[1.,0,0],[40,40,20]])
+    slicer.util.updateMarkupsControlPointsFromArray(previousTargetFiducial, previousPoints)
+    wasModified = parameterNode.StartModify()
+    parameterNode.SetNodeReferenceID("InputNode", inputNode.GetID())
+    parameterNode.SetNodeReferenceID("TargetFiducial", previousTargetFiducial.GetID())
+    parameterNode.SetParameter("Spacing", "2")
+    parameterNode.SetParameter("Radius", "15")
+    parameterNode.SetParameter("Stiffness", "0.1")
+    parameterNode.EndModify(wasModified)
+
+    sourceFiducial = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
+    targetFiducial = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
+    slicer.util.updateMarkupsControlPointsFromArray(sourceFiducial, np.array([[5.,0,0]]))
+    slicer.util.updateMarkupsControlPointsFromArray(targetFiducial, np.array([[0.,0,0]]))
+
+    # force the solve to the CLI, as before with wait_for_completion
+    inProcessMaxCost = WarpDrive.WarpDriveLogic.inProcessMaxCost
+    WarpDrive.WarpDriveLogic.inProcessMaxCost = 0
+    WarpDrive.WarpDriveLogic.rbfCache = RBFCache.RBFCache(maxMemoryBytes=0)
+    try:
+      startTime = time.perf_counter()
+      AbstractPointerEffect.modifyPreviousCorrections(sourceFiducial, targetFiducial)
+      stall = time.perf_counter() - startTime
+      self.assertTrue(AbstractPointerEffect.getPreviousCorrectionsScheduler().isBusy())
+      np.testing.assert_array_equal(slicer.util.arrayFromMarkupsControlPoints(previousTargetFiducial), previousPoints)
+
+      # a second drag while solving is applied once the first completes
+      AbstractPointerEffect.modifyPreviousCorrections(sourceFiducial, targetFiducial)
+      while AbstractPointerEffect.getPreviousCorrectionsScheduler().isBusy():
+        slicer.app.processEvents()
+        qt.QThread.msleep(50)
+      solve = time.perf_counter() - startTime
+      logging.info('WarpDrive: GUI blocked %.3f s of the %.3f s update' % (stall, solve))
+    finally:
+      WarpDrive.WarpDriveLogic.inProcessMaxCost = inProcessMaxCost
+      WarpDrive.WarpDriveLogic.rbfCache = None
+
+    modifiedPoints = slicer.util.arrayFromMarkupsControlPoints(previousTargetFiducial)
+    # the landmark near the correction is moved twice (about 4 mm each), the far one stays
+    self.assertGreater(modifiedPoints[0,0], 7)
+    np.testing.assert_allclose(modifiedPoints[1], previousPoints[1], atol=0.01)
+    self.assertEqual(parameterNode.GetParameter("Update"), "true")
+
+  def test_QueuedPreviousCorrections(self):
+    """ Drags queued while previous corrections are updated give the same landmarks as updating them one after the other.
+    """
+    import WarpDrive
+    from WarpDriveLib.Effects.PointerEffect import AbstractPointerEffect
+    from WarpDriveLib.Helpers import MarkupsHelper
+
+    parameterNode = WarpDrive.WarpDriveLogic().getParameterNode()
+    inputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLGridTransformNode')
+    GridNodeHelper.emptyGridTransform(np.array([81,81,61]), np.array([-80.,-80.,-60.]), np.array([2.,2.,2.]), vtk.vtkMatrix4x4(), inputNode)
+    wasModified = parameterNode.StartModify()
+    parameterNode.SetNodeReferenceID("InputNode", inputNode.GetID())
+    parameterNode.SetParameter("Spacing", "2")
+    parameterNode.SetParameter("Radius", "15")
+    parameterNode.SetParameter("Stiffness", "0.1")
+    parameterNode.EndModify(wasModified)
+
+    previousPoints = np.array([[1.,0,0],[8,2,0],[40,40,20]])
+    # the second drag is near the target of the first
+    corrections = [(np.array([[5.,0,0]]), np.array([[0.,0,0]])), (np.array([[4.,3,0]]), np.array([[0.,3,0]]))]
+    correctionNodes = []
+    for sourcePoints, targetPoints in corrections:
+      sourceFiducial = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
+      targetFiducial = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
+      slicer.util.updateMarkupsControlPointsFromArray(sourceFiducial, sourcePoints)
+      slicer.util.updateMarkupsControlPointsFromArray(targetFiducial, targetPoints)
+      correctionNodes.append((sourceFiducial, targetFiducial))
+
+    def waitForUpdates():
+      while AbstractPointerEffect.getPreviousCorrectionsScheduler().isBusy():
+        slicer.app.processEvents()
+        qt.QThread.msleep(50)
+
+    def applyCorrections(queued):
+      previousTargetFiducial = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
+      slicer.util.updateMarkupsControlPointsFromArray(previousTargetFiducial, previousPoints)
+      parameterNode.SetNodeReferenceID("TargetFiducial", previousTargetFiducial.GetID())
+      for (sourceFiducial, targetFiducial), (sourcePoints, targetPoints) in zip(correctionNodes, corrections):
+        self.assertTrue(AbstractPointerEffect.modifyPreviousCorrections(sourceFiducial, targetFiducial))
+        if queued:
+          self.assertTrue(AbstractPointerEffect.getPreviousCorrectionsScheduler().isBusy())
+        else:
+          waitForUpdates()
+        # as setFiducialNodeAs, the target of the correction becomes a previous target
+        MarkupsHelper.addControlPoints(previousTargetFiducial, targetPoints)
+      waitForUpdates()
+      return slicer.util.arrayFromMarkupsControlPoints(previousTargetFiducial)
+
+    # force the solve to the CLI, so that the second drag is queued while the first is solved
+    inProcessMaxCost = WarpDrive.WarpDriveLogic.inProcessMaxCost
+    WarpDrive.WarpDriveLogic.inProcessMaxCost = 0
+    WarpDrive.WarpDriveLogic.rbfCache = RBFCache.RBFCache(maxMemoryBytes=0)
+    try:
+      sequentialPoints = applyCorrections(queued=False)
+      queuedPoints = applyCorrections(queued=True)
+    finally:
+      WarpDrive.WarpDriveLogic.inProcessMaxCost = inProcessMaxCost
+      WarpDrive.WarpDriveLogic.rbfCache = None
+
+    # the target of the first drag is only moved by the second
+    self.assertGreater(np.linalg.norm(sequentialPoints[3] - corrections[0][1][0]), 1)
+    np.testing.assert_allclose(queuedPoints, sequentialPoints, atol=1e-3)
+    self.assertEqual(len(AbstractPointerEffect.pendingPreviousCorrections), 0)
+
+  def test_SmudgeHelper(self):
+    """ In-place kernel addition, against the smudge of the dense stacked sphere.
+    """
+    r = 4
+    xx, yy, zz = np.mgrid[:2*r+1, :2*r+1, :2*r+1]
+    sphere = np.exp(-0.5 * (((xx-r)/(0.5*r)) ** 2 + ((yy-r)/(0.5*r)) ** 2 + ((zz-r)/(0.5*r)) ** 2))
+    kernel = SmudgeHelper.getKernel(r)
+    np.testing.assert_allclose(kernel, sphere, rtol=1e-6)
+    self.assertIs(SmudgeHelper.getKernel(r), kernel)
+    self.assertFalse(kernel.flags.writeable)
+
+    array = np.zeros((20,25,30,3), dtype=np.float32)
+    expected = np.zeros(array.shape, dtype=np.float32)
+    displacement = np.array([1.,-2.,0.5])
+    box = SmudgeHelper.addKernel(array, (10.3,12,8.6,1), kernel, displacement)
+    expected[5:14, 8:17, 6:15] += np.stack([sphere * d for d in displacement], 3)
+    np.testing.assert_allclose(array, expected, atol=1e-6)
+    np.testing.assert_array_equal(box[0], [6,8,5])
+    np.testing.assert_array_equal(box[1], [15,17,14])
+
+    # with one voxel tiles, the bounds of the tiled grid are those of the added kernels
+    tiledGrid = SmudgeHelper.TiledGrid(array.shape[2::-1], tileSize=1)
+    tiledGrid.addKernel((10.3,12,8.6,1), kernel, displacement)
+    tiledGrid.addKernel((20,12,10), kernel, displacement)
+    lower, upper = tiledGrid.getBounds()
+    np.testing.assert_array_equal(lower, [6,8,5])
+    np.testing.assert_array_equal(upper, [25,17,15])
+    tiledGrid.clear()
+    self.assertIsNone(tiledGrid.getBounds())
+
+  def test_SmudgeBorder(self):
+    """ Smudges across every face of a small grid are clipped instead of failing.
+    """
+    r = 3
+    kernel = SmudgeHelper.getKernel(r)
+    size = np.array([10,12,14])
+    center = size // 2
+    for axis in range(3):
+      for side in [-1, 1]:
+        array = np.zeros(tuple(size[::-1]) + (3,), dtype=np.float32)
+        displacement = np.zeros(3)
+        displacement[axis] = side
+        tiledGrid = SmudgeHelper.TiledGrid(size, tileSize=1)
+        # stroke from the center to beyond the face, along the axis
+        for step in range(size[axis]):
+          point = center.copy()
+          point[axis] += side * step
+          SmudgeHelper.addKernel(array, point, kernel, displacement)
+          tiledGrid.addKernel(point, kernel, displacement)
+        expectedLower, expectedUpper = center - r, center + r + 1
+        if side < 0:
+          expectedLower[axis] = 0
+        else:
+          expectedUpper[axis] = size[axis]
+        lower, upper = tiledGrid.getBounds()
+        np.testing.assert_array_equal(lower, expectedLower)
+        np.testing.assert_array_equal(upper, expectedUpper)
+        np.testing.assert_allclose(tiledGrid.toDense(), array, atol=1e-6)
+        # the face voxels are displaced, only along the stroke direction
+        face = np.take(array, 0 if side < 0 else size[axis] - 1, axis=2-axis)
+        self.assertGreater((side * face[..., axis]).max(), 0.9)
+        self.assertFalse(np.delete(array, axis, axis=3).any())
+        # the kernel centered outside the grid is dropped
+        outside = center.copy()
+        outside[axis] = -r - 1 if side < 0 else size[axis] + r
+        self.assertIsNone(SmudgeHelper.addKernel(array, outside, kernel, displacement))
+
+  def test_SmudgeTiledGrid(self):
+    """ Sparse tiled grid against the dense one, including kernels across the border.
+    """
+    size = np.array([50,60,70])
+    tiledGrid = SmudgeHelper.TiledGrid(size, tileSize=16)
+    array = np.zeros(tuple(size[::-1]) + (3,), dtype=np.float32)
+    self.assertIsNone(tiledGrid.getDisplayBox())
+    kernel = SmudgeHelper.getKernel(4)
+    random = np.random.RandomState(0)
+    displayBox = None
+    for i in range(30):
+      center = random.uniform(-5, 25, 3)
+      displacement = random.normal(size=3)
+      box = tiledGrid.addKernel(center, kernel, displacement)
+      denseBox = SmudgeHelper.addKernel(array, center, kernel, displacement)
+      np.testing.assert_array_equal(box, denseBox)
+      # the display covers the allocated tiles with zeros around them
+      displayBox = tiledGrid.getDisplayBox(displayBox)
+      lower, upper = displayBox
+      display = tiledGrid.toDense(displayBox)
+      np.testing.assert_allclose(display, array[lower[2]:upper[2], lower[1]:upper[1], lower[0]:upper[0]], atol=1e-6)
+      outside = array.copy()
+      outside[lower[2]:upper[2], lower[1]:upper[1], lower[0]:upper[0]] = 0
+      self.assertFalse(outside.any())
+    np.testing.assert_allclose(tiledGrid.toDense(), array, atol=1e-6)
+    # tiles are only allocated near the corner the kernels were added to
+    self.assertLess(tiledGrid.getAllocatedBytes(), array.nbytes / 2)
+    tiledGrid.clear()
+    self.assertEqual(tiledGrid.getAllocatedBytes(), 0)
+
+  def test_SmudgeDragBenchmark(self):
+    """ Scripted drag over a full-brain grid shown in the slice views. Compares the dense grid updated on every move,
+    cached kernels added in place with the views updated at most SmudgeToolEffect.maxFrameRate times per second,
+    and the same with the sparse tiled grid of SmudgeToolEffect.
+    """
+    import time
+    from WarpDriveLib.Tools.SmudgeTool import SmudgeToolEffect
+
+    # 1 mm grid over the MNI brain, warping a volume shown in the slice views
+    size, origin, spacing = np.array([181,217,181]), np.array([-90.,-126.,-72.]), np.ones(3)
+    auxTransformNode = GridNodeHelper.emptyGridTransform(size, origin, spacing)
+    volumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode')
+    volumeNode.SetOrigin(origin)
+    slicer.util.updateVolumeFromArray(volumeNode, np.random.rand(*size[::-1]).astype(np.float32))
+    slicer.util.setSliceViewerLayers(background=volumeNode, fit=True)
+    array = slicer.util.arrayFromGridTransform(auxTransformNode)
+    r = 10
+    moves = [np.array([0., 20.-i, 10.+0.2*i]) for i in range(100)]
+
+    def render():
+      for sliceViewName in slicer.app.layoutManager().sliceViewNames():
+        slicer.app.layoutManager().sliceWidget(sliceViewName).sliceView().forceRender()
+
+    def drag(smudge, throttle, transformNode):
+      volumeNode.SetAndObserveTransformNodeID(transformNode.GetID())
+      times = []
+      frames = 0
+      lastFrame = 0
+      for previousPoint, currentPoint in zip(moves[:-1], moves[1:]):
+        startTime = time.perf_counter()
+        smudge(previousPoint, currentPoint)
+        if not throttle or startTime - lastFrame >= 1. / SmudgeToolEffect.maxFrameRate:
+          transformNode.Modified()
+          render()
+          frames += 1
+          lastFrame = startTime
+        times.append(time.perf_counter() - startTime)
+      return np.array(times), frames
+
+    def denseSmudge(previousPoint, currentPoint):
+      xx, yy, zz = np.mgrid[:2*r+1, :2*r+1, :2*r+1]
+      v = 0.5*r
+      sphere = np.exp(-0.5 * (((xx-r)/v) ** 2 + ((yy-r)/v) ** 2 + ((zz-r)/v) ** 2))
+      i, j, k = np.round(currentPoint - origin).astype(int)
+      array[k-r:k+r+1, j-r:j+r+1, i-r:i+r+1] += np.stack([sphere * d for d in (previousPoint - currentPoint)], 3)
+
+    def incrementalSmudge(previousPoint, currentPoint):
+      SmudgeHelper.addKernel(array, currentPoint - origin, SmudgeHelper.getKernel(r), previousPoint - currentPoint)
+
+    # tiles shown through a dense transform over the allocated ones, as in SmudgeToolEffect
+    tiledGrid = SmudgeHelper.TiledGrid(size)
+    displayNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLGridTransformNode')
+    display = {'box': None}
+    def tiledSmudge(previousPoint, currentPoint):
+      box = tiledGrid.addKernel(currentPoint - origin, SmudgeHelper.getKernel(r), previousPoint - currentPoint)
+      displayBox = tiledGrid.getDisplayBox(display['box'])
+      if displayBox is not display['box']:
+        GridNodeHelper.emptyGridTransform(displayBox[1] - displayBox[0], origin + displayBox[0] * spacing, spacing, None, displayNode)
+        display['box'] = displayBox
+        box = tiledGrid.getBounds()
+      tiledGrid.copyTo(slicer.util.arrayFromGridTransform(displayNode), box, displayBox[0])
+
+    results = []
+    results.append(('dense',) + drag(denseSmudge, False, auxTransformNode) + (array.nbytes,))
+    denseResult = array.copy()
+    array[:] = 0
+    results.append(('incremental',) + drag(incrementalSmudge, True, auxTransformNode) + (array.nbytes,))
+    np.testing.assert_allclose(array, denseResult, atol=1e-4)
+    results.append(('tiled',) + drag(tiledSmudge, True, displayNode) + (tiledGrid.getAllocatedBytes() + slicer.util.arrayFromGridTransform(displayNode).nbytes,))
+    np.testing.assert_allclose(tiledGrid.toDense(), denseResult, atol=1e-4)
+
+    for name, times, frames, memory in results:
+      logging.info('WarpDrive smudge drag benchmark, %s: %.1f ms per move (max %.1f ms), %d frames in %.2f s, %.1f MB' % (name, 1000 * times.mean(), 1000 * times.max(), frames, times.sum(), memory / 1024.**2))
+    self.assertLessEqual(results[1][2], results[0][2])
+    self.assertLess(results[2][3], results[0][3])
@@ -1,14 +1,20 @@
 import vtk, qt, slicer
+import logging
+import time
 
 import numpy as np
 
 from .Effect import AbstractEffect
-from ..Helpers import GridNodeHelper
+from ..Helpers import GridNodeHelper, LandmarkHelper, MarkupsHelper, RecomputeScheduler
 
 import WarpDrive
 
 class AbstractPointerEffect(AbstractEffect):
 
+  # previous corrections are modified in the background, independently of the effect instances
+  previousCorrectionsScheduler = None
+  pendingPreviousCorrections = []
+
   def __init__(self, sliceWidget):
     AbstractEffect.__init__(self, sliceWidget)
     self.parameterNode = WarpDrive.WarpDriveLogic().getParameterNode()
@@ -64,43 +70,140 @@ class AbstractPointerEffect(AbstractEffect):
         self.previousTransformNodeID = None
       
   def applyCorrection(self, sourceFiducial, targetFiducial):
-    if int(self.parameterNode.GetParameter("ModifiableCorrections")):
-      self.modifyPreviousCorrections(sourceFiducial, targetFiducial)
+    modifyingPrevious = int(self.parameterNode.GetParameter("ModifiableCorrections")) and self.modifyPreviousCorrections(sourceFiducial, targetFiducial)
     sourceFiducial.ApplyTransform(self.parameterNode.GetNodeReference("OutputGridTransform").GetTransformFromParent()) # undo current
+    self.decimateCorrection(sourceFiducial, targetFiducial, float(self.parameterNode.GetParameter("Radius")))
     self.setFiducialNodeAs("Source", sourceFiducial, targetFiducial.GetName(), self.parameterNode.GetParameter("Radius"))
     self.setFiducialNodeAs("Target", targetFiducial, targetFiducial.GetName(), self.parameterNode.GetParameter("Radius"))
-    self.parameterNode.SetParameter("Update","true")
+    if not modifyingPrevious:
+      # otherwise updated once the previous corrections are moved
+      self.parameterNode.SetParameter("Update","true")
+
+  def decimateCorrection(self, sourceFiducial, targetFiducial, radius):
+    # merge near-duplicate pairs of dense strokes to keep the RBF system small
+    numberOfPoints = targetFiducial.GetNumberOfControlPoints()
+    if numberOfPoints < 2:
+      return
+    sourcePoints, targetPoints = LandmarkHelper.decimateLandmarks(slicer.util.arrayFromMarkupsControlPoints(sourceFiducial), slicer.util.arrayFromMarkupsControlPoints(targetFiducial), radius)
+    slicer.util.updateMarkupsControlPointsFromArray(sourceFiducial, sourcePoints)
+    slicer.util.updateMarkupsControlPointsFromArray(targetFiducial, targetPoints)
+    logging.info('WarpDrive: correction decimated from %d to %d landmarks' % (numberOfPoints, len(targetPoints)))
+
+  @staticmethod
+  def fiducialFromPoints(points, name=None):
+    """
+    Hidden fiducial node with the given points, filled before it is added to the scene
+    so that the scene and its observers are notified once.
+    """
+    fiducial = slicer.vtkMRMLMarkupsFiducialNode()
+    if name is not None:
+      fiducial.SetName(name)
+    slicer.util.updateMarkupsControlPointsFromArray(fiducial, np.asarray(points, dtype=float).reshape(-1,3))
+    slicer.mrmlScene.AddNode(fiducial)
+    fiducial.CreateDefaultDisplayNodes()
+    fiducial.GetDisplayNode().SetGlyphTypeFromString('Sphere3D')
+    fiducial.GetDisplayNode().SetGlyphScale(1)
+    fiducial.GetDisplayNode().SetVisibility(0)
+    fiducial.GetDisplayNode().SetPointLabelsVisibility(0)
+    return fiducial
 
   def setFiducialNodeAs(self, type, fromNode, name, radius):
     toNode = self.parameterNode.GetNodeReference(type + "Fiducial")
-    for i in range(fromNode.GetNumberOfControlPoints()):
-      toNode.AddControlPoint(vtk.vtkVector3d(fromNode.GetNthControlPointPosition(i)), name)
-      toNode.SetNthControlPointDescription(toNode.GetNumberOfControlPoints()-1, radius)
+    MarkupsHelper.addControlPoints(toNode, slicer.util.arrayFromMarkupsControlPoints(fromNode), name, radius)
     slicer.mrmlScene.RemoveNode(fromNode)
 
-  def modifyPreviousCorrections(self, sourceFiducial, targetFiducial):
-    if self.parameterNode.GetNodeReference("TargetFiducial").GetNumberOfControlPoints() == 0:
-      return
+  @classmethod
+  def modifyPreviousCorrections(cls, sourceFiducial, targetFiducial):
+    """
+    Moves the previous target landmarks with the warp of the new correction, without blocking the GUI.
+    The warp is computed in the background and applied when it completes. Corrections made
+    while it runs are warped after it, one at a time in the order they were made.
+    Returns whether an update was queued, in which case the warp is updated once it is applied.
+    """
+    previousTargetFiducial = WarpDrive.WarpDriveLogic().getParameterNode().GetNodeReference("TargetFiducial")
+    if previousTargetFiducial.GetNumberOfControlPoints() == 0:
+      return False
+    # copy the correction, as its nodes are removed before the update starts
+    sourcePoints = WarpDrive.WarpDriveLogic.getSelectedControlPointPositions(sourceFiducial)
+    targetPoints = WarpDrive.WarpDriveLogic.getSelectedControlPointPositions(targetFiducial)
+    # control points to move, by ID as the indices change when corrections are removed
+    controlPointIDs = [previousTargetFiducial.GetNthControlPointID(i) for i in range(previousTargetFiducial.GetNumberOfControlPoints())]
+    cls.pendingPreviousCorrections.append((sourcePoints, targetPoints, controlPointIDs))
+    cls.getPreviousCorrectionsScheduler().request()
+    return True
+
+  @classmethod
+  def getPreviousCorrectionsScheduler(cls):
+    if cls.previousCorrectionsScheduler is None:
+      # results of previous corrections are still needed, so running updates are not cancelled
+      # shared by all the pointer effects
+      AbstractPointerEffect.previousCorrectionsScheduler = RecomputeScheduler.RecomputeScheduler(cls.startPreviousCorrectionsUpdate, lambda cliNode: None)
+    return cls.previousCorrectionsScheduler
+
+  @classmethod
+  def startPreviousCorrectionsUpdate(cls):
+    """
+    Starts the warp of the oldest pending correction, applying the ones computed in-process right away.
+    Each correction only moves the landmarks that existed when it was made, as when they were warped
+    one after the other. Returns the running cli node, or None if all were applied.
+    """
+    parameterNode = WarpDrive.WarpDriveLogic().getParameterNode()
     # reference
-    size,origin,spacing,directionMatrix = GridNodeHelper.getGridDefinition(self.parameterNode.GetNodeReference("InputNode"))
-    userSpacing = np.ones(3) * float(self.parameterNode.GetParameter("Spacing"))
+    size,origin,spacing,directionMatrix = GridNodeHelper.getGridDefinition(parameterNode.GetNodeReference("InputNode"))
+    userSpacing = np.ones(3) * float(parameterNode.GetParameter("Spacing"))
     size = size * (spacing / userSpacing)
-    auxVolumeNode = GridNodeHelper.emptyVolume(size.astype(int), origin, userSpacing, directionMatrix)
-    # output
-    outputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLGridTransformNode')
+    outputGrid = (size.astype(int), origin, userSpacing, directionMatrix)
     # params
-    RBFRadius = []
-    for i in range(targetFiducial.GetNumberOfControlPoints()):
-      if targetFiducial.GetNthControlPointSelected(i):
-        RBFRadius.append(self.parameterNode.GetParameter("Radius"))
-    RBFRadius = ",".join(RBFRadius)
-    stiffness = float(self.parameterNode.GetParameter("Stiffness"))
-
-    self.parameterNode.SetParameter("Running", "true")
-    cliNode = WarpDrive.WarpDriveLogic().computeWarp(auxVolumeNode, outputNode, sourceFiducial, targetFiducial, RBFRadius, stiffness, wait_for_completion=True)
-
-    self.parameterNode.GetNodeReference("TargetFiducial").ApplyTransform(outputNode.GetTransformToParent())
-    self.parameterNode.SetParameter("Running", "false")
-    slicer.mrmlScene.RemoveNode(auxVolumeNode)
-    slicer.mrmlScene.RemoveNode(outputNode)
-    slicer.mrmlScene.RemoveNode(cliNode)
+    stiffness = float(parameterNode.GetParameter("Stiffness"))
+
+    while cls.pendingPreviousCorrections:
+      sourcePoints, targetPoints, controlPointIDs = cls.pendingPreviousCorrections.pop(0)
+      # nodes
+      sourceFiducial = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
+      targetFiducial = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
+      slicer.util.updateMarkupsControlPointsFromArray(sourceFiducial, sourcePoints)
+      slicer.util.updateMarkupsControlPointsFromArray(targetFiducial, targetPoints)
+      outputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLGridTransformNode')
+      tmpNodes = [sourceFiducial, targetFiducial, outputNode]
+      RBFRadius = ",".join([parameterNode.GetParameter("Radius")] * len(targetPoints))
+
+      startTime = time.perf_counter()
+      cliNode = WarpDrive.WarpDriveLogic().computeWarp(outputGrid, outputNode, sourceFiducial, targetFiducial, RBFRadius, stiffness, preview=False)
+      logging.info('WarpDrive: previous corrections update blocked the GUI for %.3f s' % (time.perf_counter() - startTime))
+
+      if cliNode is not None:
+        cliNode.AddObserver(slicer.vtkMRMLCommandLineModuleNode.StatusModifiedEvent, lambda c,e,i=controlPointIDs,n=tmpNodes: cls.onPreviousCorrectionsUpdated(c,i,n))
+        return cliNode
+      cls.onPreviousCorrectionsUpdated(None, controlPointIDs, tmpNodes)
+    return None
+
+  @classmethod
+  def onPreviousCorrectionsUpdated(cls, cliNode, controlPointIDs, tmpNodes):
+    if cliNode is not None:
+      if cliNode.IsBusy():
+        return
+      qt.QTimer.singleShot(1000, lambda: slicer.mrmlScene.RemoveNode(cliNode))
+
+    parameterNode = WarpDrive.WarpDriveLogic().getParameterNode()
+    if cliNode is None or cliNode.GetStatus() == cliNode.Completed:
+      transform = tmpNodes[-1].GetTransformToParent()
+      previousTargetFiducial = parameterNode.GetNodeReference("TargetFiducial")
+      wasModifying = previousTargetFiducial.StartModify()
+      for controlPointID in controlPointIDs:
+        index = previousTargetFiducial.GetNthControlPointIndexByID(controlPointID)
+        if index >= 0:
+          previousTargetFiducial.SetNthControlPointPosition(index, *transform.TransformPoint(previousTargetFiducial.GetNthControlPointPosition(index)))
+      previousTargetFiducial.EndModify(wasModifying)
+    else:
+      logging.error('WarpDrive: failed to modify previous corrections (%s)' % cliNode.GetStatusString())
+    # the warp includes the new correction either way
+    parameterNode.SetParameter("Update","true")
+
+    for node in tmpNodes:
+      slicer.mrmlScene.RemoveNode(node)
+
+    # start the update of the next correction made meanwhile, if any
+    scheduler = cls.getPreviousCorrectionsScheduler()
+    scheduler.jobFinished(cliNode)
+    if cls.pendingPreviousCorrections and not scheduler.isBusy():
+      scheduler.request()
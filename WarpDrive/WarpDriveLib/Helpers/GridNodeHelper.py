@@ -26,6 +26,22 @@ def getGridDefinition(node):
 
   return size,origin,spacing,directionMatrix
 
+def getGridDefinitionAsCLIParameters(size, origin, spacing, directionMatrix):
+  # output grid parameters of FiducialRegistrationVariableRBF, in LPS
+  rasToLps = np.diag([-1, -1, 1])
+  direction = np.array([[directionMatrix.GetElement(row,col) for col in range(3)] for row in range(3)])
+  return {
+    "outputSize" : ",".join(str(int(s)) for s in size),
+    "outputOrigin" : ",".join(str(o) for o in rasToLps.dot(origin)),
+    "outputSpacing" : ",".join(str(s) for s in spacing),
+    "outputDirection" : ",".join(str(d) for d in rasToLps.dot(direction).flatten()),
+    }
+
+def getCoarseGridDefinition(size, origin, spacing, directionMatrix, factor):
+  # grid with factor times the spacing, covering at least the same region
+  coarseSize = np.ceil((np.asarray(size) - 1) / factor).astype(int) + 1
+  return coarseSize, origin, np.asarray(spacing) * factor, directionMatrix
+
 def getTransformRASToIJK(transformNode):
   size,origin,spacing,directionMatrix = getGridDefinition(transformNode)
   m = vtk.vtkMatrix4x4()
@@ -62,22 +78,3 @@ def emptyGridTransform(transformSize, transformOrigin, transformSpacing, directi
   transformNode.GetTransformFromParent().GetDisplacementGrid().SetSpacing(transformSpacing)
 
   return transformNode
-
-
-def emptyVolume(imageSize, imageOrigin, imageSpacing, directionMatrix):
-  voxelType = vtk.VTK_UNSIGNED_CHAR
-  fillVoxelValue = 0
-  # Create an empty image volume, filled with fillVoxelValue
-  imageData = vtk.vtkImageData()
-  imageData.SetDimensions(imageSize)
-  imageData.AllocateScalars(voxelType, 1)
-  imageData.GetPointData().GetScalars().Fill(fillVoxelValue)
-  # Create volume node
-  volumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
-  volumeNode.SetOrigin(imageOrigin)
-  volumeNode.SetSpacing(imageSpacing)
-  volumeNode.SetIJKToRASDirectionMatrix(directionMatrix)
-  volumeNode.SetAndObserveImageData(imageData)
-  volumeNode.CreateDefaultDisplayNodes()
-
-  return volumeNode
\ No newline at end of file
@@ -0,0 +1,50 @@
+import numpy as np
+
+
+def decimateLandmarks(sourcePoints, targetPoints, radius, distanceFraction=0.25, displacementTolerance=0.5):
+  """
+  Merge near-duplicate source/target pairs into their mean.
+  Pairs are merged if their target points (the RBF centers) are closer than distanceFraction * radius
+  and their displacements (source - target) differ by less than displacementTolerance (mm).
+  The displacement of every merged pair is therefore within displacementTolerance of the one it is replaced by.
+  Returns the decimated source and target points as Nx3 arrays.
+  """
+  sourcePoints = np.asarray(sourcePoints, dtype=float).reshape(-1,3)
+  targetPoints = np.asarray(targetPoints, dtype=float).reshape(-1,3)
+  displacements = sourcePoints - targetPoints
+  maxDistance = distanceFraction * radius
+
+  decimatedSource = []
+  decimatedTarget = []
+  remaining = np.ones(len(targetPoints), dtype=bool)
+  for i in range(len(targetPoints)):
+    if not remaining[i]:
+      continue
+    # pairs close to the seed, both in position and displacement
+    closeTarget = np.linalg.norm(targetPoints - targetPoints[i], axis=1) <= maxDistance
+    closeDisplacement = np.linalg.norm(displacements - displacements[i], axis=1) <= displacementTolerance / 2.0
+    cluster = remaining & closeTarget & closeDisplacement
+    remaining[cluster] = False
+    decimatedSource.append(sourcePoints[cluster].mean(axis=0))
+    decimatedTarget.append(targetPoints[cluster].mean(axis=0))
+
+  return np.array(decimatedSource).reshape(-1,3), np.array(decimatedTarget).reshape(-1,3)
+
+
+def resamplePolyline(points, sampleDistance=1.0, numberOfPoints=None):
+  """
+  Points evenly spaced along the polyline through the given points, including its end points.
+  The spacing is the closest to sampleDistance that divides the polyline length, unless numberOfPoints is given.
+  Returns an Nx3 array, with a single point if the polyline has no length.
+  """
+  points = np.asarray(points, dtype=float).reshape(-1,3)
+  segmentLengths = np.linalg.norm(np.diff(points, axis=0), axis=1)
+  if len(points) == 0 or not np.any(segmentLengths > 0):
+    return points[:1].copy()
+  # arc length at each point, without the repeated ones
+  keep = np.concatenate([[True], segmentLengths > 0])
+  arcLength = np.concatenate([[0], np.cumsum(segmentLengths)])[keep]
+  if numberOfPoints is None:
+    numberOfPoints = max(int(round(arcLength[-1] / sampleDistance)), 1) + 1
+  samples = np.linspace(0, arcLength[-1], numberOfPoints)
+  return np.stack([np.interp(samples, arcLength, points[keep,a]) for a in range(3)], axis=1)
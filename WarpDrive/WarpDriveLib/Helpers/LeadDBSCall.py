@@ -19,24 +19,20 @@ def setApprovedData(normalizationMethodFile, value):
 
 def applyChanges(correctionsTransformNodeID, nativeReferencePath, templateReferencePath, forwardWarpPath, inverseWarpPath, subjectWarpDrivePath, useExternalInstance):
 
-  forwardParams = {
+  # forward and inverse are computed in one run, loading the corrections once
+  params = {
     "inputTransform1File": forwardWarpPath,
     "inputTransform2Node": correctionsTransformNodeID,
     "inputReferenceVolumeFile" : templateReferencePath,
-    "outputFileName" : forwardWarpPath
+    "outputFileName" : forwardWarpPath,
+    "inverseTransformFile": inverseWarpPath,
+    "inverseReferenceVolumeFile" : nativeReferencePath,
+    "outputInverseFileName" : inverseWarpPath,
+    "compressionLevel" : slicer.util.settingsValue("NetstimPreferences/warpDriveCompressionLevel", 6, converter=int)
     } 
 
-  inverseParams = {
-    "inputTransform1Node": correctionsTransformNodeID,
-    "inputTransform2File": inverseWarpPath,
-    "inputReferenceVolumeFile" : nativeReferencePath,
-    "outputFileName" : inverseWarpPath
-    }
-
-  forwardCliNode = slicer.mrmlScene.AddNode(slicer.cli.createNode(slicer.modules.compositetogridtransform, forwardParams))
-  forwardCliNode.SetName('forwardCompositeToGrid')
-  inverseCliNode = slicer.mrmlScene.AddNode(slicer.cli.createNode(slicer.modules.compositetogridtransform, inverseParams))
-  inverseCliNode.SetName('inverseCompositeToGrid')
+  cliNode = slicer.mrmlScene.AddNode(slicer.cli.createNode(slicer.modules.compositetogridtransform, params))
+  cliNode.SetName('compositeToGrid')
 
   subName = os.path.basename(os.path.dirname(subjectWarpDrivePath))
   tmpScenePath = os.path.join(subjectWarpDrivePath, 'tmpScene')
@@ -49,15 +45,14 @@ def applyChanges(correctionsTransformNodeID, nativeReferencePath, templateRefere
                     w.children()[5].hide();\
                     w.children()[6].hide();\
                     w.children()[7].hide();\
-                    w.setCurrentCommandLineModuleNode(forwardCliNode);\
+                    w.setCurrentCommandLineModuleNode(cliNode);\
                     txt = ctk.ctkFittedTextBrowser(w);\
                     txt.setHtml(\'Subject: '+subName+'.<br><br>Saving changes to the normalization transformation files.<br><br>This window is independent of Slicer and Lead-DBS and will close when finished.\');\
                     w.children()[1].insertWidget(0,txt);\
                     w.resize(w.width,w.height/2);\
                     qt.QApplication.processEvents();\
-                    forwardCliNode.AddObserver(\'ModifiedEvent\', lambda c,e,w=w,icli=inverseCliNode: [slicer.util.getNode(c.GetParameterAsString(\'inputTransform2Node\')).Inverse(), w.setCurrentCommandLineModuleNode(icli), slicer.cli.run(slicer.modules.compositetogridtransform, icli)] if (c.GetStatus() == c.Completed) else None);\
-                    inverseCliNode.AddObserver(\'ModifiedEvent\', lambda c,e,w=w,: [shutil.rmtree(r\''+tmpScenePath+'\') if os.path.isdir(r\''+tmpScenePath+'\') else None, w.close(), slicer.mrmlScene.Clear(), qt.QApplication.processEvents(), qt.QTimer().singleShot(1000, lambda: slicer.util.exit())] if (c.GetStatus() == c.Completed) else None);\
-                    slicer.cli.run(slicer.modules.compositetogridtransform, forwardCliNode);'
+                    cliNode.AddObserver(\'ModifiedEvent\', lambda c,e,w=w,: [shutil.rmtree(r\''+tmpScenePath+'\') if os.path.isdir(r\''+tmpScenePath+'\') else None, w.close(), slicer.mrmlScene.Clear(), qt.QApplication.processEvents(), qt.QTimer().singleShot(1000, lambda: slicer.util.exit())] if (c.GetStatus() == c.Completed) else None);\
+                    slicer.cli.run(slicer.modules.compositetogridtransform, cliNode);'
 
   if useExternalInstance:
 
@@ -67,8 +62,7 @@ def applyChanges(correctionsTransformNodeID, nativeReferencePath, templateRefere
 
     tmpScene = slicer.vtkMRMLScene()
     slicer.mrmlScene.CopyDefaultNodesToScene(tmpScene)
-    tmpScene.AddNode(forwardCliNode)
-    tmpScene.AddNode(inverseCliNode)
+    tmpScene.AddNode(cliNode)
     tmpScene.AddNode(slicer.util.getNode(correctionsTransformNodeID))
     tmpScene.SaveSceneToSlicerDataBundleDirectory(tmpScenePath)
     tmpScene.Clear()
@@ -78,8 +72,7 @@ def applyChanges(correctionsTransformNodeID, nativeReferencePath, templateRefere
     with open(tmpScriptPath, 'w') as f:
       f.write('import os, shutil, ctk;\
                 loadScene(r\''+os.path.join(tmpScenePath,'tmpScene.mrml')+'\');\
-                forwardCliNode = slicer.mrmlScene.GetFirstNodeByName(\'forwardCompositeToGrid\');\
-                inverseCliNode = slicer.mrmlScene.GetFirstNodeByName(\'inverseCompositeToGrid\');'\
+                cliNode = slicer.mrmlScene.GetFirstNodeByName(\'compositeToGrid\');'\
                 + python_commands + 'os.remove(r\''+tmpScriptPath+'\')')
 
     slicerInstallPath = os.path.dirname(os.path.dirname(sys.executable))
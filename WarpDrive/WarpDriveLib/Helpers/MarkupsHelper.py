@@ -0,0 +1,16 @@
+import vtk
+
+
+def addControlPoints(markupsNode, points, label='', description=''):
+  """
+  Adds the points to the markups node with the given label and description, in a single modification.
+  Observers get one notification of each kind at the end instead of one per point.
+  Returns the index of the first added control point.
+  """
+  wasModifying = markupsNode.StartModify()
+  firstIndex = markupsNode.GetNumberOfControlPoints()
+  for point in points:
+    index = markupsNode.AddControlPoint(vtk.vtkVector3d(point), label)
+    markupsNode.SetNthControlPointDescription(index, description)
+  markupsNode.EndModify(wasModifying)
+  return firstIndex
@@ -0,0 +1,85 @@
+import os
+import glob
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+
+def computeKey(sourcePoints, targetPoints, RBFRadius, stiffness, outputGrid):
+  """
+  Hash of everything that determines the output of FiducialRegistrationVariableRBF.
+  outputGrid is a (size, origin, spacing, directionMatrix) tuple, with directionMatrix as a 3x3 array.
+  """
+  size, origin, spacing, directionMatrix = outputGrid
+  h = hashlib.sha1()
+  for values in [sourcePoints, targetPoints, RBFRadius, [stiffness], size, origin, spacing, directionMatrix]:
+    array = np.ascontiguousarray(values, dtype=np.float64)
+    h.update(str(array.shape).encode())
+    h.update(array.tobytes())
+  return h.hexdigest()
+
+
+class RBFCache():
+  """
+  Displacement fields indexed by computeKey.
+  The most recently used fields are kept in memory, up to maxMemoryBytes. If a directory is given, the fields
+  evicted from memory are stored there, up to maxDiskBytes, removing the least recently used files first.
+  """
+
+  def __init__(self, maxMemoryBytes=512 * 1024 * 1024, diskPath=None, maxDiskBytes=0):
+    self.maxMemoryBytes = maxMemoryBytes
+    self.diskPath = diskPath
+    self.maxDiskBytes = maxDiskBytes
+    self.memory = OrderedDict()
+    self.memoryBytes = 0
+    if self.diskEnabled():
+      os.makedirs(self.diskPath, exist_ok=True)
+
+  def diskEnabled(self):
+    return self.diskPath is not None and self.maxDiskBytes > 0
+
+  def diskFileName(self, key):
+    return os.path.join(self.diskPath, key + '.npy')
+
+  def get(self, key):
+    if key in self.memory:
+      self.memory.move_to_end(key)
+      return self.memory[key]
+    if self.diskEnabled() and os.path.isfile(self.diskFileName(key)):
+      field = np.load(self.diskFileName(key))
+      os.utime(self.diskFileName(key)) # mark as recently used
+      self.put(key, field)
+      return field
+    return None
+
+  def put(self, key, field):
+    if key in self.memory:
+      self.memoryBytes -= self.memory[key].nbytes
+    self.memory[key] = field
+    self.memory.move_to_end(key)
+    self.memoryBytes += field.nbytes
+    while self.memoryBytes > self.maxMemoryBytes:
+      evictedKey, evictedField = self.memory.popitem(last=False)
+      self.memoryBytes -= evictedField.nbytes
+      self.putOnDisk(evictedKey, evictedField)
+
+  def putOnDisk(self, key, field):
+    if not self.diskEnabled() or field.nbytes > self.maxDiskBytes:
+      return
+    if not os.path.isfile(self.diskFileName(key)):
+      np.save(self.diskFileName(key), field)
+    os.utime(self.diskFileName(key))
+    # evict least recently used files
+    files = sorted(glob.glob(os.path.join(self.diskPath, '*.npy')), key=os.path.getmtime)
+    totalBytes = sum(os.path.getsize(f) for f in files)
+    while totalBytes > self.maxDiskBytes and files:
+      f = files.pop(0)
+      totalBytes -= os.path.getsize(f)
+      os.remove(f)
+
+  def clear(self):
+    self.memory.clear()
+    self.memoryBytes = 0
+    if self.diskEnabled():
+      for f in glob.glob(os.path.join(self.diskPath, '*.npy')):
+        os.remove(f)
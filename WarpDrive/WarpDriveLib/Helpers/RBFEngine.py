@@ -0,0 +1,101 @@
+import numpy as np
+
+
+def findCoefficients(sourcePoints, targetPoints, radius, stiffness):
+  """
+  Coefficients of the variable radius gaussian RBF, as computed by FiducialRegistrationVariableRBF.
+  The RBF centers are the target points and the field maps them to the source points.
+  radius is a scalar or one radius per landmark. Returns an Nx3 array.
+  """
+  sourcePoints = np.asarray(sourcePoints, dtype=float).reshape(-1,3)
+  targetPoints = np.asarray(targetPoints, dtype=float).reshape(-1,3)
+  radius = np.broadcast_to(np.asarray(radius, dtype=float), (len(targetPoints),))
+
+  squaredDistances = np.sum((targetPoints[:,np.newaxis,:] - targetPoints[np.newaxis,:,:])**2, axis=2)
+  # K[k,i] is the kernel of landmark k evaluated at landmark i
+  K = np.exp(-squaredDistances / radius[:,np.newaxis]**2)
+  A = K.T.dot(K)
+  b = K.T.dot(sourcePoints - targetPoints)
+
+  # regularization
+  prefactor = np.sqrt(np.pi/2.)**3 / radius.mean()
+  r2 = squaredDistances / np.outer(radius, radius)
+  regularization = prefactor * np.exp(-r2/2.) * (-10 + (r2-5.)**2)
+  np.fill_diagonal(regularization, prefactor * 15.)
+  A += stiffness * regularization
+
+  # Cholesky, falling back to SVD if not positive definite or ill-conditioned
+  try:
+    L = np.linalg.cholesky(A)
+    diagonal = np.abs(np.diag(L))
+    if (diagonal.min() / diagonal.max())**2 > 1e-6:
+      return np.linalg.solve(L.T, np.linalg.solve(L, b))
+  except np.linalg.LinAlgError:
+    pass
+  return np.linalg.lstsq(A, b, rcond=1e-6)[0]
+
+
+def getSupportBoxes(centers, radius, outputGrid, kernelTruncation):
+  """
+  Index bounds [lower, upper) of the grid voxels closer than kernelTruncation * radius to each center,
+  or of the whole grid if kernelTruncation is 0.
+  outputGrid is a (size, origin, spacing, direction) tuple, with direction as a 3x3 array. Returns two Nx3 arrays.
+  """
+  size, origin, spacing, direction = outputGrid
+  size = np.asarray(size, dtype=int)
+  if kernelTruncation <= 0:
+    return np.zeros((len(centers),3), dtype=int), np.tile(size, (len(centers),1))
+  rasToIJK = np.linalg.inv(np.asarray(direction, dtype=float) * np.asarray(spacing, dtype=float))
+  centersIJK = (np.asarray(centers) - origin).dot(rasToIJK.T)
+  # half width of the bounding box of a sphere along each index axis
+  halfWidths = kernelTruncation * np.asarray(radius, dtype=float).reshape(-1,1) * np.linalg.norm(rasToIJK, axis=1)
+  lower = np.clip(np.floor(centersIJK - halfWidths).astype(int), 0, size)
+  upper = np.clip(np.ceil(centersIJK + halfWidths).astype(int) + 1, 0, size)
+  return lower, upper
+
+
+def evaluationCost(targetPoints, radius, outputGrid, kernelTruncation=5.0):
+  """
+  Number of kernel evaluations of evaluateField plus the N^3 of the solve in findCoefficients for N landmarks,
+  to decide whether computeField is fast enough to run in-process.
+  """
+  targetPoints = np.asarray(targetPoints, dtype=float).reshape(-1,3)
+  radius = np.broadcast_to(np.asarray(radius, dtype=float), (len(targetPoints),))
+  lower, upper = getSupportBoxes(targetPoints, radius, outputGrid, kernelTruncation)
+  return int(np.prod(np.maximum(upper - lower, 0), axis=1).sum()) + len(targetPoints)**3
+
+
+def evaluateField(coefficients, targetPoints, radius, outputGrid, kernelTruncation=5.0):
+  """
+  Displacement field of the RBF over the output grid, in the layout of slicer.util.arrayFromGridTransform (k,j,i,3).
+  outputGrid is a (size, origin, spacing, direction) tuple in RAS, with direction as a 3x3 array.
+  Each landmark only contributes to the voxels closer than kernelTruncation times its radius (all of them if 0).
+  """
+  targetPoints = np.asarray(targetPoints, dtype=float).reshape(-1,3)
+  radius = np.broadcast_to(np.asarray(radius, dtype=float), (len(targetPoints),))
+  size, origin, spacing, direction = outputGrid
+  size = np.asarray(size, dtype=int)
+  ijkToRAS = np.asarray(direction, dtype=float) * np.asarray(spacing, dtype=float)
+
+  field = np.zeros((size[2], size[1], size[0], 3), dtype=np.float32)
+  lower, upper = getSupportBoxes(targetPoints, radius, outputGrid, kernelTruncation)
+  for center, r, coefficient, low, up in zip(targetPoints, radius, coefficients, lower, upper):
+    if np.any(up <= low):
+      continue
+    # offsets to the center of the voxels in the support box, broadcast as (k,j,i,3)
+    i, j, k = [np.arange(low[a], up[a]).reshape(-1,1) * ijkToRAS[:,a] for a in range(3)]
+    offsets = (origin - center) + k[:,np.newaxis,np.newaxis,:] + j[np.newaxis,:,np.newaxis,:] + i[np.newaxis,np.newaxis,:,:]
+    squaredDistances = np.sum(offsets**2, axis=3) / r**2
+    kernel = np.exp(-squaredDistances)
+    if kernelTruncation > 0:
+      kernel[squaredDistances > kernelTruncation**2] = 0
+    field[low[2]:up[2], low[1]:up[1], low[0]:up[0]] += kernel[...,np.newaxis] * coefficient
+  return field
+
+
+def computeField(sourcePoints, targetPoints, radius, stiffness, outputGrid, kernelTruncation=5.0):
+  """
+  In-process equivalent of FiducialRegistrationVariableRBF, without temporary files.
+  """
+  coefficients = findCoefficients(sourcePoints, targetPoints, radius, stiffness)
+  return evaluateField(coefficients, targetPoints, radius, outputGrid, kernelTruncation)
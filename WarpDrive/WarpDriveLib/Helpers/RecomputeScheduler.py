@@ -0,0 +1,54 @@
+class RecomputeScheduler():
+  """
+  Runs recompute jobs one at a time, keeping at most one job pending.
+  startJob() starts a job from the current state (e.g. the latest landmarks) and returns a handle,
+  such as a CLI node, or None if the job already completed. The owner must call jobFinished(handle)
+  when the job completes, fails or is cancelled.
+  A request while a job runs cancels it with cancelJob(handle), as its result is outdated, and
+  a single new job is started once it finishes, however many requests were made meanwhile.
+  """
+
+  def __init__(self, startJob, cancelJob):
+    self.startJob = startJob
+    self.cancelJob = cancelJob
+    self.runningJob = None
+    self.starting = False
+    self.pending = False
+    self.cancelRequested = False
+
+  def request(self):
+    if not self.isBusy():
+      self.start()
+      return
+    self.pending = True
+    # a job requested while starting another one cancels it once it has started
+    if not self.starting and not self.cancelRequested:
+      self.cancelRequested = True
+      self.cancelJob(self.runningJob)
+
+  def jobFinished(self, job):
+    if job is None or job != self.runningJob:
+      return
+    self.runningJob = None
+    if self.pending:
+      self.start()
+
+  def isBusy(self):
+    return self.starting or self.runningJob is not None
+
+  def start(self):
+    # startJob may process events, so requests can arrive before it returns
+    self.pending = False
+    self.cancelRequested = False
+    self.starting = True
+    try:
+      job = self.startJob()
+    finally:
+      self.starting = False
+    self.runningJob = job
+    if self.pending:
+      if job is None:
+        self.start()
+      else:
+        self.cancelRequested = True
+        self.cancelJob(job)
@@ -0,0 +1,155 @@
+import functools
+import numpy as np
+
+
+@functools.lru_cache(maxsize=8)
+def getKernel(r):
+  """
+  Gaussian smudge kernel of radius r voxels, a (2r+1)^3 float32 array equal to 1 at the center.
+  Kernels are cached by radius and shared, so they are read-only.
+  """
+  xx, yy, zz = np.mgrid[:2*r+1, :2*r+1, :2*r+1]
+  v = 0.5*r
+  kernel = np.exp(-0.5 * (((xx-r)/v) ** 2 + ((yy-r)/v) ** 2 + ((zz-r)/v) ** 2)).astype(np.float32)
+  kernel.flags.writeable = False
+  return kernel
+
+
+def getKernelBox(size, centerIJK, kernel):
+  """
+  Box of the grid of the given (i,j,k) size covered by the kernel centered at the voxel nearest to centerIJK (i,j,k),
+  clipped to the grid. Returns the (lower, upper) (i,j,k) index bounds, upper excluded, and the clipped kernel,
+  or None if the kernel is completely outside the grid.
+  """
+  r = kernel.shape[0] // 2
+  center = np.round(np.asarray(centerIJK, dtype=float)[:3]).astype(int)
+  lower = np.maximum(center - r, 0)
+  upper = np.minimum(center + r + 1, size)
+  if np.any(upper <= lower):
+    return None
+  kernelLower = lower - (center - r)
+  kernelUpper = upper - (center - r)
+  return (lower, upper), kernel[kernelLower[2]:kernelUpper[2], kernelLower[1]:kernelUpper[1], kernelLower[0]:kernelUpper[0]]
+
+
+def addKernel(array, centerIJK, kernel, displacement):
+  """
+  Adds kernel * displacement in place to the displacement array, with layout (k,j,i,3),
+  centering the kernel at the voxel nearest to centerIJK (i,j,k).
+  Near the border, the kernel is clipped to the array, so only its part inside the grid is added.
+  Returns the modified box as (lower, upper) (i,j,k) index bounds, upper excluded,
+  or None if the kernel is completely outside the array.
+  """
+  kernelBox = getKernelBox(array.shape[2::-1], centerIJK, kernel)
+  if kernelBox is None:
+    return None
+  (lower, upper), kernel = kernelBox
+  box = array[lower[2]:upper[2], lower[1]:upper[1], lower[0]:upper[0]]
+  weighted = np.empty(kernel.shape, dtype=array.dtype)
+  for component in range(3):
+    np.multiply(kernel, displacement[component], out=weighted)
+    box[..., component] += weighted
+  return lower, upper
+
+
+class TiledGrid():
+  """
+  Sparse displacement field over a grid of the given (i,j,k) size, stored in cubic float32 tiles
+  of tileSize voxels with layout (k,j,i,3). Tiles are allocated when modified, the rest of the grid is zero.
+  """
+
+  def __init__(self, size, tileSize=16):
+    self.size = np.asarray(size, dtype=int)
+    self.tileSize = tileSize
+    self.tiles = {}
+
+  def clear(self):
+    self.tiles = {}
+
+  def getAllocatedBytes(self):
+    return sum(tile.nbytes for tile in self.tiles.values())
+
+  def getBounds(self):
+    """
+    Box of the allocated tiles clipped to the grid, as (lower, upper) (i,j,k) index bounds, or None if empty.
+    """
+    if not self.tiles:
+      return None
+    keys = np.array(list(self.tiles.keys()))
+    return keys.min(axis=0) * self.tileSize, np.minimum((keys.max(axis=0) + 1) * self.tileSize, self.size)
+
+  def getTileRegions(self, box, allocate=False):
+    """
+    Parts of the tiles overlapping the box, as (tile, tile slices, box slices) tuples,
+    the slices being in (k,j,i) order. Missing tiles are allocated, or skipped if not allocate.
+    """
+    lower, upper = box
+    first = lower // self.tileSize
+    last = (upper - 1) // self.tileSize
+    for tk in range(first[2], last[2] + 1):
+      for tj in range(first[1], last[1] + 1):
+        for ti in range(first[0], last[0] + 1):
+          key = (ti, tj, tk)
+          tile = self.tiles.get(key)
+          if tile is None:
+            if not allocate:
+              continue
+            tile = self.tiles[key] = np.zeros((self.tileSize,) * 3 + (3,), dtype=np.float32)
+          tileLower = np.array(key) * self.tileSize
+          regionLower = np.maximum(lower, tileLower)
+          regionUpper = np.minimum(upper, tileLower + self.tileSize)
+          tileSlices = tuple(slice(regionLower[a] - tileLower[a], regionUpper[a] - tileLower[a]) for a in (2,1,0))
+          boxSlices = tuple(slice(regionLower[a] - lower[a], regionUpper[a] - lower[a]) for a in (2,1,0))
+          yield tile, tileSlices, boxSlices
+
+  def addKernel(self, centerIJK, kernel, displacement):
+    """
+    Same as addKernel on the dense field, allocating the tiles covered by the kernel.
+    """
+    kernelBox = getKernelBox(self.size, centerIJK, kernel)
+    if kernelBox is None:
+      return None
+    box, kernel = kernelBox
+    weighted = kernel[..., np.newaxis] * np.asarray(displacement, dtype=np.float32)
+    for tile, tileSlices, boxSlices in self.getTileRegions(box, allocate=True):
+      tile[tileSlices] += weighted[boxSlices]
+    return box
+
+  def copyTo(self, array, box, arrayLower):
+    """
+    Copies the allocated tiles in the box to the dense array, with layout (k,j,i,3), whose first voxel
+    is the grid voxel arrayLower (i,j,k). The voxels of the array in missing tiles are not modified.
+    """
+    lower = np.asarray(box[0]) - arrayLower
+    upper = np.asarray(box[1]) - arrayLower
+    region = array[lower[2]:upper[2], lower[1]:upper[1], lower[0]:upper[0]]
+    for tile, tileSlices, boxSlices in self.getTileRegions(box):
+      region[boxSlices] = tile[tileSlices]
+
+  def toDense(self, box=None):
+    """
+    Dense displacement field over the box (the whole grid if None), with layout (k,j,i,3).
+    """
+    if box is None:
+      box = (np.zeros(3, dtype=int), self.size)
+    lower, upper = box
+    array = np.zeros(tuple((upper - lower)[::-1]) + (3,), dtype=np.float32)
+    self.copyTo(array, box, lower)
+    return array
+
+  def getDisplayBox(self, displayBox=None):
+    """
+    Box of a dense field showing the allocated tiles, with a margin of zeros so that the displacement
+    stays zero when extended outside of it. The current displayBox is returned if it is still valid.
+    Returns None if there are no tiles.
+    """
+    bounds = self.getBounds()
+    if bounds is None:
+      return None
+    if displayBox is not None:
+      # allocated tiles must leave one zero voxel inside the display, except at the grid border
+      innerLower = displayBox[0] + (displayBox[0] > 0)
+      innerUpper = displayBox[1] - (displayBox[1] < self.size)
+      if np.all(bounds[0] >= innerLower) and np.all(bounds[1] <= innerUpper):
+        return displayBox
+    return np.maximum(bounds[0] - self.tileSize, 0), np.minimum(bounds[1] + self.tileSize, self.size)
@@ -5,7 +5,7 @@ import numpy as np
 from ..Widgets.ToolWidget   import AbstractToolWidget
 from ..Effects.DrawEffect import AbstractDrawEffect
 
-from ..Helpers import GridNodeHelper
+from ..Helpers import GridNodeHelper, LandmarkHelper
 
 class DrawToolWidget(AbstractToolWidget):
   
@@ -64,8 +64,7 @@ class DrawToolEffect(AbstractDrawEffect):
           return
 
       else: # use new drawing as target fiducial
-        targetFiducial = self.getFiducialFromDrawing(nPoints = self.sourceFiducial.GetNumberOfControlPoints())
-        targetFiducial.SetName(slicer.mrmlScene.GenerateUniqueName('drawing'))
+        targetFiducial = self.getFiducialFromDrawing(nPoints = self.sourceFiducial.GetNumberOfControlPoints(), name = slicer.mrmlScene.GenerateUniqueName('drawing'))
 
       if targetFiducial is None:
         slicer.mrmlScene.RemoveNode(self.sourceFiducial)
@@ -82,24 +81,16 @@ class DrawToolEffect(AbstractDrawEffect):
       slicer.mrmlScene.RemoveNode(self.sourceFiducial)
       self.sourceFiducial = None
 
-  def getFiducialFromDrawing(self, sampleDistance = 1, nPoints = None):
+  def getFiducialFromDrawing(self, sampleDistance = 1, nPoints = None, name = None):
 
-    # create curve from drawing and resample
-    sourceCurve = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsCurveNode')
-    sourceCurve.Copy(self.drawnCurveNode)
-    sourceCurve.ResampleCurveWorld(sampleDistance)
-    if nPoints is not None: # resample to get specified number of points
-      sourceCurve.ResampleCurveWorld(sourceCurve.GetCurveLengthWorld() / max((nPoints - 1), 1))
+    # resample drawing, to the specified number of points if given
+    drawnPoints = slicer.util.arrayFromMarkupsControlPoints(self.drawnCurveNode, world=True)
+    points = LandmarkHelper.resamplePolyline(drawnPoints, sampleDistance, nPoints)
 
-    sourceFiducial = self.curveToFiducial(sourceCurve)
-
-    slicer.mrmlScene.RemoveNode(sourceCurve)
-
-    if sourceFiducial.GetNumberOfControlPoints() <= 1:
-      slicer.mrmlScene.RemoveNode(sourceFiducial)
+    if len(points) <= 1:
       return None
     else:
-      return sourceFiducial
+      return self.fiducialFromPoints(points, name)
 
   def getFiducialFromSlicedModel(self, sampleDistance = 1):
 
@@ -119,13 +110,10 @@ class DrawToolEffect(AbstractDrawEffect):
     targetCurve.SetCurveTypeToShortestDistanceOnSurface(slicedModel)
     targetCurve.ResampleCurveWorld(targetCurve.GetCurveLengthWorld() / max((resampledPoints.GetNumberOfPoints() - 1), 1))
       
-    # curve to fiducial
-    targetFiducial = self.curveToFiducial(targetCurve)
-
-    # set name
+    # curve to fiducial, named after the model
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
     modelParentName =  shNode.GetItemName(shNode.GetItemParent(shNode.GetItemByDataNode(originalModel)))
-    targetFiducial.SetName(modelParentName + '_' + originalModel.GetName())
+    targetFiducial = self.curveToFiducial(targetCurve, modelParentName + '_' + originalModel.GetName())
 
     # remove
     slicer.mrmlScene.RemoveNode(targetCurve)
@@ -145,16 +133,8 @@ class DrawToolEffect(AbstractDrawEffect):
       targetNode.AddControlPoint(p, label)
 
 
-  def curveToFiducial(self, curve):
-    fiducial = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
-    fiducial.GetDisplayNode().SetGlyphTypeFromString('Sphere3D')
-    fiducial.GetDisplayNode().SetGlyphScale(1)
-    fiducial.GetDisplayNode().SetVisibility(0)
-    fiducial.GetDisplayNode().SetPointLabelsVisibility(0)
-    points = vtk.vtkPoints()
-    curve.GetControlPointPositionsWorld(points)
-    fiducial.SetControlPointPositionsWorld(points)
-    return fiducial
+  def curveToFiducial(self, curve, name = None):
+    return self.fiducialFromPoints(slicer.util.arrayFromMarkupsControlPoints(curve, world=True), name)
 
   def sliceClosestModel(self, point):
     shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
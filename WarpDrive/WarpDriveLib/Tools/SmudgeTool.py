@@ -5,7 +5,7 @@ import numpy as np
 from ..Widgets.ToolWidget   import AbstractToolWidget
 from ..Effects.CircleEffect import AbstractCircleEffect
 
-from ..Helpers import GridNodeHelper
+from ..Helpers import GridNodeHelper, LandmarkHelper, SmudgeHelper
 
 class SmudgeToolWidget(AbstractToolWidget):
     
@@ -16,8 +16,15 @@ class SmudgeToolWidget(AbstractToolWidget):
 
 class SmudgeToolEffect(AbstractCircleEffect):
 
+  # smudge displacements over the auxiliary grid, stored in tiles allocated where the brush has been
+  auxGrid = None
+  auxGridDefinition = None
+  # dense grid transform showing the allocated part of auxGrid
   auxTransformNode = None
+  auxDisplayBox = None
   auxTransfromRASToIJK = None
+  # slice views are updated at most this many times per second while smudging
+  maxFrameRate = 30
 
   def __init__(self, sliceWidget):
     AbstractCircleEffect.__init__(self, sliceWidget)
@@ -27,15 +34,23 @@ class SmudgeToolEffect(AbstractCircleEffect):
       size, origin, spacing, directionMatrix = GridNodeHelper.getGridDefinition(self.parameterNode.GetNodeReference("InputNode"))
       userSpacing = np.ones(3) * float(self.parameterNode.GetParameter("Spacing"))
       size = size * (spacing / userSpacing)
-      type(self).auxTransformNode = GridNodeHelper.emptyGridTransform(size.astype(int), origin, userSpacing, directionMatrix) 
-      type(self).auxTransfromRASToIJK = GridNodeHelper.getTransformRASToIJK(self.auxTransformNode)  
+      type(self).auxGrid = SmudgeHelper.TiledGrid(size.astype(int))
+      type(self).auxGridDefinition = (origin, userSpacing, directionMatrix)
+      type(self).auxTransformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLGridTransformNode')
+      self.setAuxDisplayBox(None)
+      type(self).auxTransfromRASToIJK = GridNodeHelper.getTransformRASToIJK(self.auxTransformNode)
 
     # points
-    self.interactionPoints = vtk.vtkPoints()
+    self.interactionPoints = []
 
     self.previousPoint = np.zeros(3)
     self.smudging = False
 
+    self.redrawTimer = qt.QTimer()
+    self.redrawTimer.setSingleShot(True)
+    self.redrawTimer.setInterval(int(1000 / self.maxFrameRate))
+    self.redrawTimer.connect('timeout()', self.updateView)
+
 
   def processEvent(self, caller=None, event=None):
 
@@ -43,24 +58,21 @@ class SmudgeToolEffect(AbstractCircleEffect):
 
     if event == 'LeftButtonPressEvent':
       self.parameterNode.GetNodeReference("OutputGridTransform").SetAndObserveTransformNodeID(self.auxTransformNode.GetID())    
-      self.auxTransformArray = slicer.util.array(self.auxTransformNode.GetID())
       self.previousPoint = self.xyToRAS(self.interactor.GetEventPosition())
-      self.interactionPoints.InsertNextPoint(self.previousPoint)
+      self.interactionPoints.append(self.previousPoint)
       self.smudging = True
 
     elif event == 'LeftButtonReleaseEvent' and self.smudging:
       self.smudging = False
-      # resample
-      self.resamplePoints()
+      self.updateView()
       # get source and target
       sourceFiducial, targetFiducial = self.getSourceTargetFromPoints()
       # apply
       self.applyCorrection(sourceFiducial, targetFiducial)
       # reset
       self.parameterNode.GetNodeReference("OutputGridTransform").HardenTransform()
-      self.interactionPoints = vtk.vtkPoints()
-      self.auxTransformArray[:] = np.zeros(self.auxTransformArray.shape)
-      self.auxTransformNode.Modified()
+      self.interactionPoints = []
+      self.clearAuxTransform()
       # qt.QApplication.setOverrideCursor(qt.QCursor(qt.Qt.ArrowCursor))
 
     elif (event == 'RightButtonPressEvent' or (event == 'KeyPressEvent' and self.interactor.GetKeySym()=='Escape')) and self.smudging:
@@ -69,73 +81,65 @@ class SmudgeToolEffect(AbstractCircleEffect):
     elif event == 'MouseMoveEvent' and self.smudging:
 
       r = int(round(float(self.parameterNode.GetParameter("Radius")) / self.auxTransformNode.GetTransformFromParent().GetDisplacementGrid().GetSpacing()[0])) # Asume isotropic!
-      sphereResult = self.createSphere(r)
       currentPoint = np.array(self.xyToRAS(self.interactor.GetEventPosition()))
-      currentIndex = self.getCurrentIndex(r, currentPoint, self.auxTransfromRASToIJK)
-      self.interactionPoints.InsertNextPoint(currentPoint)
+      currentIJK = self.auxTransfromRASToIJK.MultiplyDoublePoint(np.append(currentPoint, 1))
+      self.interactionPoints.append(currentPoint)
 
-      # apply to transform array
-      try:
-        self.auxTransformArray[currentIndex] += np.stack([(sphereResult) * i for i in (self.previousPoint - currentPoint)],3) # original
-      except ValueError: # error when modifing outside the grid
-        self.cancelSmudging()
+      # apply to auxiliary grid, clipped to the grid
+      box = self.auxGrid.addKernel(currentIJK, SmudgeHelper.getKernel(r), self.previousPoint - currentPoint)
+      if box is not None:
+        self.updateAuxDisplay(box)
 
       # update view
-      self.auxTransformNode.Modified()
+      if not self.redrawTimer.isActive():
+        self.redrawTimer.start()
       # update previous point
       self.previousPoint = currentPoint
 
 
   def cancelSmudging(self):
     self.smudging = False
-    self.interactionPoints = vtk.vtkPoints()
-    self.auxTransformArray[:] = np.zeros(self.auxTransformArray.shape)
+    self.interactionPoints = []
+    self.clearAuxTransform()
+
+  def clearAuxTransform(self):
+    self.auxGrid.clear()
+    self.setAuxDisplayBox(None)
+    self.updateView()
+
+  def setAuxDisplayBox(self, box):
+    # empty dense grid transform over the box of the auxiliary grid, or a small one at its origin if None
+    origin, spacing, directionMatrix = self.auxGridDefinition
+    lower, upper = box if box is not None else (np.zeros(3, dtype=int), np.ones(3, dtype=int) * 2)
+    displayOrigin = np.array(origin) + slicer.util.arrayFromVTKMatrix(directionMatrix)[:3,:3].dot(spacing * lower)
+    GridNodeHelper.emptyGridTransform(upper - lower, displayOrigin, spacing, directionMatrix, self.auxTransformNode)
+    type(self).auxDisplayBox = box
+
+  def updateAuxDisplay(self, box):
+    # copy the modified box to the dense transform, growing it when new tiles get close to its border
+    displayBox = self.auxGrid.getDisplayBox(self.auxDisplayBox)
+    if displayBox is not self.auxDisplayBox:
+      self.setAuxDisplayBox(displayBox)
+      box = self.auxGrid.getBounds()
+    self.auxGrid.copyTo(slicer.util.arrayFromGridTransform(self.auxTransformNode), box, displayBox[0])
+
+  def updateView(self):
+    self.redrawTimer.stop()
     self.auxTransformNode.Modified()
 
-  def resamplePoints(self):
-    # resample points 
-    sourceCurve = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsCurveNode')
-    sourceCurve.SetControlPointPositionsWorld(self.interactionPoints)
-    sourceCurve.ResampleCurveWorld(1)  
-    sourceCurve.GetControlPointPositionsWorld(self.interactionPoints)
-    slicer.mrmlScene.RemoveNode(sourceCurve)
-
   def getSourceTargetFromPoints(self):
-    # source points
-    sourceFiducial = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
-    sourceFiducial.GetDisplayNode().SetGlyphTypeFromString('Sphere3D')
-    sourceFiducial.GetDisplayNode().SetGlyphScale(1)
-    sourceFiducial.GetDisplayNode().SetVisibility(0)
-    sourceFiducial.SetControlPointPositionsWorld(self.interactionPoints)
-    # target
-    targetFiducial = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
-    targetFiducial.GetDisplayNode().SetGlyphTypeFromString('Sphere3D')
-    targetFiducial.GetDisplayNode().SetGlyphScale(1)
-    targetFiducial.GetDisplayNode().SetVisibility(0)
-    targetFiducial.SetControlPointPositionsWorld(self.interactionPoints)
-    targetFiducial.ApplyTransform(self.auxTransformNode.GetTransformToParent()) # apply smudge
-    targetFiducial.SetName(slicer.mrmlScene.GenerateUniqueName('smudge'))
-
+    # source points, resampled along the stroke
+    sourcePoints = LandmarkHelper.resamplePolyline(self.interactionPoints, sampleDistance=1)
+    # target, applying the smudge
+    transform = self.auxTransformNode.GetTransformToParent()
+    targetPoints = [transform.TransformPoint(point) for point in sourcePoints]
+
+    sourceFiducial = self.fiducialFromPoints(sourcePoints)
+    targetFiducial = self.fiducialFromPoints(targetPoints, slicer.mrmlScene.GenerateUniqueName('smudge'))
     return sourceFiducial, targetFiducial
 
-  def createSphere(self, r):
-    # create a sphere with redius
-    xx, yy, zz = np.mgrid[:2*r+1, :2*r+1, :2*r+1]
-    v = 0.5*r
-    sphereResult = ((xx-r)/v) ** 2 + ((yy-r)/v) ** 2 + ((zz-r)/v) ** 2
-    sphereResult = np.exp(-0.5 * sphereResult)
-    sphereResult = sphereResult / sphereResult[r][r][r]
-    return sphereResult
-
-  def getCurrentIndex(self, r, currentPoint, RASToIJK):
-    # get current IJK
-    pos_i,pos_j,pos_k,aux = RASToIJK.MultiplyDoublePoint(np.append(currentPoint, 1))
-    k,j,i = int(round(pos_k)),int(round(pos_j)),int(round(pos_i))
-    # expand with radius
-    currentIndex = slice(k-r,k+r+1), slice(j-r,j+r+1), slice(i-r,i+r+1)
-    return currentIndex
-
   def cleanup(self):
+    self.redrawTimer.stop()
     slicer.mrmlScene.RemoveNode(self.auxTransformNode)
     type(self).cleanAuxTransform()
     #WarpEffectTool.cleanup(self)
@@ -143,5 +147,8 @@ class SmudgeToolEffect(AbstractCircleEffect):
 
   @classmethod
   def cleanAuxTransform(cls):
+    cls.auxGrid = None
+    cls.auxGridDefinition = None
     cls.auxTransformNode = None
+    cls.auxDisplayBox = None
     cls.auxTransfromRASToIJK = None
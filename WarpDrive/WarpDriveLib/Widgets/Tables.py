@@ -525,6 +525,11 @@ class WarpDriveCorrectionsManager(VTKObservationMixin, WarpDriveCorrectionsTable
     self.addObserver(self.parameterNode, vtk.vtkCommand.ModifiedEvent, self.updateNodesListeners)
     self.addObserver(self.parameterNode, vtk.vtkCommand.ModifiedEvent, self.updateGUIFromSnapOptions)
     self._updatingSnapGUI = False
+    # point events of the same modification rebuild the table once
+    self.setUpWidgetTimer = qt.QTimer()
+    self.setUpWidgetTimer.setSingleShot(True)
+    self.setUpWidgetTimer.setInterval(0)
+    self.setUpWidgetTimer.connect('timeout()', self.setUpWidget)
 
   def visibilityChanged(self, action):
     if action.text == 'Source':
@@ -586,7 +591,11 @@ class WarpDriveCorrectionsManager(VTKObservationMixin, WarpDriveCorrectionsTable
         self.sourceVisibleAction.checked = sourceFiducialNode.GetDisplayNode().GetVisibility()
 
   def targetFiducialModified(self, caller, event):
-    self.setUpWidget()
+    # edits made from the table itself do not rebuild it
+    if self._updatingFiducials:
+      return
+    if not self.setUpWidgetTimer.isActive():
+      self.setUpWidgetTimer.start()
 
   def setUpWidget(self):
     if self._updatingFiducials: